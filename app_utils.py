@@ -4,9 +4,14 @@ app_utils.py  –  Estado compartido, conexión DB y utilidades Streamlit.
 import os
 import sys
 import json
+import collections
 import datetime
 import re
+import random
+import threading
+import time
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
@@ -175,6 +180,8 @@ def init_session_state():
         "auto_recipe":   {},
         # Avisos de la última generación
         "gen_warnings":  [],
+        # Se incrementa cada vez que cambia excel_dfs (ver marcar_db_cambiada)
+        "db_version":    0,
     }
     for k, v in defaults.items():
         if k not in st.session_state:
@@ -228,9 +235,82 @@ def _normalizar_fecha(val) -> str:
 def _nsort(s):
     return [int(t) if t.isdigit() else t.lower() for t in re.split(r"(\d+)", str(s))]
 
-def _load_cfg(dfs: dict):
-    """Lee las hojas de configuración del dfs y actualiza session_state."""
-    dfs = lib.init_cfg_from_data(dfs)
+def marcar_db_cambiada():
+    """Incrementa db_version. Lo que se deriva de excel_dfs (p. ej. los bytes de la
+    descarga) se memoriza por versión y se regenera solo cuando hace falta."""
+    st.session_state["db_version"] = st.session_state.get("db_version", 0) + 1
+
+def indice_similitud() -> "lib.IndiceSimilitud":
+    """Índice de similitud de enunciados de la sesión. Cuando cambia db_version se
+    pone al día con df_preguntas re-firmando solo altas y cambios."""
+    idx = st.session_state.get("_indice_similitud")
+    if idx is None:
+        idx = st.session_state["_indice_similitud"] = lib.IndiceSimilitud()
+    ver = st.session_state.get("db_version", 0)
+    if idx.version != ver:
+        idx.sincronizar(st.session_state.get("df_preguntas"))
+        idx.version = ver
+    return idx
+
+def indice_texto() -> "lib.IndiceTexto":
+    """Índice de búsqueda de texto sobre df_preguntas; se construye la primera vez
+    que se busca en cada db_version."""
+    ver = st.session_state.get("db_version", 0)
+    idx = st.session_state.get("_indice_texto")
+    if idx is None or idx.version != ver:
+        idx = lib.IndiceTexto(st.session_state.get("df_preguntas"))
+        idx.version = ver
+        st.session_state["_indice_texto"] = idx
+    return idx
+
+def indice_facetas() -> "lib.IndiceFacetas":
+    """Máscaras de filtrado (bloque, tema, dificultad, uso…) de df_preguntas,
+    calculadas una vez por db_version."""
+    ver = st.session_state.get("db_version", 0)
+    df = st.session_state.get("df_preguntas")
+    idx = st.session_state.get("_indice_facetas")
+    if idx is None or idx.version != ver or len(idx) != (0 if df is None else len(df)):
+        idx = lib.IndiceFacetas(df)
+        idx.version = ver
+        st.session_state["_indice_facetas"] = idx
+    return idx
+
+def pesos_muestreo() -> np.ndarray:
+    """Pesos de exposición (lib.pesos_exposicion) de cada fila de df_preguntas a
+    partir del historial de uso; se calculan una vez por db_version."""
+    ver = st.session_state.get("db_version", 0)
+    df = st.session_state.get("df_preguntas")
+    memo = st.session_state.get("_pesos_muestreo")
+    if memo is None or memo[0] != ver or len(memo[1]) != (0 if df is None else len(df)):
+        if df is None or df.empty:
+            pesos = np.ones(0)
+        else:
+            historial = lib.get_historial_uso(st.session_state.get("excel_dfs") or {})
+            pesos = lib.pesos_exposicion(*lib.exposicion_preguntas(df, historial))
+        memo = (ver, pesos)
+        st.session_state["_pesos_muestreo"] = memo
+    return memo[1]
+
+def filtrar_por_busqueda(df: pd.DataFrame, texto: str, aproximada: bool = False) -> pd.DataFrame:
+    """Filas de df (subconjunto de df_preguntas) que cumplen la búsqueda. En modo
+    aproximado se toleran erratas y el resultado se ordena por parecido."""
+    if not texto or not texto.strip():
+        return df
+    idx = indice_texto()
+    if not aproximada:
+        return df[df["ID_Pregunta"].isin(idx.buscar(texto))]
+    ids, punt = idx.buscar_aproximado(texto)
+    rango = pd.Series(np.arange(len(ids)), index=ids)
+    rango = rango[~rango.index.duplicated()]
+    df = df[df["ID_Pregunta"].isin(rango.index)]
+    return df.iloc[np.argsort(rango.reindex(df["ID_Pregunta"]).to_numpy(), kind="stable")]
+
+def _load_cfg(dfs: dict, df_preguntas=None):
+    """Lee las hojas de configuración del dfs y actualiza session_state.
+    Con df_preguntas (las preguntas ya procesadas de este mismo dfs) las hojas de
+    preguntas solo se leen si sus temas no coinciden con Cfg_Temas."""
+    temas = None if df_preguntas is None or "Tema" not in df_preguntas else df_preguntas["Tema"]
+    dfs = lib.init_cfg_from_data(dfs, temas)
     st.session_state.cfg_bloques   = lib.get_cfg_bloques(dfs)
     st.session_state.cfg_temas     = lib.get_cfg_temas(dfs)
     st.session_state.cfg_general   = lib.get_cfg_general(dfs)
@@ -254,148 +334,177 @@ def nombre_tema(tema: str) -> str:
     return f"Tema {t}: {nombre}" if nombre else f"Tema {t}"
 
 
-def procesar_excel_dfs(dfs: dict) -> pd.DataFrame:
+_COLS_PREGUNTAS = ["ID_Pregunta", "bloque", "Tema", "enunciado", "opciones_list", "letra_correcta",
+                   "dificultad", "usada", "notas", "solucion", "datos", "comentario", "objetivo",
+                   "fecha_uso"]
+_TXT_NULOS = ("nan", "NaT", "None")
+_DERIVADO_PREGUNTAS = "preguntas_v2"   # cambiar si cambia _procesar_hoja (invalida la caché)
+
+def _procesar_hoja(b_name: str, df_sheet: pd.DataFrame):
+    """Preguntas de una hoja de bloque con las columnas estándar (sin 'fecha_uso'),
+    o None si la hoja no tiene preguntas."""
+    if df_sheet.empty:
+        return None
+    head = [str(h).lower().strip() for h in df_sheet.columns]
+
+    # Detectar índices de columnas clave
+    idx_id   = next((i for i, h in enumerate(head) if "id_preg" in h or h == "id"), -1)
+    idx_enun = next((i for i, h in enumerate(head) if "enunciado" in h), -1)
+    idx_tem  = next((i for i, h in enumerate(head) if "tema" in h and "id" not in h), -1)
+    idx_dif  = next((i for i, h in enumerate(head) if "dificultad" in h), -1)
+    idx_nota = next((i for i, h in enumerate(head) if "nota" in h and "soluci" not in h), -1)
+    idx_sol  = next((i for i, h in enumerate(head) if "soluci" in h), -1)
+    idx_datos = next((i for i, h in enumerate(head) if h == "datos" or h == "datos_ids"), -1)
+    idx_com   = next((i for i, h in enumerate(head) if "comentar" in h), -1)
+    idx_obj   = next((i for i, h in enumerate(head) if h == "objetivo"), -1)
+
+    # Columna "usada"
+    idx_usada = next((i for i, h in enumerate(head) if "usada" in h or "fecha" in h), -1)
+
+    if idx_id == -1 or idx_enun == -1:
+        return None
+
+    # Ignorar filas sin ID
+    ids  = df_sheet.iloc[:, idx_id].map(str).str.strip()
+    keep = ~(ids.eq("") | ids.str.lower().isin(("nan", "none", "id_pregunta")))
+    if not keep.any():
+        return None
+    sub   = df_sheet[keep.to_numpy()]
+    ids   = ids[keep]
+    n_col = sub.shape[1]
+
+    def _txt(i):
+        return sub.iloc[:, i].map(str)
+
+    def _limpio(i):
+        # Campos de texto libre: strip y "" para nan/NaT/None
+        if i == -1 or i >= n_col:
+            return ""
+        s = _txt(i).str.strip()
+        return s.mask(s.isin(_TXT_NULOS), "").tolist()
+
+    # Tema
+    if idx_tem != -1:
+        tem = _txt(idx_tem).str.strip()
+        tem = tem.mask(tem.str.endswith(".0"), tem.str[:-2])
+        tem = tem.mask(tem.isin(("nan", "None", "")), "1").tolist()
+    else:
+        tem = "1"
+
+    # Opciones: 4 columnas justo después del enunciado
+    ops_cols = []
+    for j in range(4):
+        oi = idx_enun + 1 + j
+        if oi < n_col:
+            o = _txt(oi)
+            ops_cols.append(o.mask(o.isin(("nan", "None")), "").tolist())
+        else:
+            ops_cols.append([""] * len(sub))
+    ops = [list(t) for t in zip(*ops_cols)]
+
+    # Respuesta correcta: típicamente enunciado + 5 (enun, A, B, C, D, Correcta)
+    corr_idx = idx_enun + 5
+    if corr_idx < n_col:
+        corr = _txt(corr_idx).str.strip().str.upper()
+        corr = corr.where(corr.isin(("A", "B", "C", "D")), "A").tolist()
+    else:
+        corr = "A"
+
+    # Dificultad
+    if idx_dif != -1:
+        dif = _txt(idx_dif).str.strip()
+        dif = dif.mask(dif.isin(("nan", "None", "")), "Media").tolist()
+    else:
+        dif = "Media"
+
+    # Usada / fecha: pocas fechas distintas → normalizar una vez por valor
+    if idx_usada != -1:
+        u = sub.iloc[:, idx_usada]
+        if pd.api.types.is_datetime64_any_dtype(u):
+            u_val = u.dt.strftime("%Y-%m-%d").fillna("").tolist()
+        else:
+            codes, uniques = pd.factorize(u)
+            tabla = np.array([_normalizar_fecha(v) for v in uniques] + [""], dtype=object)
+            u_val = tabla[codes].tolist()   # código -1 (nulo) → ""
+    else:
+        u_val = ""
+
+    return pd.DataFrame({
+        "ID_Pregunta":   ids.tolist(),
+        "bloque":        b_name,
+        "Tema":          tem,
+        "enunciado":     _txt(idx_enun).tolist(),
+        "opciones_list": ops,
+        "letra_correcta": corr,
+        "dificultad":    dif,
+        "usada":         u_val,
+        "notas":         _limpio(idx_nota),
+        "solucion":      _limpio(idx_sol),
+        "datos":         _limpio(idx_datos),      # IDs de constantes físicas
+        "comentario":    _limpio(idx_com),        # etiqueta de importación
+        "objetivo":      _limpio(idx_obj),        # objetivo docente
+    })
+
+def procesar_excel_dfs(dfs: dict, cache=None) -> pd.DataFrame:
     """
     Dado el dict {nombre_hoja: DataFrame} que devuelve cargar_excel_local,
     construye un DataFrame unificado con las columnas estándar:
       ID_Pregunta, bloque, Tema, enunciado, opciones_list, letra_correcta,
       dificultad, usada, notas
+    más 'fecha_uso', la fecha de 'usada' tipada como datetime64 (NaT si no hay)
+    para filtrar por antigüedad sin convertir fila a fila.
+    Trabaja por columnas: los índices se detectan una vez por hoja y cada campo
+    se normaliza con operaciones vectorizadas sobre str(valor).
+    Con `cache` (lib.CacheLibro) se reutilizan las preguntas ya procesadas de
+    las hojas que no han cambiado y se guardan las del resto.
     """
-    rows = []
-    for b_name, df_sheet in dfs.items():
+    partes, nuevas = [], {}
+    sucias = getattr(dfs, "sucias", set())
+    for b_name in dfs.keys():
         if b_name in lib.CFG_SHEETS:
             continue
-        if df_sheet.empty:
-            continue
-        head = [str(h).lower().strip() for h in df_sheet.columns]
-
-        # Detectar índices de columnas clave
-        idx_id   = next((i for i, h in enumerate(head) if "id_preg" in h or h == "id"), -1)
-        idx_enun = next((i for i, h in enumerate(head) if "enunciado" in h), -1)
-        idx_tem  = next((i for i, h in enumerate(head) if "tema" in h and "id" not in h), -1)
-        idx_dif  = next((i for i, h in enumerate(head) if "dificultad" in h), -1)
-        idx_nota = next((i for i, h in enumerate(head) if "nota" in h and "soluci" not in h), -1)
-        idx_sol  = next((i for i, h in enumerate(head) if "soluci" in h), -1)
-        idx_datos = next((i for i, h in enumerate(head) if h == "datos" or h == "datos_ids"), -1)
-        idx_com   = next((i for i, h in enumerate(head) if "comentar" in h), -1)
-        idx_obj   = next((i for i, h in enumerate(head) if h == "objetivo"), -1)
-
-        # Opciones: 4 columnas justo después del enunciado
-        idx_opA  = idx_enun + 1 if idx_enun != -1 else -1
-
-        # Columna correcta: típicamente enunciado + 5
-        idx_corr_offset = 5  # enun, A, B, C, D, Correcta
-
-        # Columna "usada"
-        idx_usada = next((i for i, h in enumerate(head) if "usada" in h or "fecha" in h), -1)
-
-        for _, row_s in df_sheet.iterrows():
-            r = row_s.tolist()
-
-            if idx_id == -1 or idx_enun == -1 or idx_opA == -1:
-                continue
-
-            # Ignorar filas sin ID
-            id_val = str(r[idx_id]).strip()
-            if not id_val or id_val.lower() in ("nan", "none", "id_pregunta"):
-                continue
-
-            # Tema
-            tem_raw = str(r[idx_tem]).strip() if idx_tem != -1 else "1"
-            if tem_raw.endswith(".0"):
-                tem_raw = tem_raw[:-2]
-            if tem_raw in ("nan", "None", ""):
-                tem_raw = "1"
-
-            # Opciones (4 columnas)
-            ops = []
-            for j in range(4):
-                oi = idx_opA + j
-                ops.append(str(r[oi]) if oi < len(r) and str(r[oi]) not in ("nan", "None") else "")
-
-            # Respuesta correcta
-            corr_idx = idx_enun + idx_corr_offset
-            if corr_idx < len(r):
-                corr_raw = str(r[corr_idx]).strip().upper()
+        parte = None
+        if cache is not None and b_name not in sucias:
+            parte = cache.leer_derivado(_DERIVADO_PREGUNTAS, b_name)
+        if parte is None:
+            parte = _procesar_hoja(b_name, dfs[b_name])
+            if parte is None:
+                parte = pd.DataFrame(columns=_COLS_PREGUNTAS[:-1])
             else:
-                corr_raw = "A"
-            if corr_raw not in ("A", "B", "C", "D"):
-                corr_raw = "A"
-
-            # Dificultad
-            dif_raw = str(r[idx_dif]).strip() if idx_dif != -1 and idx_dif < len(r) else "Media"
-            if dif_raw in ("nan", "None", ""):
-                dif_raw = "Media"
-
-            # Usada / fecha
-            u_val = ""
-            if idx_usada != -1 and idx_usada < len(r):
-                u_val = _normalizar_fecha(r[idx_usada])
-
-            # Notas
-            nota_val = ""
-            if idx_nota != -1 and idx_nota < len(r):
-                n = str(r[idx_nota]).strip()
-                nota_val = "" if n in ("nan", "NaT", "None") else n
-
-            # Solución
-            sol_val = ""
-            if idx_sol != -1 and idx_sol < len(r):
-                s = str(r[idx_sol]).strip()
-                sol_val = "" if s in ("nan", "NaT", "None") else s
-
-            # Datos (IDs de constantes físicas, separados por coma)
-            datos_val = ""
-            if idx_datos != -1 and idx_datos < len(r):
-                d = str(r[idx_datos]).strip()
-                datos_val = "" if d in ("nan", "NaT", "None") else d
-
-            # Comentario / etiqueta de importación
-            com_val = ""
-            if idx_com != -1 and idx_com < len(r):
-                c = str(r[idx_com]).strip()
-                com_val = "" if c in ("nan", "NaT", "None") else c
-
-            # Objetivo docente
-            obj_val = ""
-            if idx_obj != -1 and idx_obj < len(r):
-                o = str(r[idx_obj]).strip()
-                obj_val = "" if o in ("nan", "NaT", "None") else o
-
-            rows.append({
-                "ID_Pregunta":   id_val,
-                "bloque":        b_name,
-                "Tema":          tem_raw,
-                "enunciado":     str(r[idx_enun]),
-                "opciones_list": ops,
-                "letra_correcta": corr_raw,
-                "dificultad":    dif_raw,
-                "usada":         u_val,
-                "notas":         nota_val,
-                "solucion":      sol_val,
-                "datos":         datos_val,
-                "comentario":    com_val,
-                "objetivo":      obj_val,
-            })
-
-    if not rows:
-        return pd.DataFrame(columns=["ID_Pregunta","bloque","Tema","enunciado",
-                                      "opciones_list","letra_correcta","dificultad","usada","notas","solucion","datos","comentario","objetivo"])
-    return pd.DataFrame(rows)
+                # Tipada ya en la parte: la caché la guarda y no hay que volver a parsearla
+                parte["fecha_uso"] = lib.columna_fecha_uso(parte)
+            nuevas[b_name] = parte
+        if len(parte):
+            partes.append(parte)
+    if cache is not None:
+        cache.escribir_derivados(_DERIVADO_PREGUNTAS, nuevas)
+
+    if not partes:
+        df = pd.DataFrame(columns=_COLS_PREGUNTAS[:-1])
+    else:
+        df = pd.concat(partes, ignore_index=True)
+    df["fecha_uso"] = lib.columna_fecha_uso(df)
+    return df
 
 # ── Conexión ─────────────────────────────────────────────────────────────────
 def connect_db(path: str):
-    """Carga el Excel desde ruta local y actualiza session_state."""
+    """Carga la DB desde ruta local (.xlsx o SQLite .db) y actualiza session_state."""
     try:
-        dfs = lib.cargar_excel_local(path)
-        dfs = _load_cfg(dfs)
-        df  = procesar_excel_dfs(dfs)
+        # Caché en disco (_cache/ junto al archivo): si no ha cambiado desde la
+        # última carga se evita openpyxl, y solo se procesan las hojas que cambiaron.
+        cache = lib.CacheLibro(path)
+        dfs = cache.leer_hojas()
+        if dfs is None:
+            dfs = lib.cargar_sqlite(path) if lib.es_ruta_sqlite(path) else lib.cargar_excel_local(path)
+            cache.escribir_hojas(dfs)
+        df  = procesar_excel_dfs(dfs, cache=cache)
+        dfs = _load_cfg(dfs, df)
         st.session_state.excel_path    = path
         st.session_state.excel_dfs     = dfs
         st.session_state.df_preguntas  = df
         st.session_state.bloques       = [k for k in dfs if k not in lib.CFG_SHEETS]
-        st.session_state["excel_bytes"] = lib.generar_excel_bytes(dfs)
         st.session_state.db_connected  = True
+        marcar_db_cambiada()
         n_blq = len(st.session_state.bloques)
         return True, f"{len(df)} preguntas en {n_blq} bloque(s)"
     except FileNotFoundError:
@@ -408,62 +517,81 @@ def connect_db(path: str):
         st.session_state.db_connected = False
         return False, f"Error al cargar: {e}"
 
-def connect_db_from_gsheets(token: dict, spreadsheet_url: str) -> tuple:
-    """Carga la DB desde Google Sheets usando token OAuth 2.0. Retorna (ok, mensaje)."""
+def _df_desde_valores(valores: list) -> pd.DataFrame:
+    """DataFrame de strings a partir de las celdas de una pestaña (primera fila =
+    cabecera), equivalente a ws.get_all_records(numericise_ignore=["all"])."""
+    if len(valores) < 2:
+        return pd.DataFrame()
+    cabecera = [str(c) for c in valores[0]]
+    if len(set(cabecera)) != len(cabecera):
+        return pd.DataFrame()  # cabeceras repetidas: get_all_records tampoco las acepta
+    ancho = len(cabecera)
+    filas = [(list(f) + [""] * ancho)[:ancho] for f in valores[1:]]
+    return pd.DataFrame(filas, columns=cabecera)
+
+def connect_db_from_gsheets(token: dict, spreadsheet_url: str, descartar_cambios: bool = False) -> tuple:
+    """Carga la DB desde Google Sheets usando token OAuth 2.0. Retorna (ok, mensaje).
+
+    Si quedan hojas de la sesión sin sincronizar (envío que no termina o que ha
+    fallado) no recarga nada, para no perderlas, salvo con descartar_cambios=True."""
     try:
-        import gspread
-        from google.oauth2.credentials import Credentials
-
-        creds = Credentials(
-            token=token.get("access_token"),
-            scopes=["https://www.googleapis.com/auth/spreadsheets"],
-        )
-        gc = gspread.authorize(creds)
-
         # Extraer ID del spreadsheet desde la URL
         m = re.search(r"/spreadsheets/d/([a-zA-Z0-9\-_]+)", spreadsheet_url)
         if not m:
             return False, "URL de Google Sheets no válida. Debe ser del tipo: https://docs.google.com/spreadsheets/d/..."
         spreadsheet_id = m.group(1)
 
-        sh = gc.open_by_key(spreadsheet_id)
+        ses = sesion_gsheets(token, spreadsheet_id)
+        cola = cola_sync_gsheets()
+        # Que lo leído incluya los cambios aún en cola; si no se han podido enviar
+        # todos, recargar los pisaría con la versión de Google Sheets
+        enviado = cola.vaciar()
+        est = cola.estado()
+        if not descartar_cambios and (not enviado or est["fallidas"]):
+            sin_enviar = sorted(set(est["pendientes"]) | set(est["fallidas"]))
+            msg = ("Hay cambios sin sincronizar con Google Sheets en: "
+                   f"{', '.join(sin_enviar)}. Reinténtalo o descarga el Excel antes "
+                   "de recargar, o recarga descartándolos.")
+            # El sidebar pide confirmación antes de descartarlos (_render_confirmar_recarga)
+            st.session_state["_gsheets_confirmar"] = {"url": spreadsheet_url, "msg": msg}
+            return False, msg
+        st.session_state.pop("_gsheets_confirmar", None)
+        ses.olvidar_metadatos()   # recarga: las pestañas pueden haber cambiado
+        sh = ses.sh
         st.session_state["_gsheets_id"] = spreadsheet_id
-        dfs = {}
+        dfs = lib.LibroHojas()
         existing_sheet_names = set()
-        for ws in sh.worksheets():
-            try:
-                records = ws.get_all_records(numericise_ignore=["all"])
-            except Exception:
-                records = []
-            dfs[ws.title] = pd.DataFrame(records) if records else pd.DataFrame()
-            existing_sheet_names.add(ws.title)
+        for titulo, valores in ses.valores_de(ses.hojas()).items():
+            dfs[titulo] = _df_desde_valores(valores)
+            existing_sheet_names.add(titulo)
+        dfs.marcar_guardado()
+        # Lo leído es la versión sincronizada de partida para los envíos incrementales
+        snaps = {n: _grid_hoja(d) for n, d in dfs.items()}
 
-        dfs = _load_cfg(dfs)
+        df = procesar_excel_dfs(dfs)
+        dfs = _load_cfg(dfs, df)
 
         # Empujar a GSheets las hojas de config que no existían allí (creadas en memoria)
         for cfg_name in lib.CFG_SHEETS:
             if cfg_name not in existing_sheet_names and cfg_name in dfs:
                 df_cfg = dfs[cfg_name]
                 try:
-                    ws_cfg = sh.add_worksheet(
-                        title=cfg_name,
-                        rows=max(100, len(df_cfg) + 5),
-                        cols=max(10, len(df_cfg.columns) + 1),
-                    )
+                    ses.hoja(cfg_name, filas=max(100, len(df_cfg) + 5),
+                             cols=max(10, len(df_cfg.columns) + 1))
                     if len(df_cfg.columns) > 0:
-                        headers = list(df_cfg.columns)
-                        rows_data = df_cfg.fillna("").astype(str).values.tolist()
-                        ws_cfg.update([headers] + rows_data)
+                        snaps[cfg_name], _ = sincronizar_hoja_delta(ses, cfg_name, df_cfg, [])
+                    else:
+                        snaps[cfg_name] = _grid_hoja(df_cfg)
                 except Exception:
                     pass  # no crítico, se intentará al guardar en Configuración
+        cola.reiniciar(ses, snaps, descartar=descartar_cambios)
 
-        df = procesar_excel_dfs(dfs)
         st.session_state.excel_path    = ""
         st.session_state.excel_dfs     = dfs
         st.session_state.df_preguntas  = df
         st.session_state.bloques       = [k for k in dfs if k not in lib.CFG_SHEETS]
         st.session_state.db_connected  = True
-        st.session_state["excel_bytes"] = lib.generar_excel_bytes(dfs)
+        marcar_db_cambiada()
         st.session_state["_gsheets_url"]  = spreadsheet_url
         st.session_state["_gsheets_title"] = sh.title
         st.session_state["_upload_name"]   = f"GSheets: {sh.title}"
@@ -477,18 +605,16 @@ def connect_db_from_gsheets(token: dict, spreadsheet_url: str) -> tuple:
 def connect_db_from_upload(uploaded_file) -> tuple:
     """Carga el Excel desde un st.file_uploader (cloud mode). Retorna (ok, mensaje)."""
     try:
-        import io
         bytes_data = uploaded_file.read()
-        xls = pd.ExcelFile(io.BytesIO(bytes_data), engine='openpyxl')
-        dfs = {name: pd.read_excel(xls, sheet_name=name) for name in xls.sheet_names}
-        dfs = _load_cfg(dfs)
+        dfs = lib.cargar_excel_bytes(bytes_data)
         df  = procesar_excel_dfs(dfs)
+        dfs = _load_cfg(dfs, df)
         st.session_state.excel_path    = ""   # sin ruta en cloud
         st.session_state.excel_dfs     = dfs
         st.session_state.df_preguntas  = df
         st.session_state.bloques       = [k for k in dfs if k not in lib.CFG_SHEETS]
         st.session_state.db_connected  = True
-        st.session_state["excel_bytes"] = lib.generar_excel_bytes(dfs)
+        marcar_db_cambiada()
         st.session_state["_upload_name"] = uploaded_file.name
         return True, f"Conectado: {uploaded_file.name}"
     except Exception as e:
@@ -505,17 +631,580 @@ def reload_db():
     # GSheets / upload: re-procesa desde dfs ya en memoria
     dfs = st.session_state.get("excel_dfs", {})
     if dfs:
-        dfs = _load_cfg(dfs)
         df = procesar_excel_dfs(dfs)
+        dfs = _load_cfg(dfs, df)
         st.session_state.excel_dfs     = dfs
         st.session_state.df_preguntas  = df
         st.session_state.bloques       = [k for k in dfs if k not in lib.CFG_SHEETS]
         st.session_state.db_connected  = True
-        st.session_state["excel_bytes"] = lib.generar_excel_bytes(dfs)
+        marcar_db_cambiada()
+
+# ── Planificador de peticiones a Google Sheets ───────────────────────────────
+# La API limita las peticiones por minuto y usuario (lecturas y escrituras por
+# separado). Todas las llamadas de SesionGSheets pasan por un cubo de fichas
+# por tipo; las del hilo de sincronización (prioridad de fondo) dejan una
+# reserva y ceden el turno a las interactivas. Los límites se pueden ajustar en
+# st.secrets["GSHEETS_CUOTA"] (lecturas_min, escrituras_min, rafaga).
+PRIORIDAD_INTERACTIVA = 0
+PRIORIDAD_FONDO       = 1
+_GSHEETS_CUOTA = {"lecturas_min": 60, "escrituras_min": 60, "rafaga": 10}
+_prioridad_hilo = threading.local()
+
+def prioridad_actual() -> int:
+    """Prioridad de las peticiones hechas desde el hilo actual."""
+    return getattr(_prioridad_hilo, "valor", PRIORIDAD_INTERACTIVA)
+
+class PlanificadorGSheets:
+    """Cubos de fichas de lectura y escritura con prioridad y estadísticas."""
+
+    TIPOS = ("lectura", "escritura")
+
+    def __init__(self, lecturas_min: float = 60, escrituras_min: float = 60,
+                 rafaga: int = 10, reserva: float = 0.3):
+        # Con tasa 0 adquirir() dividiría por cero y con ráfaga 0 no daría nunca ficha
+        if not (lecturas_min > 0 and escrituras_min > 0):
+            raise ValueError(f"lecturas_min y escrituras_min deben ser > 0 "
+                             f"(recibido {lecturas_min}, {escrituras_min})")
+        if not rafaga >= 1:
+            raise ValueError(f"rafaga debe ser >= 1 (recibido {rafaga})")
+        if not 0 <= reserva < 1:
+            raise ValueError(f"reserva debe estar en [0, 1) (recibido {reserva})")
+        self.rafaga = rafaga
+        self.reserva = reserva * rafaga   # fichas que el fondo no puede gastar
+        self._tasa = {"lectura": lecturas_min / 60.0, "escritura": escrituras_min / 60.0}
+        ahora = time.monotonic()
+        self._fichas = {t: float(rafaga) for t in self.TIPOS}
+        self._ultimo = {t: ahora for t in self.TIPOS}
+        self._esperando = {t: [0, 0] for t in self.TIPOS}   # por prioridad
+        self._stats = {t: {"llamadas": 0, "errores": 0, "espera_total": 0.0,
+                           "espera_max": 0.0, "duracion_total": 0.0,
+                           "recientes": collections.deque()} for t in self.TIPOS}
+        self._cv = threading.Condition()
+
+    def _rellenar(self, tipo: str, ahora: float):
+        self._fichas[tipo] = min(self.rafaga, self._fichas[tipo]
+                                 + (ahora - self._ultimo[tipo]) * self._tasa[tipo])
+        self._ultimo[tipo] = ahora
+
+    def adquirir(self, tipo: str, prioridad: int = None) -> float:
+        """Bloquea hasta que haya ficha para `tipo`. Retorna los segundos esperados."""
+        prioridad = prioridad_actual() if prioridad is None else prioridad
+        minimo = 1 + (self.reserva if prioridad == PRIORIDAD_FONDO else 0)
+        inicio = time.monotonic()
+        with self._cv:
+            self._esperando[tipo][prioridad] += 1
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._rellenar(tipo, ahora)
+                    cede = (prioridad == PRIORIDAD_FONDO
+                            and self._esperando[tipo][PRIORIDAD_INTERACTIVA] > 0)
+                    if not cede and self._fichas[tipo] >= min(minimo, self.rafaga):
+                        self._fichas[tipo] -= 1
+                        break
+                    falta = max(min(minimo, self.rafaga) - self._fichas[tipo], 0.05)
+                    self._cv.wait(falta / self._tasa[tipo])
+            finally:
+                self._esperando[tipo][prioridad] -= 1
+                self._cv.notify_all()
+            espera = time.monotonic() - inicio
+            st_ = self._stats[tipo]
+            st_["espera_total"] += espera
+            st_["espera_max"] = max(st_["espera_max"], espera)
+        return espera
+
+    def agotar(self, tipo: str):
+        """El servidor ha respondido 429: vaciar el cubo para frenar el ritmo."""
+        with self._cv:
+            self._rellenar(tipo, time.monotonic())
+            self._fichas[tipo] = min(self._fichas[tipo], 0.0)
+
+    def llamar(self, tipo: str, fn, *args, **kwargs):
+        """Ejecuta fn(*args, **kwargs) respetando el presupuesto de `tipo`."""
+        self.adquirir(tipo)
+        st_ = self._stats[tipo]
+        t0 = time.monotonic()
+        error = False
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            fin = time.monotonic()
+            with self._cv:
+                st_["llamadas"] += 1
+                st_["errores"] += error
+                st_["duracion_total"] += fin - t0
+                st_["recientes"].append(fin)
+
+    def estadisticas(self) -> dict:
+        """{tipo: {llamadas, errores, por_minuto, espera_media, espera_max, duracion_media}}."""
+        with self._cv:
+            return self._estadisticas(time.monotonic())
+
+    def _estadisticas(self, ahora: float) -> dict:
+        res = {}
+        for tipo, st_ in self._stats.items():
+            rec = st_["recientes"]
+            while rec and rec[0] < ahora - 60:
+                rec.popleft()
+            n = st_["llamadas"]
+            res[tipo] = {"llamadas": n, "errores": st_["errores"], "por_minuto": len(rec),
+                         "espera_media": st_["espera_total"] / n if n else 0.0,
+                         "espera_max": st_["espera_max"],
+                         "duracion_media": st_["duracion_total"] / n if n else 0.0}
+        return res
+
+def planificador_gsheets() -> PlanificadorGSheets:
+    """Planificador de la sesión actual (límites de st.secrets["GSHEETS_CUOTA"])."""
+    if "_gsheets_plan" not in st.session_state:
+        try:
+            secretos = dict(st.secrets.get("GSHEETS_CUOTA", {}))
+        except Exception:
+            secretos = {}
+        cuota, errores = _cuota_gsheets(secretos)
+        for err in errores:
+            st.session_state.setdefault("_sync_errors", []).append(f"⚠️ {err}")
+        st.session_state["_gsheets_plan"] = PlanificadorGSheets(
+            cuota["lecturas_min"], cuota["escrituras_min"], cuota["rafaga"])
+    return st.session_state["_gsheets_plan"]
+
+def _cuota_gsheets(secretos: dict) -> tuple:
+    """(cuota, errores): límites de GSHEETS_CUOTA sobre los de _GSHEETS_CUOTA. Los
+    valores no numéricos o no positivos se sustituyen por el de por defecto y se
+    describen en `errores`."""
+    cuota, errores = {}, []
+    for clave, defecto in _GSHEETS_CUOTA.items():
+        valor = secretos.get(clave, defecto)
+        try:
+            num = int(float(valor)) if clave == "rafaga" else float(valor)
+        except (TypeError, ValueError):
+            num = 0
+        if not num > 0:
+            errores.append(f"GSHEETS_CUOTA.{clave} = {valor!r} no es válido (debe ser un "
+                           f"número mayor que 0); se usa {defecto}.")
+            num = defecto
+        cuota[clave] = num
+    return cuota, errores
+
+
+# ── Cliente Google Sheets por sesión ─────────────────────────────────────────
+# Credenciales, cliente gspread (con su requests.Session y pool de conexiones) y
+# la hoja de cálculo abierta se crean una sola vez por sesión y se reutilizan en
+# connect_db_from_gsheets y en todas las sincronizaciones.
+_GSHEETS_TOKEN_URI = "https://oauth2.googleapis.com/token"
+_GSHEETS_CONEXIONES = 8   # tamaño del pool HTTP por sesión
+
+def _credenciales_google(token: dict):
+    """Credenciales OAuth a partir del token de la sesión. Si el token trae
+    refresh_token (access_type=offline) se renuevan solas al caducar."""
+    from google.oauth2.credentials import Credentials
+    cfg = {}
+    try:
+        cfg = st.secrets.get("GOOGLE_OAUTH", {})
+    except Exception:
+        pass
+    expiry = None
+    if token.get("obtenido") and token.get("expires_in"):
+        # google-auth trabaja con datetimes UTC sin zona; margen de un minuto
+        expiry = (datetime.datetime.fromtimestamp(float(token["obtenido"]), datetime.timezone.utc)
+                  + datetime.timedelta(seconds=int(token["expires_in"]) - 60)).replace(tzinfo=None)
+    return Credentials(
+        token=token.get("access_token"),
+        refresh_token=token.get("refresh_token"),
+        token_uri=_GSHEETS_TOKEN_URI,
+        client_id=cfg.get("client_id"),
+        client_secret=cfg.get("client_secret"),
+        scopes=["https://www.googleapis.com/auth/spreadsheets"],
+        expiry=expiry,
+    )
+
+class SesionGSheets:
+    """Hoja de cálculo abierta con su cliente, más una caché de los metadatos de
+    sus pestañas ({título: {"id", "filas", "cols"}}) para no pedirlos en cada
+    sincronización. `sh` es un gspread.Spreadsheet o un objeto con su interfaz."""
+
+    def __init__(self, sh, cliente=None, credenciales=None, clave=None, planificador=None):
+        self.sh = sh
+        self.cliente = cliente
+        self.credenciales = credenciales
+        self.clave = clave
+        self.planificador = planificador
+        self._hojas = None
+
+    def _llamar(self, tipo: str, fn, *args, **kwargs):
+        if self.planificador is None:
+            return fn(*args, **kwargs)
+        return self.planificador.llamar(tipo, fn, *args, **kwargs)
+
+    @property
+    def titulo(self) -> str:
+        return self.sh.title
+
+    def hojas(self) -> dict:
+        """Pestañas de la hoja de cálculo, en orden (una petición la primera vez)."""
+        if self._hojas is None:
+            meta = self._llamar("lectura", self.sh.fetch_sheet_metadata)
+            self._hojas = {}
+            for hoja in meta.get("sheets", []):
+                prop = hoja["properties"]
+                grid = prop.get("gridProperties", {})
+                self._hojas[prop["title"]] = {"id": prop["sheetId"],
+                                              "filas": grid.get("rowCount", 0),
+                                              "cols": grid.get("columnCount", 0)}
+        return self._hojas
+
+    def hoja(self, titulo: str, filas: int = 200, cols: int = 20) -> tuple:
+        """(metadatos, creada) de la pestaña `titulo`, creándola si no existe."""
+        hojas = self.hojas()
+        if titulo in hojas:
+            return hojas[titulo], False
+        ws = self._llamar("escritura", self.sh.add_worksheet,
+                          title=titulo, rows=filas, cols=cols)
+        hojas[titulo] = {"id": ws.id, "filas": ws.row_count, "cols": ws.col_count}
+        return hojas[titulo], True
+
+    def valores(self, titulo: str) -> list:
+        """Todas las celdas de una pestaña como lista de filas de strings."""
+        import gspread
+        rango = gspread.utils.absolute_range_name(titulo)
+        return self._llamar("lectura", self.sh.values_get, rango).get("values", [])
+
+    def valores_de(self, titulos: list, por_peticion: int = 50) -> dict:
+        """Celdas de varias pestañas con values.batchGet ({título: filas}); una
+        petición por cada `por_peticion` pestañas en vez de una por pestaña."""
+        import gspread
+        titulos = list(titulos)
+        res = {}
+        for i in range(0, len(titulos), por_peticion):
+            grupo = titulos[i:i + por_peticion]
+            rangos = [gspread.utils.absolute_range_name(t) for t in grupo]
+            resp = self._llamar("lectura", self.sh.values_batch_get, rangos)
+            for titulo, vr in zip(grupo, resp.get("valueRanges", [])):
+                res[titulo] = vr.get("values", [])
+        return res
+
+    def batch_update(self, body: dict) -> dict:
+        return self._llamar("escritura", self.sh.batch_update, body)
+
+    def olvidar_metadatos(self):
+        """Descarta la caché de pestañas (p. ej. tras un error o una recarga)."""
+        self._hojas = None
+
+def sesion_gsheets(token: dict = None, spreadsheet_id: str = None) -> SesionGSheets:
+    """SesionGSheets de la sesión actual, reutilizada mientras no cambien el
+    usuario ni la hoja de cálculo. Si las credenciales se han renovado, el
+    access_token nuevo se guarda en st.session_state["google_token"]."""
+    token = token if token is not None else st.session_state.get("google_token")
+    spreadsheet_id = spreadsheet_id or st.session_state.get("_gsheets_id")
+    clave = (token.get("refresh_token") or token.get("access_token"), spreadsheet_id)
+    ses = st.session_state.get("_gsheets_sesion")
+    if ses is None or ses.clave != clave:
+        import gspread
+        from requests.adapters import HTTPAdapter
+
+        creds = _credenciales_google(token)
+        gc = gspread.authorize(creds)
+        gc.http_client.session.mount(
+            "https://", HTTPAdapter(pool_connections=2, pool_maxsize=_GSHEETS_CONEXIONES))
+        plan = planificador_gsheets()
+        sh = plan.llamar("lectura", gc.open_by_key, spreadsheet_id)
+        ses = SesionGSheets(sh, gc, creds, clave, plan)
+        st.session_state["_gsheets_sesion"] = ses
+    nuevo = getattr(ses.credenciales, "token", None)
+    if nuevo and nuevo != token.get("access_token"):
+        token["access_token"] = nuevo
+        token["obtenido"] = datetime.datetime.now().timestamp()
+    return ses
+
+
+# ── Sincronización incremental con Google Sheets ─────────────────────────────
+# En lugar de ws.clear() + ws.update() con la hoja entera, se compara la hoja
+# actual con la última versión sincronizada (ColaSyncGSheets.snaps)
+# y se envía un único spreadsheet.batch_update con: borrado de filas
+# (deleteDimension), ampliación de la cuadrícula si hace falta (appendDimension)
+# y solo las celdas que cambian (updateCells). La SesionGSheets puede envolver
+# cualquier objeto con la interfaz de gspread.Spreadsheet, p. ej. un servidor
+# falso en memoria.
+
+def _grid_hoja(df: pd.DataFrame) -> list:
+    """Cabecera + filas como strings, tal y como se escriben en Google Sheets."""
+    return [[str(c) for c in df.columns]] + df.fillna("").astype(str).values.tolist()
+
+def _orden_por_id(anterior: list, actual: list, clave: str):
+    """Si ambas hojas tienen la columna clave con IDs únicos y las filas que siguen
+    existiendo conservan su orden, retorna (filas_borradas, n_supervivientes);
+    si no, None (se compara por posición)."""
+    if not anterior or not actual or clave not in anterior[0] or clave not in actual[0]:
+        return None
+    io_, in_ = anterior[0].index(clave), actual[0].index(clave)
+    ids_old = [r[io_] if io_ < len(r) else "" for r in anterior[1:]]
+    ids_new = [r[in_] if in_ < len(r) else "" for r in actual[1:]]
+    if len(set(ids_old)) != len(ids_old) or len(set(ids_new)) != len(ids_new):
+        return None
+    nuevos = set(ids_new)
+    borradas = [i + 1 for i, pid in enumerate(ids_old) if pid not in nuevos]
+    quedan   = [pid for pid in ids_old if pid in nuevos]
+    if ids_new[:len(quedan)] != quedan:
+        return None
+    return borradas, len(quedan)
+
+def _diff_grid(anterior: list, actual: list, clave: str = "ID_Pregunta") -> dict:
+    """Plan de cambios para pasar de la cuadrícula `anterior` a `actual`:
+    filas a borrar (índices de `anterior`) y celdas a escribir por fila
+    (índices ya sin las borradas): {"borrar": [...], "filas": {fila: (col, valores)}}."""
+    orden = _orden_por_id(anterior, actual, clave)
+    if orden is not None:
+        borradas, n_quedan = orden
+        borr = set(borradas)
+        base = [anterior[0]] + [r for i, r in enumerate(anterior[1:], start=1) if i not in borr]
+    else:
+        borradas = list(range(len(actual), len(anterior)))
+        base = anterior[:len(actual)]
+    ancho = max([len(r) for r in anterior[:1] + actual[:1]] or [0])
+    filas = {}
+    for i, fila in enumerate(actual):
+        vieja = base[i] if i < len(base) else []
+        a = list(fila) + [""] * (ancho - len(fila))
+        v = list(vieja) + [""] * (ancho - len(vieja))
+        dif = [j for j in range(ancho) if a[j] != v[j]]
+        if dif:
+            filas[i] = (dif[0], a[dif[0]:dif[-1] + 1])
+    return {"borrar": borradas, "filas": filas, "n_filas": len(actual), "ancho": ancho}
+
+def _celda_gsheets(valor: str) -> dict:
+    return {"userEnteredValue": {"stringValue": valor}} if valor != "" else {}
+
+def _peticiones_sync(plan: dict, sheet_id: int, n_filas_hoja: int, n_cols_hoja: int) -> list:
+    """Traduce un plan de _diff_grid a peticiones de spreadsheets.batchUpdate."""
+    reqs = []
+    # Borrados de abajo arriba, agrupando filas contiguas
+    tramos = []
+    for i in sorted(plan["borrar"], reverse=True):
+        if tramos and tramos[-1][0] == i + 1:
+            tramos[-1][0] = i
+        else:
+            tramos.append([i, i + 1])
+    for ini, fin in tramos:
+        reqs.append({"deleteDimension": {"range": {
+            "sheetId": sheet_id, "dimension": "ROWS", "startIndex": ini, "endIndex": fin}}})
+    filas_tras_borrar = n_filas_hoja - len(plan["borrar"])
+    if plan["n_filas"] > filas_tras_borrar:
+        reqs.append({"appendDimension": {"sheetId": sheet_id, "dimension": "ROWS",
+                                         "length": plan["n_filas"] - filas_tras_borrar}})
+    if plan["ancho"] > n_cols_hoja:
+        reqs.append({"appendDimension": {"sheetId": sheet_id, "dimension": "COLUMNS",
+                                         "length": plan["ancho"] - n_cols_hoja}})
+    for fila, (col, valores) in sorted(plan["filas"].items()):
+        reqs.append({"updateCells": {
+            "range": {"sheetId": sheet_id, "startRowIndex": fila, "endRowIndex": fila + 1,
+                      "startColumnIndex": col, "endColumnIndex": col + len(valores)},
+            "rows": [{"values": [_celda_gsheets(v) for v in valores]}],
+            "fields": "userEnteredValue",
+        }})
+    return reqs
+
+def sincronizar_hoja_delta(ses: SesionGSheets, titulo: str, df, anterior=None) -> tuple:
+    """Lleva la pestaña `titulo` al contenido de df (DataFrame o cuadrícula de
+    _grid_hoja) con un único batch_update.
+    `anterior` es la cuadrícula sincronizada la última vez (si es None se lee de
+    la hoja). Retorna (cuadrícula_nueva, estadísticas)."""
+    actual = df if isinstance(df, list) else _grid_hoja(df)
+    meta, creada = ses.hoja(titulo, filas=max(200, len(actual) + 20),
+                            cols=max(20, len(actual[0]) if actual else 0))
+    if creada:
+        anterior = []
+    elif anterior is None:
+        anterior = ses.valores(titulo)
+    plan = _diff_grid(anterior, actual)
+    stats = {"borradas": len(plan["borrar"]), "filas_escritas": len(plan["filas"]),
+             "celdas": sum(len(v) for _, v in plan["filas"].values()), "peticiones": 0}
+    reqs = _peticiones_sync(plan, meta["id"], meta["filas"], meta["cols"])
+    if reqs:
+        ses.batch_update({"requests": reqs})
+        stats["peticiones"] = 1
+        meta["filas"] = max(meta["filas"] - len(plan["borrar"]), plan["n_filas"])
+        meta["cols"]  = max(meta["cols"], plan["ancho"])
+    return actual, stats
+
+# ── Cola de sincronización en segundo plano ──────────────────────────────────
+# Las páginas solo marcan "hoja X modificada": la cuadrícula se congela en ese
+# momento y un hilo por sesión la envía a Google Sheets tras una breve ventana
+# en la que las ediciones repetidas de la misma hoja se funden en un solo envío.
+# El hilo no toca st.session_state: recibe la SesionGSheets y las cuadrículas.
+_HTTP_REINTENTABLES = {429, 500, 502, 503, 504}
+
+def _error_reintentable(e: Exception) -> tuple:
+    """(reintentable, seguro_que_no_se_aplicó). Solo un 429 garantiza que el
+    batch_update no llegó a aplicarse; tras un 5xx o un corte de red se relee
+    la hoja antes de volver a calcular las diferencias."""
+    import gspread
+    import requests
+    if isinstance(e, gspread.exceptions.APIError):
+        codigo = getattr(getattr(e, "response", None), "status_code", None)
+        return codigo in _HTTP_REINTENTABLES, codigo == 429
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True, False
+    return False, False
+
+class ColaSyncGSheets:
+    """Hilo de fondo que sincroniza hojas con Google Sheets. Guarda la última
+    cuadrícula enviada de cada hoja (base de los envíos incrementales), funde las
+    ediciones que llegan dentro de `ventana` segundos y reintenta con espera
+    exponencial los errores de cuota o de red."""
+
+    def __init__(self, ventana: float = 1.5, reintentos: int = 6,
+                 espera_base: float = 1.0, espera_max: float = 60.0):
+        self.ventana = ventana
+        self.reintentos = reintentos
+        self.espera_base = espera_base
+        self.espera_max = espera_max
+        self.ses = None
+        self.snaps = {}          # {hoja: cuadrícula sincronizada}
+        self.enviadas = 0
+        self._cv = threading.Condition()
+        self._pendientes = {}    # {hoja: (cuadrícula, instante a partir del cual enviar)}
+        self._fallidas = {}      # {hoja: (cuadrícula, mensaje)}
+        self._en_curso = None
+        self._hilo = None
+        self._generacion = 0     # sube en cada reiniciar(): invalida envíos anteriores
+
+    # ── API para el hilo de Streamlit ──
+    def reiniciar(self, ses, snaps: dict, descartar: bool = False, timeout: float = 30.0):
+        """Nueva conexión: parte de las cuadrículas leídas.
+
+        Espera a que termine el envío en curso. Si aun así queda uno en curso, o
+        hay hojas pendientes o fallidas, lanza RuntimeError sin tocar nada (las
+        fallidas siguen disponibles para reintentar_fallidas) salvo que
+        descartar=True. Un envío que acabe después no escribe en los snaps nuevos.
+        """
+        limite = time.monotonic() + timeout
+        with self._cv:
+            while self._en_curso and not descartar:
+                resto = limite - time.monotonic()
+                if resto <= 0:
+                    break
+                self._cv.wait(resto)
+            sin_enviar = sorted(set(self._pendientes) | set(self._fallidas)
+                                | ({self._en_curso} if self._en_curso else set()))
+            if sin_enviar and not descartar:
+                raise RuntimeError("cambios sin sincronizar con Google Sheets en: "
+                                   + ", ".join(sin_enviar))
+            self._generacion += 1
+            self.ses = ses
+            self.snaps = snaps
+            self._pendientes.clear()
+            self._fallidas.clear()
+
+    def encolar(self, ses, hoja: str, grid: list):
+        with self._cv:
+            self.ses = ses
+            self._pendientes[hoja] = (grid, time.monotonic() + self.ventana)
+            self._fallidas.pop(hoja, None)
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, daemon=True,
+                                              name="sync-gsheets")
+                self._hilo.start()
+            self._cv.notify_all()
+
+    def reintentar_fallidas(self):
+        with self._cv:
+            fallidas, self._fallidas = self._fallidas, {}
+        for hoja, (grid, _) in fallidas.items():
+            self.encolar(self.ses, hoja, grid)
+
+    def estado(self) -> dict:
+        with self._cv:
+            pendientes = sorted(self._pendientes)
+            if self._en_curso and self._en_curso not in pendientes:
+                pendientes.insert(0, self._en_curso)
+            return {"pendientes": pendientes,
+                    "fallidas": {h: m for h, (_, m) in self._fallidas.items()},
+                    "enviadas": self.enviadas}
+
+    def vaciar(self, timeout: float = 30.0) -> bool:
+        """Envía ya lo pendiente (sin esperar la ventana) y espera a que termine."""
+        limite = time.monotonic() + timeout
+        with self._cv:
+            self._pendientes = {h: (g, 0.0) for h, (g, _) in self._pendientes.items()}
+            self._cv.notify_all()
+            while self._pendientes or self._en_curso:
+                resto = limite - time.monotonic()
+                if resto <= 0:
+                    return False
+                self._cv.wait(resto)
+        return True
+
+    # ── Hilo de fondo ──
+    def _bucle(self):
+        _prioridad_hilo.valor = PRIORIDAD_FONDO
+        while True:
+            with self._cv:
+                if not self._pendientes:
+                    # El hilo termina cuando no queda trabajo; encolar() lo relanza
+                    self._hilo = None
+                    return
+                hoja, (grid, listo) = min(self._pendientes.items(), key=lambda kv: kv[1][1])
+                espera = listo - time.monotonic()
+                if espera > 0:
+                    self._cv.wait(espera)
+                    continue
+                del self._pendientes[hoja]
+                self._en_curso = hoja
+                ses, anterior, gen = self.ses, self.snaps.get(hoja), self._generacion
+            try:
+                grid = self._enviar(ses, hoja, grid, anterior)
+                with self._cv:
+                    if gen == self._generacion:
+                        self.snaps[hoja] = grid
+                        self.enviadas += 1
+            except Exception as e:
+                with self._cv:
+                    if gen == self._generacion:
+                        self.snaps.pop(hoja, None)
+                        if hoja not in self._pendientes:
+                            self._fallidas[hoja] = (grid, str(e))
+                if ses is not None:
+                    ses.olvidar_metadatos()
+            finally:
+                with self._cv:
+                    self._en_curso = None
+                    self._cv.notify_all()
+
+    def _enviar(self, ses, hoja: str, grid: list, anterior) -> list:
+        """Un envío con reintentos. Si durante la espera llega una versión más
+        nueva de la hoja, se envía esa. Retorna la cuadrícula enviada."""
+        for intento in range(self.reintentos + 1):
+            try:
+                sincronizar_hoja_delta(ses, hoja, grid, anterior)
+                return grid
+            except Exception as e:
+                reintentable, no_aplicado = _error_reintentable(e)
+                if not reintentable or intento == self.reintentos:
+                    raise
+                if no_aplicado and ses.planificador is not None:
+                    ses.planificador.agotar("escritura")
+                if not no_aplicado:
+                    anterior = None
+                    ses.olvidar_metadatos()
+                espera = min(self.espera_max, self.espera_base * 2 ** intento)
+                time.sleep(espera * random.uniform(0.5, 1.0))
+                with self._cv:
+                    if hoja in self._pendientes:
+                        grid = self._pendientes.pop(hoja)[0]
+        return grid
+
+def cola_sync_gsheets() -> ColaSyncGSheets:
+    """Cola de sincronización de la sesión actual."""
+    if "_gsheets_cola" not in st.session_state:
+        st.session_state["_gsheets_cola"] = ColaSyncGSheets()
+    return st.session_state["_gsheets_cola"]
 
 def sync_hoja_gsheets(bloque: str) -> bool:
-    """Reescribe la hoja del bloque en Google Sheets con el contenido actual de excel_dfs.
-    No-op si no hay conexión GSheets activa. Muestra warning si falla."""
+    """Marca la hoja del bloque para sincronizarla con Google Sheets en segundo
+    plano (solo se envían las diferencias con la última versión sincronizada).
+    No-op si no hay conexión GSheets activa. El estado se ve en el sidebar."""
     spreadsheet_id = st.session_state.get("_gsheets_id")
     token          = st.session_state.get("google_token")
     if not spreadsheet_id or not token:
@@ -526,26 +1215,8 @@ def sync_hoja_gsheets(bloque: str) -> bool:
         return False
 
     try:
-        import gspread
-        from google.oauth2.credentials import Credentials
-
-        creds = Credentials(
-            token=token.get("access_token"),
-            scopes=["https://www.googleapis.com/auth/spreadsheets"],
-        )
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(spreadsheet_id)
-
-        try:
-            ws = sh.worksheet(bloque)
-        except gspread.exceptions.WorksheetNotFound:
-            ws = sh.add_worksheet(title=bloque, rows=max(200, len(df_sheet) + 20), cols=20)
-
-        ws.clear()
-        if len(df_sheet.columns) > 0:
-            headers = list(df_sheet.columns)
-            rows    = df_sheet.fillna("").astype(str).values.tolist()
-            ws.update([headers] + rows)
+        ses = sesion_gsheets(token, spreadsheet_id)
+        cola_sync_gsheets().encolar(ses, bloque, _grid_hoja(df_sheet))
         return True
 
     except Exception as e:
@@ -558,12 +1229,56 @@ def sync_hoja_gsheets(bloque: str) -> bool:
 
 
 def sync_bloques_gsheets(bloques: list) -> None:
-    """Sincroniza varios bloques a la vez. Muestra spinner mientras escribe."""
+    """Marca varios bloques para sincronizar en segundo plano."""
     if not st.session_state.get("_gsheets_id"):
         return
-    with st.spinner("Guardando en Google Sheets…"):
-        for blq in bloques:
-            sync_hoja_gsheets(blq)
+    for blq in bloques:
+        sync_hoja_gsheets(blq)
+
+
+def _render_estado_sync():
+    """Estado de la cola de sincronización y del ritmo de peticiones; se refresca
+    solo mientras hay envíos pendientes."""
+    cola = st.session_state.get("_gsheets_cola")
+    plan = st.session_state.get("_gsheets_plan")
+    if plan is not None:
+        est_p = plan.estadisticas()
+        lec, esc = est_p["lectura"], est_p["escritura"]
+        st.caption(f"📡 Sheets (último min): {lec['por_minuto']} lect · {esc['por_minuto']} escr"
+                   f" · espera media {max(lec['espera_media'], esc['espera_media']):.1f} s")
+    if cola is None:
+        return
+    est = cola.estado()
+    if est["pendientes"]:
+        st.caption(f"⏳ Guardando en Google Sheets: {', '.join(est['pendientes'])}")
+    for hoja, msg in est["fallidas"].items():
+        st.warning(f"⚠️ No se pudo sincronizar '{hoja}' con Google Sheets: {msg}. "
+                   "Descarga el Excel desde el sidebar para no perder los cambios.")
+    if est["fallidas"] and st.button("🔁 Reintentar", key="btn_retry_sync",
+                                     use_container_width=True):
+        cola.reintentar_fallidas()
+        st.rerun()
+
+
+def _render_confirmar_recarga():
+    """Recarga de Google Sheets rechazada por cambios sin sincronizar: los muestra
+    y deja recargar descartándolos de forma explícita."""
+    conf = st.session_state.get("_gsheets_confirmar")
+    if not conf or not st.session_state.get("google_token"):
+        return
+    st.warning(f"⚠️ {conf['msg']}")
+    cc1, cc2 = st.columns(2)
+    if cc1.button("🗑️ Descartar y recargar", key="btn_reload_discard", use_container_width=True):
+        with st.spinner("Conectando…"):
+            ok, msg = connect_db_from_gsheets(st.session_state["google_token"], conf["url"],
+                                              descartar_cambios=True)
+        st.session_state.pop("_gsheets_confirmar", None)
+        if not ok:
+            st.session_state.setdefault("_sync_errors", []).append(msg)
+        st.rerun()
+    if cc2.button("Cancelar", key="btn_reload_keep", use_container_width=True):
+        st.session_state.pop("_gsheets_confirmar", None)
+        st.rerun()
 
 
 # ── Google OAuth helpers (flujo manual, sin popup) ────────────────────────────
@@ -637,6 +1352,7 @@ def handle_oauth_callback():
         code = params["code"]
         with st.spinner("Completando autenticación con Google…"):
             token    = _exchange_code(code, cfg)
+            token["obtenido"] = datetime.datetime.now().timestamp()
             userinfo = _google_userinfo(token.get("access_token", ""))
         st.session_state["google_token"]      = token
         st.session_state["google_user_email"] = userinfo.get("email", "")
@@ -685,13 +1401,14 @@ def _render_gsheets_oauth():
                 ok, msg = connect_db_from_gsheets(
                     st.session_state["google_token"], gs_url
                 )
-            if ok:
+            if ok or "_gsheets_confirmar" in st.session_state:
                 st.rerun()
             else:
                 st.error(msg)
 
         if gc2.button("🚪 Salir", key="btn_logout_google", use_container_width=True):
-            for k in ("google_token", "google_user_email", "_gsheets_url", "_gsheets_title"):
+            for k in ("google_token", "google_user_email", "_gsheets_url", "_gsheets_title",
+                      "_gsheets_sesion"):
                 st.session_state.pop(k, None)
             st.rerun()
 
@@ -727,6 +1444,12 @@ def render_sidebar():
 
         # ── Google Sheets OAuth (si está configurado) ─────────────────────────
         _render_gsheets_oauth()
+        _cola = st.session_state.get("_gsheets_cola")
+        if _cola is not None or "_gsheets_plan" in st.session_state:
+            # Mientras haya envíos en curso el fragmento se refresca solo
+            _cada = 2 if _cola is not None and _cola.estado()["pendientes"] else None
+            st.fragment(run_every=_cada)(_render_estado_sync)()
+        _render_confirmar_recarga()
 
         st.markdown("**📚 Base de Datos Excel**")
 
@@ -751,11 +1474,11 @@ def render_sidebar():
         # ── Ruta local directa (solo útil en local, oculta en Cloud) ─────────
         with st.expander("📂 Ruta local directa", expanded=False):
             path_m = st.text_input(
-                "Ruta al .xlsx",
+                "Ruta al .xlsx o .db",
                 value=st.session_state.excel_path,
                 key="sidebar_path_manual",
                 label_visibility="collapsed",
-                placeholder="C:/ruta/archivo.xlsx",
+                placeholder="C:/ruta/archivo.xlsx (o .db)",
             )
             if st.button("🔌 Conectar", key="btn_conectar_manual",
                          use_container_width=True):
@@ -765,6 +1488,32 @@ def render_sidebar():
                 else:
                     st.error(msg)
 
+            # ── Conversión Excel ↔ SQLite ─────────────────────────────────────
+            _cur_path = st.session_state.excel_path
+            if _cur_path and os.path.isfile(_cur_path):
+                if lib.es_ruta_sqlite(_cur_path):
+                    if st.button("📤 Exportar a .xlsx", key="btn_sqlite_export",
+                                 use_container_width=True,
+                                 help="Escribe un .xlsx junto a la base SQLite"):
+                        try:
+                            out = lib.exportar_sqlite_a_excel(_cur_path)
+                            st.success(f"Exportado: {os.path.basename(out)}")
+                        except Exception as e:
+                            st.error(f"Error al exportar: {e}")
+                elif st.button("🗃️ Convertir a SQLite", key="btn_sqlite_convert",
+                               use_container_width=True,
+                               help="Crea una base .db junto al Excel y trabaja sobre ella: "
+                                    "cada edición actualiza solo la fila afectada"):
+                    try:
+                        db_path = lib.convertir_excel_a_sqlite(_cur_path)
+                        ok, msg = connect_db(db_path)
+                        if ok:
+                            st.rerun()
+                        else:
+                            st.error(msg)
+                    except Exception as e:
+                        st.error(f"Error al convertir: {e}")
+
         # ── Datos de la asignatura (cfg_general) ─────────────────────────────
         _cg = st.session_state.get("cfg_general", {})
         _asig_sb = _cg.get("asignatura", "") or ""
@@ -793,6 +1542,8 @@ def render_sidebar():
             fname = (st.session_state.get("_upload_name")
                      or os.path.basename(st.session_state.excel_path)
                      or "base_datos.xlsx")
+            dl_name = (os.path.splitext(fname)[0] + ".xlsx"
+                       if lib.es_ruta_sqlite(fname) else fname)
             df = st.session_state.df_preguntas
             st.markdown(
                 f'<span class="conn-ok">✅ Conectado</span> '
@@ -809,27 +1560,42 @@ def render_sidebar():
                 _gid   = st.session_state.get("_gsheets_id")
                 _token = st.session_state.get("google_token")
                 if _gid and _token:
-                    connect_db_from_gsheets(_token,
+                    ok, msg = connect_db_from_gsheets(_token,
                         f"https://docs.google.com/spreadsheets/d/{_gid}")
+                    if not ok and "_gsheets_confirmar" not in st.session_state:
+                        st.session_state.setdefault("_sync_errors", []).append(msg)
                 else:
+                    ok = True
                     reload_db()
-                st.session_state["_reload_toast"] = True
+                st.session_state["_reload_toast"] = ok
                 st.rerun()
             if st.session_state.pop("_reload_toast", False):
                 n = len(st.session_state.df_preguntas)
                 st.toast(f"✅ Base de datos recargada · {n} preguntas", icon="✅")
 
             # ── Descarga del Excel actualizado ────────────────────────────────
-            excel_bytes = st.session_state.get("excel_bytes", b"")
-            if excel_bytes:
+            # Generar el .xlsx lee todas las hojas: solo se hace al pulsar
+            # "Preparar", y los bytes se memorizan mientras no cambie db_version
+            _ver_dl  = st.session_state.get("db_version", 0)
+            _memo_dl = st.session_state.setdefault("_excel_bytes_memo", {})
+            if _memo_dl.get("version") != _ver_dl:
+                _memo_dl.clear()
+            if st.session_state.excel_dfs and _memo_dl:
                 col_d.download_button(
                     "⬇️ Descargar",
-                    data=excel_bytes,
-                    file_name=fname,
+                    data=_memo_dl["data"],
+                    file_name=dl_name,
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     use_container_width=True,
                     key="btn_download_excel",
                 )
+            elif st.session_state.excel_dfs and col_d.button(
+                    "📦 Preparar", use_container_width=True, key="btn_prepare_excel",
+                    help="Genera el Excel con los cambios actuales para descargarlo"):
+                with st.spinner("Generando Excel…"):
+                    _memo_dl.update(version=_ver_dl,
+                                    data=lib.generar_excel_bytes(st.session_state.excel_dfs))
+                st.rerun()
         else:
             st.markdown('<span class="conn-wait">⏳ Sin conexión</span>',
                         unsafe_allow_html=True)
@@ -1131,24 +1897,31 @@ def _dialog_editar_pregunta(pid: str, row: dict):
         st.rerun()
 
 
-def marcar_preguntas_usadas(pids: list, fecha_str: str) -> int:
-    """Marca una lista de IDs de pregunta como usadas con la fecha dada.
+def marcar_preguntas_usadas(pids: list, fecha_str: str, examen: str = "") -> int:
+    """Marca una lista de IDs de pregunta como usadas con la fecha dada y anota
+    cada uso en el historial (Historial_Uso), que guarda todos los usos y no solo
+    el último. Todas las marcas se aplican en una transacción: una copia de
+    seguridad y un guardado.
     Devuelve el número de preguntas actualizadas correctamente."""
     count = 0
-    for pid in pids:
-        ok, _ = lib.actualizar_pregunta_excel_local(
-            st.session_state.excel_path,
-            st.session_state.excel_dfs,
-            pid,
-            {"usada": fecha_str}
-        )
-        if ok:
-            count += 1
+    try:
+        with lib.transaccion(st.session_state.excel_path,
+                             st.session_state.excel_dfs) as tx:
+            marcadas = []
+            for pid in pids:
+                ok, _ = tx.actualizar(pid, {"usada": fecha_str})
+                if ok:
+                    marcadas.append(pid)
+            tx.registrar_uso(marcadas, fecha_str, examen)
+            count = len(marcadas)
+    except Exception as e:
+        st.error(f"❌ No se pudieron marcar las preguntas como usadas: {e}")
+        return 0
     if count:
         # Sincronizar bloques afectados
         df_p = st.session_state.get("df_preguntas")
         if df_p is not None:
             bloques = df_p[df_p["ID_Pregunta"].isin(pids)]["bloque"].unique().tolist()
-            sync_bloques_gsheets(bloques)
+            sync_bloques_gsheets(bloques + [lib.HISTORIAL_USO_SHEET])
         reload_db()
     return count
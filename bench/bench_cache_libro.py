@@ -0,0 +1,84 @@
+"""Benchmark de la conexión a un .xlsx con y sin la caché en disco (lib.CacheLibro).
+
+Escribe a .xlsx el libro sintético de bench_procesar_excel (tipos mezclados en
+Tema y Usada, filas sin ID, hojas vacías) con sus hojas de configuración y mide lo que hace connect_db:
+
+  en frío:   openpyxl + procesar_excel_dfs, y escritura de la caché
+  templada:  CacheLibro + leer_hojas (perezoso) + procesar_excel_dfs con los
+             derivados cacheados + init_cfg_from_data
+  y, aparte, leer de la caché todas las hojas (lo que cuesta materializarlas).
+
+Comprueba que las preguntas procesadas desde la caché son idénticas a las de
+una lectura en frío.
+
+Uso:  python bench/bench_cache_libro.py [n_preguntas] [repeticiones]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas as pd
+
+import examen_lib_latex as lib
+from app_utils import procesar_excel_dfs
+from bench_procesar_excel import libro_sintetico
+
+
+def en_frio(path):
+    lib.cache_invalidar(path)
+    cache = lib.CacheLibro(path)
+    dfs = lib.cargar_excel_local(path)
+    cache.escribir_hojas(dfs)
+    df = procesar_excel_dfs(dfs, cache=cache)
+    return lib.init_cfg_from_data(dfs, df["Tema"]), df
+
+
+def templada(path):
+    cache = lib.CacheLibro(path)
+    dfs = cache.leer_hojas()
+    df = procesar_excel_dfs(dfs, cache=cache)
+    return lib.init_cfg_from_data(dfs, df["Tema"]), df
+
+
+def todas_las_hojas(path):
+    dfs = lib.CacheLibro(path).leer_hojas()
+    return {n: df for n, df in dfs.items()}
+
+
+def mejor_de(fn, path, reps):
+    tiempos = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        res = fn(path)
+        tiempos.append(time.perf_counter() - t0)
+    return min(tiempos), res
+
+
+def main():
+    n    = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    reps = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "banco.xlsx")
+        # Con sus hojas de configuración, como queda un banco tras el primer guardado
+        lib._escribir_xlsx(path, lib.init_cfg_from_data(libro_sintetico(n)))
+        t_frio, (_, df_frio) = mejor_de(en_frio, path, 1)
+        t_tmp, (dfs, df_tmp) = mejor_de(templada, path, reps)
+        t_todas, _ = mejor_de(todas_las_hojas, path, reps)
+        pd.testing.assert_frame_equal(df_frio, df_tmp)
+        leidas = len(dfs.hojas_leidas()) if isinstance(dfs, lib.LibroHojas) else len(dfs)
+        tam = sum(os.path.getsize(os.path.join(r, f))
+                  for r, _, fs in os.walk(os.path.join(tmp, "_cache")) for f in fs)
+
+    print(f"{n} preguntas · caché en disco {tam / 1e6:.1f} MB · preguntas idénticas a la lectura en frío")
+    print(f"  en frío (openpyxl + procesar + escribir caché): {t_frio * 1000:8.0f} ms")
+    print(f"  templada (connect_db con caché válida):         {t_tmp * 1000:8.0f} ms"
+          f"   ({leidas} hojas leídas de {len(dfs)})")
+    print(f"  leer todas las hojas de la caché:               {t_todas * 1000:8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
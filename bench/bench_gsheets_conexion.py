@@ -0,0 +1,150 @@
+"""Benchmark de la lectura de Google Sheets al conectar, contra un servidor local.
+
+Levanta en 127.0.0.1 un sustituto HTTP de la API de Sheets v4 (metadatos,
+values.get y values.batchGet) que añade una latencia fija a cada petición, y
+apunta a él el cliente real de gspread. Compara:
+
+  antes: sh.worksheets() + ws.get_all_records() por pestaña (una petición por hoja)
+  ahora: SesionGSheets.valores_de(), como connect_db_from_gsheets (un values.batchGet)
+
+y comprueba que ambos construyen los mismos DataFrames.
+
+Uso:  python bench/bench_gsheets_conexion.py [latencia_ms] [n_bloques] [filas]
+"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gspread
+import gspread.http_client
+import pandas as pd
+from google.auth.credentials import AnonymousCredentials
+
+import app_utils as au
+
+ID_HOJA = "banco-bench"
+
+
+# ── Servidor sustituto ───────────────────────────────────────────────────────
+def _titulo(rango: str) -> str:
+    return rango.split("!")[0].strip("'").replace("''", "'")
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    hojas, latencia, peticiones = {}, 0.0, []
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        time.sleep(self.latencia)
+        url = urlparse(self.path)
+        ruta = unquote(url.path)
+        base = f"/v4/spreadsheets/{ID_HOJA}"
+        self.peticiones.append(ruta)
+        if ruta == base:
+            return self._json({"spreadsheetId": ID_HOJA, "properties": {"title": "Banco (bench)"},
+                               "sheets": [{"properties": {
+                                   "sheetId": i, "title": t, "index": i, "sheetType": "GRID",
+                                   "gridProperties": {"rowCount": len(v) + 50, "columnCount": 26}}}
+                                   for i, (t, v) in enumerate(self.hojas.items())]})
+        if ruta == base + "/values:batchGet":
+            rangos = parse_qs(url.query).get("ranges", [])
+            return self._json({"spreadsheetId": ID_HOJA, "valueRanges": [
+                {"range": r, "majorDimension": "ROWS", "values": self.hojas[_titulo(r)]}
+                for r in rangos]})
+        if ruta.startswith(base + "/values/"):
+            rango = ruta[len(base + "/values/"):]
+            return self._json({"range": rango, "majorDimension": "ROWS",
+                               "values": self.hojas[_titulo(rango)]})
+        self.send_error(404)
+
+
+def levantar_servidor(hojas: dict, latencia: float):
+    _Manejador.hojas, _Manejador.latencia, _Manejador.peticiones = hojas, latencia, []
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Manejador)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    # El cliente de gspread construye las URL con constantes de módulo: redirigirlas
+    base_local = f"http://127.0.0.1:{srv.server_address[1]}"
+    for nombre in dir(gspread.http_client):
+        valor = getattr(gspread.http_client, nombre)
+        if isinstance(valor, str) and valor.startswith("https://sheets.googleapis.com"):
+            setattr(gspread.http_client, nombre, valor.replace("https://sheets.googleapis.com", base_local))
+    return srv
+
+
+def hojas_sinteticas(n_bloques=22, filas=250):
+    hojas = {}
+    for b in range(n_bloques):
+        cab = ["ID_Pregunta", "Tema", "Enunciado", "Opción A", "Opción B", "Opción C",
+               "Opción D", "Correcta", "Dificultad", "Usada", "Notas"]
+        hojas[f"Bloque {b + 1}"] = [cab] + [
+            [f"B{b + 1}-{i:04d}", str(i % 9 + 1), f"Enunciado {i}", "a", "b", "c", "d",
+             "ABCD"[i % 4], "Media"] + (["2024-01-20"] if i % 3 == 0 else [])   # filas cortas
+            for i in range(filas)]
+    hojas["Config_Bloques"] = [["Bloque", "Descripcion"]] + [[f"Bloque {b + 1}", ""] for b in range(n_bloques)]
+    hojas["Config_Temas"] = [["Tema", "Nombre", "Bloque"]] + [[str(t), f"T{t}", ""] for t in range(1, 10)]
+    return hojas
+
+
+# ── Caminos a comparar ───────────────────────────────────────────────────────
+def antes(sh):
+    dfs = {}
+    for ws in sh.worksheets():
+        records = ws.get_all_records(numericise_ignore=["all"])
+        dfs[ws.title] = pd.DataFrame(records) if records else pd.DataFrame()
+    return dfs
+
+
+def ahora(sh, planificador=None):
+    ses = au.SesionGSheets(sh, planificador=planificador)
+    return {t: au._df_desde_valores(v) for t, v in ses.valores_de(ses.hojas()).items()}
+
+
+def medir(fn, *args):
+    n = len(_Manejador.peticiones)
+    t0 = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - t0, len(_Manejador.peticiones) - n
+
+
+def main():
+    latencia = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.08
+    n_bloques = int(sys.argv[2]) if len(sys.argv) > 2 else 22
+    filas = int(sys.argv[3]) if len(sys.argv) > 3 else 250
+    srv = levantar_servidor(hojas_sinteticas(n_bloques, filas), latencia)
+    try:
+        sh = gspread.Client(auth=AnonymousCredentials()).open_by_key(ID_HOJA)
+        viejo, t_old, p_old = medir(antes, sh)
+        nuevo, t_new, p_new = medir(ahora, sh)
+        plan, t_plan, p_plan = medir(ahora, sh, au.PlanificadorGSheets())
+    finally:
+        srv.shutdown()
+
+    assert list(viejo) == list(nuevo) == list(plan)
+    for t in viejo:
+        pd.testing.assert_frame_equal(viejo[t], nuevo[t])
+        pd.testing.assert_frame_equal(viejo[t], plan[t])
+    print(f"{len(viejo)} pestañas ({n_bloques} bloques x {filas} filas), "
+          f"latencia {latencia * 1000:.0f} ms/petición. DataFrames idénticos.")
+    print(f"  get_all_records por pestaña (antes): {t_old:6.2f} s  {p_old:3d} peticiones")
+    print(f"  values.batchGet (ahora):             {t_new:6.2f} s  {p_new:3d} peticiones")
+    print(f"  values.batchGet + planificador:      {t_plan:6.2f} s  {p_plan:3d} peticiones")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Benchmark de app_utils.procesar_excel_dfs frente al bucle por filas anterior.
+
+Genera un libro sintético (por defecto 50k preguntas en 10 hojas de bloque con
+casos límite: filas sin ID, temas "7.0"/None, respuestas inválidas, fechas
+mezcladas), lo pasa por .xlsx como hace la app, comprueba que ambas versiones
+producen exactamente el mismo DataFrame y mide el mejor de N tiempos.
+
+Uso:  python bench/bench_procesar_excel.py [n_preguntas] [repeticiones]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+import examen_lib_latex as lib
+from app_utils import _normalizar_fecha, procesar_excel_dfs
+
+
+# ── Implementación anterior ──────────────────────────────────────────────────
+def procesar_excel_dfs_filas(dfs: dict) -> pd.DataFrame:
+    """
+    Versión anterior (iterrows), copiada tal cual como referencia.
+    Dado el dict {nombre_hoja: DataFrame} que devuelve cargar_excel_local,
+    construye un DataFrame unificado con las columnas estándar:
+      ID_Pregunta, bloque, Tema, enunciado, opciones_list, letra_correcta,
+      dificultad, usada, notas
+    """
+    rows = []
+    for b_name, df_sheet in dfs.items():
+        if b_name in lib.CFG_SHEETS:
+            continue
+        if df_sheet.empty:
+            continue
+        head = [str(h).lower().strip() for h in df_sheet.columns]
+
+        # Detectar índices de columnas clave
+        idx_id   = next((i for i, h in enumerate(head) if "id_preg" in h or h == "id"), -1)
+        idx_enun = next((i for i, h in enumerate(head) if "enunciado" in h), -1)
+        idx_tem  = next((i for i, h in enumerate(head) if "tema" in h and "id" not in h), -1)
+        idx_dif  = next((i for i, h in enumerate(head) if "dificultad" in h), -1)
+        idx_nota = next((i for i, h in enumerate(head) if "nota" in h and "soluci" not in h), -1)
+        idx_sol  = next((i for i, h in enumerate(head) if "soluci" in h), -1)
+        idx_datos = next((i for i, h in enumerate(head) if h == "datos" or h == "datos_ids"), -1)
+        idx_com   = next((i for i, h in enumerate(head) if "comentar" in h), -1)
+        idx_obj   = next((i for i, h in enumerate(head) if h == "objetivo"), -1)
+
+        # Opciones: 4 columnas justo después del enunciado
+        idx_opA  = idx_enun + 1 if idx_enun != -1 else -1
+
+        # Columna correcta: típicamente enunciado + 5
+        idx_corr_offset = 5  # enun, A, B, C, D, Correcta
+
+        # Columna "usada"
+        idx_usada = next((i for i, h in enumerate(head) if "usada" in h or "fecha" in h), -1)
+
+        for _, row_s in df_sheet.iterrows():
+            r = row_s.tolist()
+
+            if idx_id == -1 or idx_enun == -1 or idx_opA == -1:
+                continue
+
+            # Ignorar filas sin ID
+            id_val = str(r[idx_id]).strip()
+            if not id_val or id_val.lower() in ("nan", "none", "id_pregunta"):
+                continue
+
+            # Tema
+            tem_raw = str(r[idx_tem]).strip() if idx_tem != -1 else "1"
+            if tem_raw.endswith(".0"):
+                tem_raw = tem_raw[:-2]
+            if tem_raw in ("nan", "None", ""):
+                tem_raw = "1"
+
+            # Opciones (4 columnas)
+            ops = []
+            for j in range(4):
+                oi = idx_opA + j
+                ops.append(str(r[oi]) if oi < len(r) and str(r[oi]) not in ("nan", "None") else "")
+
+            # Respuesta correcta
+            corr_idx = idx_enun + idx_corr_offset
+            if corr_idx < len(r):
+                corr_raw = str(r[corr_idx]).strip().upper()
+            else:
+                corr_raw = "A"
+            if corr_raw not in ("A", "B", "C", "D"):
+                corr_raw = "A"
+
+            # Dificultad
+            dif_raw = str(r[idx_dif]).strip() if idx_dif != -1 and idx_dif < len(r) else "Media"
+            if dif_raw in ("nan", "None", ""):
+                dif_raw = "Media"
+
+            # Usada / fecha
+            u_val = ""
+            if idx_usada != -1 and idx_usada < len(r):
+                u_val = _normalizar_fecha(r[idx_usada])
+
+            # Notas
+            nota_val = ""
+            if idx_nota != -1 and idx_nota < len(r):
+                n = str(r[idx_nota]).strip()
+                nota_val = "" if n in ("nan", "NaT", "None") else n
+
+            # Solución
+            sol_val = ""
+            if idx_sol != -1 and idx_sol < len(r):
+                s = str(r[idx_sol]).strip()
+                sol_val = "" if s in ("nan", "NaT", "None") else s
+
+            # Datos (IDs de constantes físicas, separados por coma)
+            datos_val = ""
+            if idx_datos != -1 and idx_datos < len(r):
+                d = str(r[idx_datos]).strip()
+                datos_val = "" if d in ("nan", "NaT", "None") else d
+
+            # Comentario / etiqueta de importación
+            com_val = ""
+            if idx_com != -1 and idx_com < len(r):
+                c = str(r[idx_com]).strip()
+                com_val = "" if c in ("nan", "NaT", "None") else c
+
+            # Objetivo docente
+            obj_val = ""
+            if idx_obj != -1 and idx_obj < len(r):
+                o = str(r[idx_obj]).strip()
+                obj_val = "" if o in ("nan", "NaT", "None") else o
+
+            rows.append({
+                "ID_Pregunta":   id_val,
+                "bloque":        b_name,
+                "Tema":          tem_raw,
+                "enunciado":     str(r[idx_enun]),
+                "opciones_list": ops,
+                "letra_correcta": corr_raw,
+                "dificultad":    dif_raw,
+                "usada":         u_val,
+                "notas":         nota_val,
+                "solucion":      sol_val,
+                "datos":         datos_val,
+                "comentario":    com_val,
+                "objetivo":      obj_val,
+            })
+
+    if not rows:
+        return pd.DataFrame(columns=["ID_Pregunta","bloque","Tema","enunciado",
+                                      "opciones_list","letra_correcta","dificultad","usada","notas","solucion","datos","comentario","objetivo"])
+    return pd.DataFrame(rows)
+
+
+
+# ── Libro sintético ──────────────────────────────────────────────────────────
+def libro_sintetico(n=50_000, n_bloques=10, seed=0):
+    rng = np.random.default_rng(seed)
+    por_hoja = n // n_bloques
+    fechas = [pd.Timestamp("2023-06-12"), "2024-01-20", "20/05/2024", None, pd.NaT, ""]
+    dfs = {}
+    for b in range(n_bloques):
+        i = np.arange(por_hoja)
+        ids = np.array([f"B{b}-{k:05d}" for k in i], dtype=object)
+        ids[i % 997 == 0] = None                      # filas sin ID
+        tema = (i % 12 + 1).astype(object)
+        tema[i % 50 == 0] = "7.0"
+        tema[i % 71 == 0] = None
+        corr = rng.choice(np.array(["A", "B", "C", "D", "b", "X", None], dtype=object), por_hoja)
+        dfs[f"Bloque {b + 1}"] = pd.DataFrame({
+            "ID_Pregunta": ids,
+            "Tema":        tema,
+            "Enunciado":   [f"Enunciado {b}-{k} con algo de texto" for k in i],
+            "Opción A":    [f"a{k}" for k in i],
+            "Opción B":    [f"b{k}" for k in i],
+            "Opción C":    np.where(i % 13 == 0, None, [f"c{k}" for k in i]),
+            "Opción D":    [f"d{k}" for k in i],
+            "Correcta":    corr,
+            "Dificultad":  rng.choice(np.array(["Fácil", "Media", "Difícil", None], dtype=object), por_hoja),
+            "Usada":       [fechas[k % len(fechas)] if k % 3 == 0 else None for k in i],
+            "Notas":       np.where(i % 5 == 0, "nota", None),
+            "Solución":    np.where(i % 7 == 0, "sol", None),
+            "Comentario":  np.where(i % 11 == 0, "importada", None),
+            "Objetivo":    np.where(i % 4 == 0, "OBJ1", None),
+        })
+    dfs["Bloque vacío"] = pd.DataFrame(columns=["ID_Pregunta", "Enunciado"])
+    return lib.cargar_excel_bytes(lib.generar_excel_bytes(dfs))
+
+
+def mejor_de(fn, arg, reps):
+    tiempos = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        res = fn(arg)
+        tiempos.append(time.perf_counter() - t0)
+    return min(tiempos), res
+
+
+def main():
+    n    = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    reps = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    t0 = time.perf_counter()
+    dfs = libro_sintetico(n)
+    print(f"Libro sintético: {n} preguntas ({time.perf_counter() - t0:.1f} s vía .xlsx)")
+
+    t_old, antes = mejor_de(procesar_excel_dfs_filas, dfs, reps)
+    t_new, ahora = mejor_de(procesar_excel_dfs, dfs, reps)
+    # fecha_uso se añadió después; el resto del esquema debe coincidir exactamente
+    ahora = ahora.drop(columns=["fecha_uso"], errors="ignore")
+    pd.testing.assert_frame_equal(antes, ahora)
+
+    print(f"Resultados idénticos: {len(ahora)} filas, {ahora.shape[1]} columnas")
+    print(f"  iterrows (antes):    {t_old * 1000:8.0f} ms")
+    print(f"  vectorizado (ahora): {t_new * 1000:8.0f} ms   (x{t_old / t_new:.1f})")
+
+
+if __name__ == "__main__":
+    main()
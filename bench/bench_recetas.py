@@ -0,0 +1,168 @@
+"""Benchmark de lib.aplicar_receta frente al bucle voraz anterior del Generador.
+
+Banco sintético (por defecto 50k preguntas, 10 bloques, 40 temas, 3 dificultades,
+4 objetivos) y una receta de 3 bloques × 40 temas × 3 dificultades con celdas
+'__ALL__' y '__OBJ_' que se solapan con las de tema, más 300 preguntas fijas y
+dos celdas imposibles. Las dos versiones no eligen las mismas preguntas (la
+nueva resuelve el solapamiento como emparejamiento), así que se comprueba que
+ambas selecciones son válidas y se comparan huecos sin cubrir y tiempo.
+
+Uso:  python bench/bench_recetas.py [n_preguntas] [repeticiones]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+import examen_lib_latex as lib
+
+
+# ── Implementación anterior ──────────────────────────────────────────────────
+def receta_voraz(df_total, auto_rec, sel_prev, rng):
+    """Bucle del botón 'Generar' antes de lib.aplicar_receta, copiado tal cual
+    (salvo que devuelve las faltas como tuplas en vez de texto markdown):
+    (ids añadidos, [(bloque, clave, dificultad, pedidas, fijas, añadidas)])."""
+    exam_ids     = list(sel_prev)
+    df_lookup    = df_total.set_index("ID_Pregunta").to_dict("index")
+    already_used = set(exam_ids)
+    warns_gen    = []
+    for bloque, temas_cfg in auto_rec.items():
+        for tema_key, dif_cfg in temas_cfg.items():
+            for dif_name, n_req in dif_cfg.items():
+                if n_req <= 0:
+                    continue
+                if tema_key == "__ALL__":
+                    already_fixed = [
+                        p for p in sel_prev
+                        if df_lookup.get(p, {}).get("bloque", "") == bloque
+                        and df_lookup.get(p, {}).get("dificultad", "").lower() == dif_name.lower()
+                    ]
+                    pool_ids = df_total[
+                        (df_total["bloque"] == bloque) &
+                        (df_total["dificultad"].str.lower() == dif_name.lower()) &
+                        (~df_total["ID_Pregunta"].isin(already_used))
+                    ]["ID_Pregunta"].tolist()
+                elif tema_key.startswith("__OBJ_"):
+                    obj_cod = tema_key[len("__OBJ_"):]
+                    already_fixed = [
+                        p for p in sel_prev
+                        if df_lookup.get(p, {}).get("bloque", "") == bloque
+                        and str(df_lookup.get(p, {}).get("objetivo", "")) == obj_cod
+                        and df_lookup.get(p, {}).get("dificultad", "").lower() == dif_name.lower()
+                    ]
+                    _obj_mask = (
+                        (df_total["bloque"] == bloque) &
+                        (df_total["dificultad"].str.lower() == dif_name.lower()) &
+                        (~df_total["ID_Pregunta"].isin(already_used))
+                    )
+                    if "objetivo" in df_total.columns:
+                        _obj_mask &= (df_total["objetivo"].astype(str) == obj_cod)
+                    pool_ids = df_total[_obj_mask]["ID_Pregunta"].tolist()
+                else:
+                    already_fixed = [
+                        p for p in sel_prev
+                        if df_lookup.get(p, {}).get("bloque", "") == bloque
+                        and str(df_lookup.get(p, {}).get("Tema", "")) == str(tema_key)
+                        and df_lookup.get(p, {}).get("dificultad", "").lower() == dif_name.lower()
+                    ]
+                    pool_ids = df_total[
+                        (df_total["bloque"] == bloque) &
+                        (df_total["Tema"].astype(str) == str(tema_key)) &
+                        (df_total["dificultad"].str.lower() == dif_name.lower()) &
+                        (~df_total["ID_Pregunta"].isin(already_used))
+                    ]["ID_Pregunta"].tolist()
+
+                needed = max(0, n_req - len(already_fixed))
+                actual = min(needed, len(pool_ids))
+                picked = rng.sample(pool_ids, actual) if actual > 0 else []
+                if actual < needed:
+                    warns_gen.append((bloque, tema_key, dif_name, n_req, len(already_fixed), actual))
+                exam_ids.extend(picked)
+                already_used.update(picked)
+    return exam_ids[len(sel_prev):], warns_gen
+
+
+# ── Datos sintéticos ─────────────────────────────────────────────────────────
+def banco_sintetico(n=50_000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "ID_Pregunta": [f"P{i}" for i in range(n)],
+        "bloque":      rng.choice([f"Bloque {i}" for i in range(10)], n),
+        "Tema":        rng.integers(1, 41, n).astype(str),
+        "dificultad":  rng.choice(["Fácil", "Media", "Difícil"], n),
+        "objetivo":    rng.integers(1, 5, n).astype(str),
+    })
+
+
+def receta_sintetica():
+    rec = {}
+    for b in range(3):
+        rec[f"Bloque {b}"] = {str(t): {"fácil": 2, "media": 2, "difícil": 1} for t in range(1, 41)}
+        rec[f"Bloque {b}"]["__ALL__"] = {"fácil": 3, "media": 0, "difícil": 2}
+        rec[f"Bloque {b}"]["__OBJ_2"] = {"fácil": 1, "media": 1, "difícil": 1}
+    rec["Bloque 0"]["1"] = {"fácil": 500, "media": 1, "difícil": 0}   # imposible → falta
+    rec["Bloque 9"] = {"77": {"media": 2}}                            # tema inexistente
+    return rec
+
+
+def huecos(faltas_por_celda):
+    return sum(pedidas - fijas - añadidas for pedidas, fijas, añadidas in faltas_por_celda)
+
+
+def validar(ids, fijas, df):
+    assert len(set(ids)) == len(ids), "preguntas repetidas"
+    assert not set(ids) & set(fijas), "se repite una fija"
+    assert set(ids) <= set(df["ID_Pregunta"])
+
+
+def solapamiento(semillas=200):
+    """Bloque mínimo con tema 1 ×2 y '__ALL__' ×1 (en ese orden de receta, el peor
+    para el voraz): cuántas semillas dejan huecos con cada versión."""
+    df = pd.DataFrame({"ID_Pregunta": ["T1-a", "T1-b", "T2-a"], "bloque": ["B"] * 3,
+                       "Tema": ["1", "1", "2"], "dificultad": ["Media"] * 3})
+    rec = {"B": {"__ALL__": {"media": 1}, "1": {"media": 2}}}
+    viejo = sum(bool(receta_voraz(df, rec, [], random.Random(s))[1]) for s in range(semillas))
+    nuevo = sum(bool(lib.aplicar_receta(df, rec, [], random.Random(s))[1]) for s in range(semillas))
+    return viejo, nuevo
+
+
+def mejor_de(fn, reps):
+    tiempos = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        res = fn()
+        tiempos.append(time.perf_counter() - t0)
+    return min(tiempos), res
+
+
+def main():
+    n    = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    reps = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    df, rec = banco_sintetico(n), receta_sintetica()
+    fijas = df.sample(300, random_state=1)["ID_Pregunta"].tolist()
+
+    t_old, (ids_old, f_old) = mejor_de(lambda: receta_voraz(df, rec, fijas, random.Random(42)), reps)
+    t_new, (ids_new, f_new) = mejor_de(lambda: lib.aplicar_receta(df, rec, fijas, random.Random(42)), reps)
+    validar(ids_old, fijas, df)
+    validar(ids_new, fijas, df)
+    assert lib.aplicar_receta(df, rec, fijas, 42)[0] == ids_new, "no reproducible con la semilla"
+    h_old = huecos((p, fi, a) for _, _, _, p, fi, a in f_old)
+    h_new = huecos((f["pedidas"], f["fijas"], f["añadidas"]) for f in f_new)
+    assert h_new <= h_old
+
+    print(f"Banco sintético: {n} preguntas, {len(fijas)} fijas")
+    print(f"  voraz (antes):          {t_old * 1000:8.0f} ms  {len(ids_old)} añadidas, "
+          f"{len(f_old)} celdas cortas, {h_old} huecos")
+    print(f"  aplicar_receta (ahora): {t_new * 1000:8.0f} ms  {len(ids_new)} añadidas, "
+          f"{len(f_new)} celdas cortas, {h_new} huecos   (x{t_old / t_new:.1f})")
+    v, nv = solapamiento()
+    print(f"Solapamiento tema 1 ×2 + '__ALL__' ×1, 200 semillas con huecos: voraz {v}, ahora {nv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import pandas as pd
+import numpy as np
 import random, re, os
+from contextlib import contextmanager
 from docx import Document
 
 # ── Hojas de configuración (se excluyen del procesado de preguntas) ──────────
@@ -8,7 +10,10 @@ CFG_TEMAS_SHEET     = "Cfg_Temas"
 CFG_GENERAL_SHEET   = "Cfg_General"
 CFG_OBJETIVOS_SHEET = "Cfg_Objetivos"
 DATOS_SHEET         = "Datos"
-CFG_SHEETS          = {CFG_BLOQUES_SHEET, CFG_TEMAS_SHEET, CFG_GENERAL_SHEET, DATOS_SHEET, CFG_OBJETIVOS_SHEET}
+HISTORIAL_USO_SHEET = "Historial_Uso"
+CFG_SHEETS          = {CFG_BLOQUES_SHEET, CFG_TEMAS_SHEET, CFG_GENERAL_SHEET, DATOS_SHEET, CFG_OBJETIVOS_SHEET,
+                       HISTORIAL_USO_SHEET}
+HISTORIAL_USO_COLS  = ["ID_Pregunta", "Fecha", "Examen"]
 DATOS_COLS         = ["ID", "Nombre", "Símbolo", "Valor", "Unidades", "Categoría"]
 from docx.shared import Inches, RGBColor, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
@@ -21,6 +26,10 @@ try:
 except ImportError:
     _HAS_GSPREAD = False
 
+import importlib.util
+# Formato de la caché en disco (Feather). Lo instala streamlit; sin él no hay caché.
+_HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
 # --- DETECCIÓN DE ENTORNO ---
 def detectar_entorno():
     """Retorna 'colab' si se ejecuta en Google Colab, 'local' en caso contrario."""
@@ -39,122 +48,1296 @@ def conectar_sheet_seguro(url):
     return gc.open_by_url(url)
 
 # --- CONEXIÓN EXCEL LOCAL ---
+class LibroHojas(dict):
+    """dict {nombre_hoja: DataFrame} que recuerda qué hojas han cambiado.
+
+    Asignar una hoja (dfs[nombre] = df) la marca como sucia. Las ediciones in
+    situ sobre un DataFrame (dfs[nombre].loc[...] = ...) NO se detectan: quien
+    edita así debe llamar a marcar_sucia(nombre) o reasignar la hoja. Si hay
+    hojas marcadas, guardar_excel_local reescribe solo esas y una edición in
+    situ sin marcar en otra hoja se pierde; con completo=True se reescriben
+    todas. Añadir, quitar o reordenar hojas marca la estructura como cambiada,
+    y entonces el próximo guardado reescribe el libro entero.
+
+    Un libro creado con LibroHojas.perezoso() no lee sus hojas hasta que se
+    accede a cada una (dfs[nombre], get, items, values...).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sucias = set()
+        self.estructura_cambiada = False
+        self._indice = None
+        self._pendientes = set()
+        self._cargar_hoja = None
+        self._al_terminar = None
+
+    @classmethod
+    def perezoso(cls, nombres, cargar_hoja, al_terminar=None):
+        """Libro con las hojas `nombres` sin leer. cargar_hoja(nombre) devuelve el
+        DataFrame de una hoja y se llama la primera vez que se accede a ella;
+        al_terminar() se llama cuando ya no queda ninguna por leer."""
+        libro = cls((n, None) for n in nombres)
+        libro._pendientes  = set(libro.keys())
+        libro._cargar_hoja = cargar_hoja
+        libro._al_terminar = al_terminar
+        if not libro._pendientes and al_terminar:
+            al_terminar()
+        return libro
+
+    def _materializar(self, nombre):
+        super().__setitem__(nombre, self._cargar_hoja(nombre))
+        self._descartar_pendiente(nombre)
+
+    def _descartar_pendiente(self, nombre):
+        if nombre in self._pendientes:
+            self._pendientes.discard(nombre)
+            if not self._pendientes:
+                al_terminar, self._cargar_hoja, self._al_terminar = self._al_terminar, None, None
+                if al_terminar:
+                    al_terminar()
+
+    def hojas_leidas(self):
+        """Nombres de las hojas ya cargadas en memoria."""
+        return [n for n in self.keys() if n not in self._pendientes]
+
+    def __getitem__(self, nombre):
+        if nombre in self._pendientes:
+            self._materializar(nombre)
+        return super().__getitem__(nombre)
+
+    def get(self, nombre, default=None):
+        return self[nombre] if nombre in self else default
+
+    def __iter__(self):
+        # Definirlo en Python hace que dict(libro) y {**libro} pasen por __getitem__
+        return super().__iter__()
+
+    def items(self):
+        return [(n, self[n]) for n in self.keys()]
+
+    def values(self):
+        return [self[n] for n in self.keys()]
+
+    def __reduce__(self):
+        # Al deserializar (copia o pickle) el libro vuelve limpio y leído
+        return (self.__class__, ({n: self[n] for n in self.keys()},))
+
+    def __setitem__(self, nombre, df):
+        if nombre not in self:
+            self.estructura_cambiada = True
+        super().__setitem__(nombre, df)
+        self._descartar_pendiente(nombre)
+        self.sucias.add(nombre)
+
+    def __delitem__(self, nombre):
+        super().__delitem__(nombre)
+        self._descartar_pendiente(nombre)
+        self.sucias.discard(nombre)
+        self.estructura_cambiada = True
+
+    def pop(self, nombre, *default):
+        if nombre in self:
+            df = self[nombre]
+            del self[nombre]
+            return df
+        return super().pop(nombre, *default)
+
+    def popitem(self):
+        nombre = next(reversed(self.keys()))
+        return nombre, self.pop(nombre)
+
+    def clear(self):
+        for nombre in list(self._pendientes):
+            self._descartar_pendiente(nombre)
+        super().clear()
+        self.sucias.clear()
+        self.estructura_cambiada = True
+
+    def setdefault(self, nombre, df=None):
+        if nombre not in self:
+            self[nombre] = df
+        return self[nombre]
+
+    def update(self, *args, **kwargs):
+        for nombre, df in dict(*args, **kwargs).items():
+            self[nombre] = df
+
+    def marcar_sucia(self, *nombres):
+        self.sucias.update(n for n in nombres if n in self)
+
+    def hojas_sucias(self):
+        """Conjunto de hojas a reescribir, o None si hay que reescribirlas todas."""
+        return None if self.estructura_cambiada else set(self.sucias)
+
+    def marcar_guardado(self):
+        self.sucias.clear()
+        self.estructura_cambiada = False
+
+    def indice(self) -> 'IndicePreguntas':
+        """Índice ID_Pregunta → (hoja, fila) del libro; se crea la primera vez y se mantiene."""
+        if self._indice is None:
+            self._indice = IndicePreguntas(self)
+        return self._indice
+
+def _hojas_sucias(dict_of_dfs):
+    """Hojas modificadas de dict_of_dfs; None si no se sabe (dict normal)."""
+    if isinstance(dict_of_dfs, LibroHojas):
+        return dict_of_dfs.hojas_sucias()
+    return None
+
+def cargar_excel_bytes(data: bytes) -> LibroHojas:
+    """Abre un .xlsx en memoria en modo solo lectura (streaming) y devuelve un
+    LibroHojas perezoso: cada hoja se convierte en DataFrame al usarla por primera vez."""
+    import io
+    # pandas abre el libro con openpyxl read_only=True: las hojas se recorren en streaming
+    xls = pd.ExcelFile(io.BytesIO(data), engine='openpyxl')
+    return LibroHojas.perezoso(xls.sheet_names, lambda name: xls.parse(sheet_name=name),
+                               al_terminar=xls.close)
+
 def cargar_excel_local(filepath):
-    """Lee todas las hojas de un .xlsx y devuelve dict {nombre_hoja: DataFrame}."""
-    xls = pd.ExcelFile(filepath, engine='openpyxl')
-    return {name: pd.read_excel(xls, sheet_name=name) for name in xls.sheet_names}
-
-def backup_excel(filepath, max_backups=10):
-    """Crea backup del Excel antes de guardar. Mantiene ultimas max_backups copias."""
-    import shutil, datetime as _dt
-    if not os.path.exists(filepath): return
-    backup_dir = os.path.join(os.path.dirname(filepath), '_backups')
-    os.makedirs(backup_dir, exist_ok=True)
-    base = os.path.splitext(os.path.basename(filepath))[0]
-    ts = _dt.datetime.now().strftime('%Y%m%d_%H%M%S')
-    shutil.copy2(filepath, os.path.join(backup_dir, f"{base}_{ts}.xlsx"))
-    # Limpiar backups antiguos
-    bks = sorted([f for f in os.listdir(backup_dir) if f.startswith(base) and f.endswith('.xlsx')])
-    for old in bks[:-max_backups]:
-        os.remove(os.path.join(backup_dir, old))
-
-def guardar_excel_local(filepath, dict_of_dfs):
-    """Escribe a disco. Si filepath está vacío (modo cloud/upload), no hace nada."""
+    """Lee un .xlsx y devuelve dict {nombre_hoja: DataFrame} (LibroHojas perezoso).
+    El archivo se lee entero al abrirlo, así que guardarlo después no afecta a las
+    hojas que aún no se han materializado."""
+    with open(filepath, 'rb') as f:
+        return cargar_excel_bytes(f.read())
+
+def guardar_excel_local(filepath, dict_of_dfs, completo=False):
+    """Escribe a disco. Si filepath está vacío (modo cloud/upload), no hace nada.
+    Si filepath es una base SQLite, reescribe las hojas en ella en lugar del .xlsx.
+    Si dict_of_dfs es un LibroHojas, solo se reescriben las hojas marcadas como
+    modificadas (ver LibroHojas); el resto de partes del .xlsx se conservan tal
+    cual. completo=True reescribe todas las hojas. Si no hay ninguna marcada
+    también se reescriben todas: se ha pedido guardar y puede haber ediciones
+    in situ sin marcar."""
     if not filepath:
         return
-    backup_excel(filepath)
-    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-        for sheet_name, df in dict_of_dfs.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    sucias = None if completo else _hojas_sucias(dict_of_dfs)
+    if sucias is not None and not sucias:
+        sucias = None
+    almacen = AlmacenBackups(filepath)
+    almacen.asegurar_estado_en_disco()
+    if es_ruta_sqlite(filepath):
+        guardar_sqlite(filepath, dict_of_dfs, hojas=sucias)
+    else:
+        with _cache_al_escribir(filepath, dict_of_dfs, sucias):
+            if sucias is None or not _reemplazar_hojas_xlsx(filepath, dict_of_dfs, sucias):
+                _escribir_xlsx(filepath + '.tmp', dict_of_dfs)
+                os.replace(filepath + '.tmp', filepath)
+    almacen.registrar(dict_of_dfs, hojas=sucias)
+    if isinstance(dict_of_dfs, LibroHojas):
+        dict_of_dfs.marcar_guardado()
+
+# --- COPIAS DE SEGURIDAD (instantáneas por hoja, direccionadas por contenido) ---
+# _backups/<archivo>/objetos/ab/<sha256>.json.gz   una hoja serializada
+# _backups/<archivo>/snapshots/<AAAAmmdd_HHMMSS_ffffff>.json   [(hoja, sha256), ...]
+# Una hoja que no cambia entre guardados es el mismo objeto en todas las
+# instantáneas, así que cada guardado solo escribe las hojas modificadas.
+BACKUP_VENTANA_S = 60          # guardados más seguidos se funden en una instantánea
+BACKUP_RETENCION = (           # (antigüedad máxima en s, se conserva 1 por intervalo de s)
+    (3600,       None),        # última hora: todas
+    (86400,      3600),        # último día: una por hora
+    (30 * 86400, 86400),       # último mes: una por día
+)
+
+def _firma_archivo(filepath):
+    try:
+        st_ = os.stat(filepath)
+    except OSError:
+        return None
+    return [st_.st_mtime_ns, st_.st_size]
+
+def _columnas_fecha(df) -> list:
+    """Nombres (str) de las columnas datetime de df, para restaurarlas al deserializar."""
+    return [str(c) for c, t in df.dtypes.items() if pd.api.types.is_datetime64_any_dtype(t)]
+
+def _restaurar_fechas(df, fechas):
+    for c in fechas:
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c], errors="coerce")
+    return df
+
+def _serializar_hoja(df) -> bytes:
+    """JSON determinista de una hoja: columnas, columnas de fecha y filas (NaN → null)."""
+    import json
+    fechas = _columnas_fecha(df)
+    filas  = df.astype(object).where(pd.notna(df), None).values.tolist()
+    return json.dumps({"columnas": [str(c) for c in df.columns], "fechas": fechas, "filas": filas},
+                      ensure_ascii=False, default=str).encode("utf-8")
+
+def _deserializar_hoja(data: bytes) -> pd.DataFrame:
+    import json
+    d  = json.loads(data)
+    df = pd.DataFrame(d["filas"], columns=d["columnas"])
+    return _restaurar_fechas(df, d["fechas"])
+
+# Tipos de columna object que Arrow guarda tal cual (pd.api.types.infer_dtype)
+_TIPOS_ARROW = {"string", "integer", "floating", "boolean", "datetime", "datetime64", "date", "empty"}
+
+def _hoja_a_feather(df) -> tuple:
+    """(bytes Feather, {columna: dtype}) de una hoja, para CacheLibro.
+
+    Las columnas object con tipos mezclados (números y texto en una misma
+    columna de Excel, fechas junto a anotaciones...) se guardan como texto; las
+    de listas (opciones_list) como listas. El dict de dtypes permite devolver a
+    cada columna su dtype al leer (_hoja_de_feather)."""
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    cols, tipos = {}, {}
+    for i, c in enumerate(df.columns):
+        col = df.iloc[:, i]
+        tipos[str(c)] = str(col.dtype)
+        if col.dtype == object:
+            tipo = pd.api.types.infer_dtype(col, skipna=True)
+            if tipo not in _TIPOS_ARROW and not (
+                    tipo == "mixed" and col.dropna().map(lambda v: isinstance(v, list)).all()):
+                col = col.map(str).where(col.notna(), None)
+        cols[str(c)] = col.reset_index(drop=True)
+    tabla = pa.Table.from_pandas(pd.DataFrame(cols, columns=list(cols)), preserve_index=False)
+    buf = pa.BufferOutputStream()
+    feather.write_feather(tabla, buf, compression="uncompressed")
+    return buf.getvalue().to_pybytes(), tipos
+
+def _hoja_de_feather(ruta, tipos: dict) -> pd.DataFrame:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    tabla  = feather.read_table(ruta, memory_map=False)
+    listas = [c.name for c in tabla.schema if pa.types.is_list(c.type)]
+    # to_pandas daría arrays de numpy en vez de listas: esas columnas van aparte
+    df = tabla.drop_columns(listas).to_pandas(integer_object_nulls=True)
+    for c in listas:
+        df.insert(tabla.schema.get_field_index(c), c,
+                  pd.Series(tabla.column(c).to_pylist(), dtype=object))
+    for c, t in tipos.items():
+        if c in df.columns and str(df[c].dtype) != t:
+            try:
+                df[c] = df[c].astype(t)
+            except (TypeError, ValueError):
+                pass
+    return df
+
+class AlmacenBackups:
+    """Instantáneas de un libro (.xlsx o SQLite) en _backups/<archivo>/ junto a él.
+
+    guardar_excel_local llama a asegurar_estado_en_disco() antes de escribir y a
+    registrar() después. Las instantáneas se purgan según BACKUP_RETENCION.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.dir      = os.path.join(os.path.dirname(os.path.abspath(filepath)),
+                                     '_backups', os.path.basename(filepath))
+        self.dir_obj  = os.path.join(self.dir, 'objetos')
+        self.dir_snap = os.path.join(self.dir, 'snapshots')
+
+    def _ruta_objeto(self, sha):
+        return os.path.join(self.dir_obj, sha[:2], sha + '.json.gz')
+
+    def _guardar_hoja(self, df) -> str:
+        import gzip, hashlib
+        data = _serializar_hoja(df)
+        sha  = hashlib.sha256(data).hexdigest()
+        ruta = self._ruta_objeto(sha)
+        if not os.path.exists(ruta):
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            with gzip.GzipFile(ruta + '.tmp', 'wb', mtime=0) as f:
+                f.write(data)
+            os.replace(ruta + '.tmp', ruta)
+        return sha
+
+    def _leer_snapshot(self, snap_id):
+        import json
+        with open(os.path.join(self.dir_snap, snap_id + '.json'), encoding='utf-8') as f:
+            snap = json.load(f)
+        snap["id"] = snap_id
+        return snap
+
+    def _ids(self):
+        if not os.path.isdir(self.dir_snap):
+            return []
+        return sorted(f[:-5] for f in os.listdir(self.dir_snap) if f.endswith('.json'))
+
+    def listar(self) -> list:
+        """Instantáneas de la más antigua a la más reciente. Cada una es un dict con
+        id, fecha, actualizado (ISO), origen ('guardado'/'disco'), firma y hojas."""
+        return [self._leer_snapshot(i) for i in self._ids()]
+
+    def ultima(self):
+        ids = self._ids()
+        return self._leer_snapshot(ids[-1]) if ids else None
+
+    def asegurar_estado_en_disco(self):
+        """Si el contenido actual del archivo no está en el almacén (primer guardado,
+        o se editó fuera de la app), lo guarda como instantánea antes de sobrescribirlo."""
+        firma = _firma_archivo(self.filepath)
+        if firma is None:
+            return
+        ult = self.ultima()
+        if ult is not None and ult.get("firma") == firma:
+            return
+        dfs = cargar_sqlite(self.filepath) if es_ruta_sqlite(self.filepath) else cargar_excel_local(self.filepath)
+        self.registrar(dfs, origen='disco')
+
+    def registrar(self, dict_of_dfs, hojas=None, origen='guardado', ahora=None) -> str:
+        """Guarda una instantánea del libro tal como ha quedado en disco.
+
+        Con hojas=None se serializan todas; si no, solo las indicadas y el resto se
+        toman de la última instantánea. Un guardado a menos de BACKUP_VENTANA_S de la
+        instantánea anterior la sustituye en lugar de crear otra. Retorna el id."""
+        import json, datetime as _dt
+        ahora = ahora or _dt.datetime.now()
+        ult   = self.ultima()
+        previas = dict(ult["hojas"]) if ult is not None and hojas is not None else {}
+        lista = [[nombre, previas[nombre] if nombre in previas and nombre not in hojas
+                  else self._guardar_hoja(dict_of_dfs[nombre])]
+                 for nombre in dict_of_dfs.keys()]
+        snap = {"fecha": ahora.isoformat(timespec='seconds'),
+                "actualizado": ahora.isoformat(timespec='seconds'),
+                "origen": origen, "firma": _firma_archivo(self.filepath), "hojas": lista}
+        if (ult is not None and origen == ult.get("origen") == 'guardado'
+                and (ahora - _dt.datetime.fromisoformat(ult["fecha"])).total_seconds() < BACKUP_VENTANA_S):
+            snap_id, snap["fecha"] = ult["id"], ult["fecha"]
+        else:
+            snap_id = ahora.strftime('%Y%m%d_%H%M%S_%f')
+        os.makedirs(self.dir_snap, exist_ok=True)
+        ruta = os.path.join(self.dir_snap, snap_id + '.json')
+        with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(snap, f, ensure_ascii=False)
+        os.replace(ruta + '.tmp', ruta)
+        self.purgar(ahora)
+        return snap_id
+
+    def purgar(self, ahora=None) -> int:
+        """Aplica BACKUP_RETENCION (siempre conserva la última) y borra los objetos
+        que ya no usa ninguna instantánea. Retorna cuántas instantáneas se borraron."""
+        import datetime as _dt
+        ahora = ahora or _dt.datetime.now()
+        snaps = self.listar()
+        conservar, cubos = set(), set()
+        for i, snap in enumerate(reversed(snaps)):
+            t = _dt.datetime.fromisoformat(snap["actualizado"])
+            edad = (ahora - t).total_seconds()
+            for edad_max, intervalo in BACKUP_RETENCION:
+                if edad < edad_max:
+                    cubo = (intervalo, int(t.timestamp() // intervalo)) if intervalo else None
+                    if cubo is None or cubo not in cubos:
+                        cubos.add(cubo)
+                        conservar.add(snap["id"])
+                    break
+            if i == 0:
+                conservar.add(snap["id"])
+        borrar = [s for s in snaps if s["id"] not in conservar]
+        if not borrar:
+            return 0
+        for snap in borrar:
+            os.remove(os.path.join(self.dir_snap, snap["id"] + '.json'))
+        usados = {sha for s in snaps if s["id"] in conservar for _, sha in s["hojas"]}
+        for raiz, _, archivos in os.walk(self.dir_obj):
+            for f in archivos:
+                if f.endswith('.json.gz') and f[:-8] not in usados:
+                    os.remove(os.path.join(raiz, f))
+        return len(borrar)
+
+    def cargar(self, snap_id) -> 'LibroHojas':
+        """Reconstruye en memoria el libro de una instantánea."""
+        import gzip
+        libro = LibroHojas()
+        for nombre, sha in self._leer_snapshot(snap_id)["hojas"]:
+            with gzip.open(self._ruta_objeto(sha), 'rb') as f:
+                libro[nombre] = _deserializar_hoja(f.read())
+        libro.marcar_guardado()
+        return libro
+
+    def restaurar(self, snap_id, destino=None) -> str:
+        """Escribe la instantánea como .xlsx. Por defecto junto al archivo original,
+        como <nombre>_restaurado_<id>.xlsx. Retorna la ruta escrita."""
+        if destino is None:
+            base = os.path.splitext(os.path.abspath(self.filepath))[0]
+            destino = f"{base}_restaurado_{snap_id}.xlsx"
+        _escribir_xlsx(destino, self.cargar(snap_id))
+        return destino
+
+# --- REESCRITURA PARCIAL DEL .xlsx ---
+# Un .xlsx es un zip de partes XML. Para guardar solo las hojas modificadas se
+# regenera el XML de esas hojas (con cadenas inline, sin tocar sharedStrings.xml)
+# y el resto de partes se copian sin cambios.
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL  = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG  = "http://schemas.openxmlformats.org/package/2006/relationships"
+_XML_INVALIDOS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_EPOCH_EXCEL = pd.Timestamp("1899-12-30")
+
+def _partes_hojas_xlsx(zf):
+    """{nombre_hoja: ruta de la parte XML dentro del zip}, en el orden del libro."""
+    from xml.etree import ElementTree as ET
+    wb   = ET.fromstring(zf.read("xl/workbook.xml"))
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    destinos = {}
+    for r in rels.iter(f"{{{_NS_PKG}}}Relationship"):
+        t = r.get("Target", "")
+        destinos[r.get("Id")] = t.lstrip("/") if t.startswith("/") else "xl/" + t
+    return {h.get("name"): destinos.get(h.get(f"{{{_NS_REL}}}id"))
+            for h in wb.iter(f"{{{_NS_MAIN}}}sheet")}
+
+def _estilo_fecha_xlsx(estilos: str):
+    """Índice de un estilo de celda con formato de fecha en styles.xml.
+    Si no existe, lo añade al final de cellXfs (los índices previos no cambian).
+    Retorna (estilos, indice)."""
+    fmts_fecha = {14, 15, 16, 17, 18, 19, 20, 21, 22, 45, 46, 47}
+    for m in re.finditer(r'<numFmt\b[^>]*numFmtId="(\d+)"[^>]*formatCode="([^"]*)"', estilos):
+        if re.search(r'y|d', m.group(2), re.I):
+            fmts_fecha.add(int(m.group(1)))
+    bloque = re.search(r'<cellXfs\b[^>]*>(.*?)</cellXfs>', estilos, re.S)
+    if bloque is None:
+        return None, None
+    xfs = re.findall(r'<xf\b[^>]*?(?:/>|>.*?</xf>)', bloque.group(1), re.S)
+    for i, xf in enumerate(xfs):
+        m = re.search(r'numFmtId="(\d+)"', xf)
+        if m and int(m.group(1)) in fmts_fecha:
+            return estilos, i
+    nuevo = '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    ini, fin = bloque.span(1)
+    cabecera = re.sub(r'count="\d+"', f'count="{len(xfs) + 1}"', estilos[bloque.start():ini])
+    return estilos[:bloque.start()] + cabecera + estilos[ini:fin] + nuevo + estilos[fin:], len(xfs)
+
+def _xml_celda(ref, v, s_fecha):
+    import datetime as _dt, math
+    from xml.sax.saxutils import escape
+    if v is None or v is pd.NaT or v is pd.NA:
+        return ""
+    if isinstance(v, (bool, np.bool_)):
+        return f'<c r="{ref}" t="b"><v>{int(v)}</v></c>'
+    if isinstance(v, (int, float, np.integer, np.floating)):
+        if isinstance(v, (float, np.floating)) and not math.isfinite(v):
+            return ""
+        return f'<c r="{ref}"><v>{repr(v.item() if hasattr(v, "item") else v)}</v></c>'
+    if isinstance(v, (_dt.datetime, _dt.date)):
+        dias = (pd.Timestamp(v) - _EPOCH_EXCEL) / pd.Timedelta(days=1)
+        return f'<c r="{ref}" s="{s_fecha}"><v>{dias:.10g}</v></c>'
+    txt = _XML_INVALIDOS.sub("", v if isinstance(v, str) else str(v))
+    esp = ' xml:space="preserve"' if txt != txt.strip() or "\n" in txt else ""
+    return f'<c r="{ref}" t="inlineStr"><is><t{esp}>{escape(txt)}</t></is></c>'
+
+def _xml_hoja(df, s_fecha):
+    """XML de una hoja (cabecera + filas) equivalente a df.to_excel(index=False)."""
+    from openpyxl.utils import get_column_letter
+    letras = [get_column_letter(i + 1) for i in range(len(df.columns))]
+    filas = [[str(c) for c in df.columns]] + df.astype(object).values.tolist()
+    partes = [f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+              f'<worksheet xmlns="{_NS_MAIN}"><sheetData>']
+    for r, fila in enumerate(filas, start=1):
+        celdas = "".join(_xml_celda(f"{l}{r}", v, s_fecha) for l, v in zip(letras, fila))
+        partes.append(f'<row r="{r}">{celdas}</row>')
+    partes.append('</sheetData></worksheet>')
+    return "".join(partes).encode("utf-8")
+
+def _reemplazar_hojas_xlsx(filepath, dict_of_dfs, hojas) -> bool:
+    """Reescribe dentro del .xlsx solo las hojas `hojas`. Retorna False (sin tocar
+    el archivo) si el libro no admite el reemplazo parcial: no existe, sus hojas
+    no coinciden con dict_of_dfs o alguna hoja sucia tiene relaciones propias
+    (dibujos, comentarios...)."""
+    import zipfile
+    if not os.path.isfile(filepath):
+        return False
+    tmp = filepath + ".tmp"
+    try:
+        with zipfile.ZipFile(filepath) as zin:
+            partes = _partes_hojas_xlsx(zin)
+            if list(partes) != list(dict_of_dfs.keys()):
+                return False
+            nombres = set(zin.namelist())
+            nuevas = {}
+            for h in hojas:
+                parte = partes[h]
+                d, f = os.path.split(parte)
+                if parte not in nombres or f"{d}/_rels/{f}.rels" in nombres:
+                    return False
+                nuevas[parte] = dict_of_dfs[h]
+            estilos = zin.read("xl/styles.xml").decode("utf-8") if "xl/styles.xml" in nombres else None
+            estilos_nuevos, s_fecha = _estilo_fecha_xlsx(estilos) if estilos else (None, None)
+            if s_fecha is None:
+                return False
+            nuevas = {p: _xml_hoja(df, s_fecha) for p, df in nuevas.items()}
+            if estilos_nuevos != estilos and not any(f' s="{s_fecha}"' in x.decode() for x in nuevas.values()):
+                estilos_nuevos = estilos  # el estilo añadido no hace falta
+            with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED) as zout:
+                for info in zin.infolist():
+                    if info.filename in nuevas:
+                        zout.writestr(info, nuevas[info.filename], zipfile.ZIP_DEFLATED)
+                    elif info.filename == "xl/styles.xml" and estilos_nuevos != estilos:
+                        zout.writestr(info, estilos_nuevos.encode("utf-8"), zipfile.ZIP_DEFLATED)
+                    else:
+                        zout.writestr(info, zin.read(info.filename))
+    except (zipfile.BadZipFile, KeyError):
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    os.replace(tmp, filepath)
+    return True
+
+# --- CACHÉ DEL LIBRO PARSEADO ---
+# _cache/<hash de la ruta>/ junto al archivo:
+#   manifest.json          firma del archivo (ruta, mtime, tamaño, sha256), hojas en
+#                          orden [(nombre, sha)], derivados {nombre: {hoja: [sha_hoja, sha]}}
+#                          y los dtypes de cada objeto {sha: {columna: dtype}}
+#   objetos/<sha>.feather  una hoja o un derivado, en Feather (_hoja_a_feather)
+# Feather es columnar y binario pero solo datos: cargar la caché nunca ejecuta
+# código, aunque otro pueda escribir en la carpeta. Si el archivo no ha cambiado,
+# reconectar no pasa por openpyxl, y tras un guardado solo se escriben las hojas
+# modificadas (ver tras_guardar).
+_CACHE_FORMATO = "feather-1"
+def _hash_archivo(filepath) -> str:
+    import hashlib
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _cache_dir(filepath) -> str:
+    import hashlib
+    ruta = os.path.abspath(filepath)
+    clave = hashlib.sha1(ruta.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(os.path.dirname(ruta), '_cache', clave)
+
+def cache_invalidar(filepath):
+    """Borra la caché asociada a filepath."""
+    import shutil
+    if filepath:
+        shutil.rmtree(_cache_dir(filepath), ignore_errors=True)
+
+def _leer_hoja_archivo(filepath, nombre) -> pd.DataFrame:
+    if es_ruta_sqlite(filepath):
+        return cargar_sqlite(filepath)[nombre]
+    return pd.read_excel(filepath, sheet_name=nombre)
+
+class CacheLibro:
+    """Caché en disco de las hojas de un archivo de DB y de sus derivados.
+
+    La firma se toma al abrir: si mtime y tamaño coinciden con el manifest la
+    caché es válida sin leer el archivo; si no, se compara el sha256 del
+    contenido (un archivo copiado o 'tocado' sigue siendo válido). Los derivados
+    (p. ej. las preguntas procesadas de una hoja) se guardan junto al sha de la
+    hoja de la que salen, así que solo se recalculan los de hojas que cambian.
+    Cualquier fallo de E/S degrada a 'sin caché', nunca a error.
+    """
+
+    def __init__(self, filepath, firmar=True):
+        self.filepath = os.path.abspath(filepath)
+        self.dir      = _cache_dir(filepath)
+        self._stat    = os.stat(self.filepath)
+        self._sha     = None
+        self._man     = self._leer_manifest() if _HAS_PYARROW else {}
+        self.valida   = self._validar()
+        if not self.valida:
+            self._man = {'formato': _CACHE_FORMATO, 'hojas': [], 'derivados': {}, 'tipos': {}}
+            if firmar and _HAS_PYARROW:
+                # Firmar ANTES de que el llamador lea el archivo: si cambia entre
+                # medias, la caché escrita quedará invalidada y no al revés.
+                try:
+                    self._firma()
+                except OSError:
+                    pass
+
+    def _firma(self) -> dict:
+        if self._sha is None:
+            self._sha = _hash_archivo(self.filepath)
+        return {'ruta': self.filepath, 'mtime_ns': self._stat.st_mtime_ns,
+                'size': self._stat.st_size, 'sha256': self._sha}
+
+    def _leer_manifest(self) -> dict:
+        import json
+        try:
+            with open(os.path.join(self.dir, 'manifest.json'), encoding='utf-8') as f:
+                man = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return man if isinstance(man, dict) else {}
+
+    def _validar(self) -> bool:
+        man = self._man
+        if (man.get('ruta') != self.filepath or man.get('formato') != _CACHE_FORMATO
+                or not isinstance(man.get('hojas'), list)):
+            return False   # sin caché, de otro archivo o de un formato anterior (.pkl, .json)
+        man.setdefault('derivados', {})
+        man.setdefault('tipos', {})
+        if man.get('mtime_ns') == self._stat.st_mtime_ns and man.get('size') == self._stat.st_size:
+            return True
+        try:
+            if man.get('sha256') == self._firma()['sha256']:
+                self._escribir_manifest()
+                return True
+        except OSError:
+            pass
+        return False
+
+    def _escribir_manifest(self):
+        import json
+        os.makedirs(self.dir, exist_ok=True)
+        self._man.update(self._firma())
+        ruta = os.path.join(self.dir, 'manifest.json')
+        with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self._man, f, ensure_ascii=False)
+        os.replace(ruta + '.tmp', ruta)
+
+    def _ruta_objeto(self, sha):
+        return os.path.join(self.dir, 'objetos', sha + '.feather')
+
+    def _guardar_objeto(self, df) -> str:
+        import hashlib
+        data, tipos = _hoja_a_feather(df)
+        sha  = hashlib.sha256(data).hexdigest()
+        ruta = self._ruta_objeto(sha)
+        if not os.path.exists(ruta):
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            with open(ruta + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(ruta + '.tmp', ruta)
+        self._man['tipos'][sha] = tipos
+        return sha
+
+    def _leer_objeto(self, sha) -> pd.DataFrame:
+        return _hoja_de_feather(self._ruta_objeto(sha), self._man['tipos'].get(sha, {}))
+
+    def _purgar(self):
+        """Borra los objetos que ya no referencia el manifest."""
+        vivos = {sha for _, sha in self._man['hojas']}
+        vivos.update(sha for d in self._man['derivados'].values() for _, sha in d.values())
+        self._man['tipos'] = {sha: t for sha, t in self._man['tipos'].items() if sha in vivos}
+        dir_obj = os.path.dirname(self._ruta_objeto('x'))
+        for f in os.listdir(dir_obj):
+            if f.endswith('.feather') and f[:-8] not in vivos:
+                try:
+                    os.remove(os.path.join(dir_obj, f))
+                except OSError:
+                    pass
+
+    def leer_hojas(self):
+        """LibroHojas perezoso con las hojas cacheadas, o None si la caché no es válida."""
+        if not self.valida or not self._man['hojas']:
+            return None
+        shas = dict(self._man['hojas'])
+
+        def _cargar(nombre):
+            try:
+                return self._leer_objeto(shas[nombre])
+            except (OSError, ValueError):
+                # Otra sesión guardó entre medias y purgó el objeto: leer del archivo
+                return _leer_hoja_archivo(self.filepath, nombre)
+
+        return LibroHojas.perezoso([n for n, _ in self._man['hojas']], _cargar)
+
+    def escribir_hojas(self, dict_of_dfs, hojas=None):
+        """Guarda las hojas de dict_of_dfs. Con `hojas`, solo esas (y las que no
+        estuvieran en caché); el resto conserva su entrada."""
+        if not _HAS_PYARROW:
+            return
+        try:
+            if not self.valida:
+                cache_invalidar(self.filepath)
+                self._man = {'formato': _CACHE_FORMATO, 'hojas': [], 'derivados': {}, 'tipos': {}}
+            previas = dict(self._man['hojas'])
+            nuevas  = []
+            for nombre in dict_of_dfs.keys():
+                if hojas is not None and nombre not in hojas and nombre in previas:
+                    nuevas.append([nombre, previas[nombre]])
+                else:
+                    nuevas.append([nombre, self._guardar_objeto(dict_of_dfs[nombre])])
+            self._man['hojas'] = nuevas
+            shas = dict(nuevas)
+            self._man['derivados'] = {
+                der: {h: e for h, e in por_hoja.items() if shas.get(h) == e[0]}
+                for der, por_hoja in self._man['derivados'].items()
+            }
+            self._escribir_manifest()
+            self.valida = True
+            self._purgar()
+        except Exception:
+            pass
+
+    def leer_derivado(self, nombre, hoja):
+        """Derivado `nombre` de la hoja, o None si no está o salió de otra versión de ella."""
+        if not self.valida:
+            return None
+        sha_hoja = dict(self._man['hojas']).get(hoja)
+        entrada  = self._man['derivados'].get(nombre, {}).get(hoja)
+        if not sha_hoja or not entrada or entrada[0] != sha_hoja:
+            return None
+        try:
+            return self._leer_objeto(entrada[1])
+        except (OSError, ValueError):
+            return None
+
+    def escribir_derivados(self, nombre, por_hoja: dict):
+        """Guarda {hoja: DataFrame} como derivado `nombre` de la versión cacheada de cada hoja."""
+        if not self.valida or not por_hoja:
+            return
+        try:
+            shas = dict(self._man['hojas'])
+            d = self._man['derivados'].setdefault(nombre, {})
+            for hoja, df in por_hoja.items():
+                if hoja in shas:
+                    d[hoja] = [shas[hoja], self._guardar_objeto(df)]
+            self._escribir_manifest()
+            self._purgar()
+        except Exception:
+            pass
+
+    def tras_guardar(self, dict_of_dfs, hojas=None):
+        """El archivo se acaba de escribir desde dict_of_dfs: refirma y guarda solo las
+        `hojas` modificadas (todas si None). Si la caché no era válida, se descarta."""
+        if not self.valida:
+            cache_invalidar(self.filepath)
+            return
+        try:
+            self._stat, self._sha = os.stat(self.filepath), None
+        except OSError:
+            cache_invalidar(self.filepath)
+            return
+        self.escribir_hojas(dict_of_dfs, hojas)
+
+@contextmanager
+def _cache_al_escribir(filepath, dict_of_dfs, hojas=None):
+    """Envuelve una escritura de filepath desde dict_of_dfs. Si la caché era válida
+    antes, después se actualiza con CacheLibro.tras_guardar(hojas); si no, o si la
+    escritura falla, se borra. `hojas` puede rellenarse dentro del bloque."""
+    cache = None
+    if filepath and os.path.isfile(filepath):
+        try:
+            cache = CacheLibro(filepath, firmar=False)
+        except OSError:
+            pass
+    try:
+        yield
+    except BaseException:
+        cache_invalidar(filepath)
+        raise
+    if cache is not None:
+        cache.tras_guardar(dict_of_dfs, hojas)
+    else:
+        cache_invalidar(filepath)
+
+def _escribir_xlsx(destino, dict_of_dfs):
+    """Escribe dict_of_dfs como .xlsx (ruta o buffer), equivalente a df.to_excel(index=False)
+    por hoja pero con openpyxl en modo write-only: las filas se vuelcan en streaming
+    sin construir el modelo de celdas, en menos tiempo y memoria."""
+    wb = openpyxl.Workbook(write_only=True)
+    for sheet_name, df in dict_of_dfs.items():
+        ws = wb.create_sheet(title=sheet_name)
+        ws.append(list(df.columns))
+        for fila in df.astype(object).where(pd.notna(df), None).itertuples(index=False, name=None):
+            ws.append(fila)
+    wb.save(destino)
 
 def generar_excel_bytes(dict_of_dfs) -> bytes:
     """Genera el Excel en memoria (para descarga en cloud mode o backup)."""
     import io as _io
     buf = _io.BytesIO()
-    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
-        for sheet_name, df in dict_of_dfs.items():
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    _escribir_xlsx(buf, dict_of_dfs)
     return buf.getvalue()
 
-def actualizar_pregunta_excel_local(filepath, dict_of_dfs, pid, datos):
-    """Equivalente local de actualizar_pregunta_db para archivos Excel."""
+# --- ALMACENAMIENTO SQLITE (alternativa al .xlsx) ---
+# Cada hoja del libro se guarda como filas JSON {columna: valor} en una tabla
+# según su tipo (preguntas / cfg / datos). Así se conservan cabeceras arbitrarias
+# y las ediciones de una pregunta son un UPDATE de una sola fila.
+SQLITE_EXTS = ('.db', '.sqlite', '.sqlite3')
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hojas (
+    nombre   TEXT PRIMARY KEY,
+    orden    INTEGER NOT NULL,
+    tipo     TEXT NOT NULL,
+    columnas TEXT NOT NULL,
+    fechas   TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS preguntas (
+    hoja        TEXT NOT NULL,
+    pos         INTEGER NOT NULL,
+    id_pregunta TEXT,
+    fila        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_preguntas_id   ON preguntas(id_pregunta);
+CREATE INDEX IF NOT EXISTS ix_preguntas_hoja ON preguntas(hoja, pos);
+CREATE TABLE IF NOT EXISTS cfg (
+    hoja TEXT NOT NULL,
+    pos  INTEGER NOT NULL,
+    fila TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_cfg_hoja ON cfg(hoja, pos);
+CREATE TABLE IF NOT EXISTS datos (
+    pos  INTEGER NOT NULL,
+    id   TEXT,
+    fila TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_datos_id ON datos(id);
+"""
+
+def es_ruta_sqlite(filepath) -> bool:
+    """True si la ruta apunta a una base SQLite (.db/.sqlite/.sqlite3)."""
+    return bool(filepath) and str(filepath).lower().endswith(SQLITE_EXTS)
+
+def _sqlite_abrir(filepath):
+    import sqlite3
+    con = sqlite3.connect(filepath)
+    con.executescript(_SQLITE_SCHEMA)
+    # Bases creadas antes de guardar los tipos: sin columna `fechas` (se leen como texto)
+    if 'fechas' not in {r[1] for r in con.execute("PRAGMA table_info(hojas)")}:
+        con.execute("ALTER TABLE hojas ADD COLUMN fechas TEXT NOT NULL DEFAULT '[]'")
+        con.commit()
+    return con
+
+def _tipo_hoja(sheet_name) -> str:
+    if sheet_name == DATOS_SHEET:
+        return 'datos'
+    return 'cfg' if sheet_name in CFG_SHEETS else 'preguntas'
+
+def _filas_json(df):
+    """Serializa las filas de un DataFrame como JSON (NaN/NaT → null)."""
+    import json
+    cols = [str(c) for c in df.columns]
+    vals = df.astype(object).where(pd.notna(df), None).values.tolist()
+    return [json.dumps(dict(zip(cols, v)), ensure_ascii=False, default=str) for v in vals]
+
+def _sqlite_escribir_hoja(con, sheet_name, orden, df):
+    import json
+    tipo = _tipo_hoja(sheet_name)
+    con.execute("INSERT OR REPLACE INTO hojas(nombre, orden, tipo, columnas, fechas) VALUES (?,?,?,?,?)",
+                (sheet_name, orden, tipo, json.dumps([str(c) for c in df.columns], ensure_ascii=False),
+                 json.dumps(_columnas_fecha(df), ensure_ascii=False)))
+    filas = _filas_json(df)
+    if tipo == 'preguntas':
+        con.execute("DELETE FROM preguntas WHERE hoja = ?", (sheet_name,))
+        ids = (df['ID_Pregunta'].astype(str).tolist() if 'ID_Pregunta' in df.columns
+               else [None] * len(df))
+        con.executemany("INSERT INTO preguntas(hoja, pos, id_pregunta, fila) VALUES (?,?,?,?)",
+                        [(sheet_name, i, ids[i], f) for i, f in enumerate(filas)])
+    elif tipo == 'datos':
+        con.execute("DELETE FROM datos")
+        ids = df['ID'].astype(str).tolist() if 'ID' in df.columns else [None] * len(df)
+        con.executemany("INSERT INTO datos(pos, id, fila) VALUES (?,?,?)",
+                        [(i, ids[i], f) for i, f in enumerate(filas)])
+    else:
+        con.execute("DELETE FROM cfg WHERE hoja = ?", (sheet_name,))
+        con.executemany("INSERT INTO cfg(hoja, pos, fila) VALUES (?,?,?)",
+                        [(sheet_name, i, f) for i, f in enumerate(filas)])
+
+def cargar_sqlite(filepath):
+    """Lee una base SQLite y devuelve dict {nombre_hoja: DataFrame} como cargar_excel_local."""
+    import json
+    from contextlib import closing
+    if not os.path.isfile(filepath):
+        raise FileNotFoundError(filepath)
+    dfs = LibroHojas()
+    with closing(_sqlite_abrir(filepath)) as con:
+        hojas = con.execute("SELECT nombre, tipo, columnas, fechas FROM hojas ORDER BY orden").fetchall()
+        for nombre, tipo, columnas, fechas in hojas:
+            if tipo == 'preguntas':
+                cur = con.execute("SELECT fila FROM preguntas WHERE hoja = ? ORDER BY pos, rowid", (nombre,))
+            elif tipo == 'datos':
+                cur = con.execute("SELECT fila FROM datos ORDER BY pos, rowid")
+            else:
+                cur = con.execute("SELECT fila FROM cfg WHERE hoja = ? ORDER BY pos, rowid", (nombre,))
+            cols = json.loads(columnas)
+            df   = pd.DataFrame.from_records([json.loads(f) for (f,) in cur], columns=cols)
+            dfs[nombre] = _restaurar_fechas(df, json.loads(fechas))
+    dfs.marcar_guardado()
+    return dfs
+
+def guardar_sqlite(filepath, dict_of_dfs, hojas=None):
+    """Reescribe en una transacción las hojas indicadas (todas si hojas=None).
+    Las hojas que ya no están en dict_of_dfs se eliminan de la base."""
+    from contextlib import closing
+    with _cache_al_escribir(filepath, dict_of_dfs, hojas), closing(_sqlite_abrir(filepath)) as con, con:
+        nombres = list(dict_of_dfs.keys())
+        for orden, sheet_name in enumerate(nombres):
+            if hojas is None or sheet_name in hojas:
+                _sqlite_escribir_hoja(con, sheet_name, orden, dict_of_dfs[sheet_name])
+            else:
+                con.execute("UPDATE hojas SET orden = ? WHERE nombre = ?", (orden, sheet_name))
+        if hojas is None:
+            marcas = ",".join("?" * len(nombres)) or "''"
+            con.execute(f"DELETE FROM preguntas WHERE hoja NOT IN ({marcas})", nombres)
+            con.execute(f"DELETE FROM cfg WHERE hoja NOT IN ({marcas})", nombres)
+            con.execute(f"DELETE FROM hojas WHERE nombre NOT IN ({marcas})", nombres)
+
+def sqlite_aplicar_cambios(filepath, dict_of_dfs, actualizados=(), eliminados=()):
+    """Persiste a nivel de fila: UPDATE de las preguntas `actualizados` (con su
+    contenido actual en dict_of_dfs) y DELETE de las `eliminados`."""
+    import json
+    from contextlib import closing
+    act = {str(i) for i in actualizados}
+    tocadas = set()   # hojas cuyo contenido cambia, para refrescar solo esas en la caché
+    with _cache_al_escribir(filepath, dict_of_dfs, tocadas), closing(_sqlite_abrir(filepath)) as con, con:
+        for pid in [str(i) for i in eliminados] + sorted(act):
+            tocadas.update(h for (h,) in con.execute(
+                "SELECT DISTINCT hoja FROM preguntas WHERE id_pregunta = ?", (pid,)))
+        if eliminados:
+            con.executemany("DELETE FROM preguntas WHERE id_pregunta = ?",
+                            [(str(i),) for i in eliminados])
+        if not act:
+            return
+        for sheet_name, df in dict_of_dfs.items():
+            if sheet_name in CFG_SHEETS or 'ID_Pregunta' not in df.columns:
+                continue
+            mask = df['ID_Pregunta'].astype(str).isin(act)
+            if not mask.any():
+                continue
+            con.execute("UPDATE hojas SET columnas = ?, fechas = ? WHERE nombre = ?",
+                        (json.dumps([str(c) for c in df.columns], ensure_ascii=False),
+                         json.dumps(_columnas_fecha(df), ensure_ascii=False), sheet_name))
+            tocadas.add(sheet_name)
+            sub = df[mask]
+            for pos, pid, fila in zip(sub.index, sub['ID_Pregunta'].astype(str), _filas_json(sub)):
+                cur = con.execute("UPDATE preguntas SET hoja = ?, fila = ? WHERE id_pregunta = ?",
+                                  (sheet_name, fila, pid))
+                if cur.rowcount == 0:
+                    con.execute("INSERT INTO preguntas(hoja, pos, id_pregunta, fila) VALUES (?,?,?,?)",
+                                (sheet_name, int(pos), pid, fila))
+
+def convertir_excel_a_sqlite(xlsx_path, db_path=None):
+    """Crea una base SQLite con el contenido del .xlsx. Devuelve la ruta de la base."""
+    db_path = db_path or os.path.splitext(xlsx_path)[0] + '.db'
+    guardar_sqlite(db_path, cargar_excel_local(xlsx_path))
+    return db_path
+
+def exportar_sqlite_a_excel(db_path, xlsx_path=None):
+    """Exporta explícitamente la base SQLite a .xlsx. Devuelve la ruta del Excel."""
+    xlsx_path = xlsx_path or os.path.splitext(db_path)[0] + '.xlsx'
+    _escribir_xlsx(xlsx_path, cargar_sqlite(db_path))
+    return xlsx_path
+
+# --- MUTACIONES (parches en memoria + un único guardado) ---
+def _asignar_celda(df, idx, col, valor):
+    """df.at[idx, col] = valor; si el dtype de la columna no admite el valor, la pasa a object."""
+    try:
+        df.at[idx, col] = valor
+    except (TypeError, ValueError):
+        df[col] = df[col].astype(object)
+        df.at[idx, col] = valor
+
+def _asignar_mascara(df, mask, col, valor):
+    """df.loc[mask, col] = valor con la misma tolerancia de dtype que _asignar_celda."""
     try:
-        bloque = datos['bloque']
-        if bloque not in dict_of_dfs:
+        df.loc[mask, col] = valor
+    except (TypeError, ValueError):
+        df[col] = df[col].astype(object)
+        df.loc[mask, col] = valor
+
+def _clave_columna(col):
+    """Campo de pregunta al que corresponde una cabecera (None si ninguno).
+    El orden de las comprobaciones decide las cabeceras ambiguas."""
+    cl = str(col).lower().strip()
+    if 'enunciado' in cl:                  return 'enunciado'
+    if 'tema' in cl and 'id' not in cl:    return 'tema'
+    if 'correcta' in cl or 'resp' in cl:   return 'correcta'
+    if 'dificultad' in cl:                 return 'dificultad'
+    if 'usada' in cl or 'used' in cl:      return 'usada'
+    if 'soluci' in cl:                     return 'solucion'
+    if 'nota' in cl:                       return 'notas'
+    if 'comentar' in cl:                   return 'comentario'
+    if cl == 'objetivo':                   return 'objetivo'
+    if cl == 'datos':                      return 'datos_ids'
+    return None
+
+class _HojaIndexada:
+    """Posiciones de cada ID y columnas resueltas de una hoja de preguntas.
+    Es válida mientras la hoja sea el mismo DataFrame, con las mismas columnas y filas."""
+
+    def __init__(self, df):
+        self.df       = df
+        self.columnas = df.columns
+        self.n        = len(df)
+        self.pos      = {}   # ID → primera fila
+        self.repes    = {}   # ID → filas siguientes (IDs repetidos en la hoja)
+        self.agregar(df['ID_Pregunta'].astype(str).tolist(), 0)
+        self.campos = {}
+        for col in df.columns:
+            clave = _clave_columna(col)
+            if clave:
+                self.campos.setdefault(clave, []).append(col)
+        enun = next((i for i, c in enumerate(df.columns) if 'enunciado' in str(c).lower()), None)
+        self.opciones = list(df.columns[enun + 1:]) if enun is not None else []
+
+    def vigente(self, df):
+        return df is self.df and df.columns is self.columnas and len(df) == self.n
+
+    def agregar(self, ids, inicio):
+        for i, pid in enumerate(ids, start=inicio):
+            if pid in self.pos:
+                self.repes.setdefault(pid, []).append(i)
+            else:
+                self.pos[pid] = i
+
+    def filas(self, pid):
+        if pid not in self.pos:
+            return []
+        return [self.pos[pid]] + self.repes.get(pid, [])
+
+class IndicePreguntas:
+    """ID_Pregunta → (hoja, fila) y esquema de columnas por hoja, para dict_of_dfs.
+
+    Cada hoja se indexa la primera vez que se consulta y se vuelve a indexar solo
+    si su DataFrame se sustituye o cambia de forma desde fuera. Las altas y bajas
+    hechas con TransaccionExcel actualizan el índice sin recorrer el libro.
+    """
+
+    def __init__(self, dict_of_dfs):
+        self.dfs    = dict_of_dfs
+        self._hojas = {}
+
+    def hoja(self, sheet):
+        """_HojaIndexada vigente de sheet, o None si no es una hoja de preguntas."""
+        df = self.dfs.get(sheet)
+        if sheet in CFG_SHEETS or df is None or 'ID_Pregunta' not in df.columns:
+            self._hojas.pop(sheet, None)
+            return None
+        h = self._hojas.get(sheet)
+        if h is None or not h.vigente(df):
+            h = self._hojas[sheet] = _HojaIndexada(df)
+        return h
+
+    def buscar(self, pid):
+        """(hoja, fila) de la primera aparición de pid, o None."""
+        pid = str(pid)
+        for sheet in self.dfs:
+            h = self.hoja(sheet)
+            if h is not None and pid in h.pos:
+                return sheet, h.pos[pid]
+        return None
+
+    def agrupar(self, ids):
+        """{hoja: [filas]} con todas las apariciones de los ids indicados."""
+        ids = {str(i) for i in ids}
+        grupos = {}
+        for sheet in list(self.dfs):
+            h = self.hoja(sheet)
+            if h is None:
+                continue
+            filas = [f for pid in ids for f in h.filas(pid)]
+            if filas:
+                grupos[sheet] = sorted(filas)
+        return grupos
+
+    def esquema(self, sheet):
+        """{campo: [columnas]} de la hoja ('enunciado', 'tema', 'usada'...)."""
+        h = self.hoja(sheet)
+        return h.campos if h is not None else {}
+
+    def opciones(self, sheet):
+        """Columnas de opciones (las que siguen al enunciado)."""
+        h = self.hoja(sheet)
+        return h.opciones if h is not None else []
+
+    def anotar_alta(self, sheet, df, n_previas):
+        """La hoja pasa a ser df, que añade filas al final de la anterior de n_previas filas."""
+        h = self._hojas.get(sheet)
+        if h is None or h.n != n_previas or not df.columns.equals(h.columnas):
+            self._hojas.pop(sheet, None)
+            return
+        h.agregar(df['ID_Pregunta'].iloc[n_previas:].astype(str).tolist(), n_previas)
+        h.df, h.columnas, h.n = df, df.columns, len(df)
+
+    def anotar_baja(self, sheet, df):
+        """La hoja pasa a ser df (filas eliminadas): solo se reindexa esa hoja."""
+        self._hojas[sheet] = _HojaIndexada(df)
+
+class TransaccionExcel:
+    """Acumula cambios sobre dict_of_dfs y los persiste de una vez al confirmar.
+
+    Usar a través de `transaccion(filepath, dict_of_dfs)`: al salir sin error se
+    hace una sola copia de seguridad y un solo guardado; si hay una excepción se
+    restauran las hojas tocadas y no se escribe nada.
+    """
+
+    def __init__(self, filepath, dict_of_dfs):
+        self.filepath     = filepath
+        self.dfs          = dict_of_dfs
+        self.indice       = (dict_of_dfs.indice() if isinstance(dict_of_dfs, LibroHojas)
+                             else IndicePreguntas(dict_of_dfs))
+        self.actualizados = set()
+        self.eliminados   = set()
+        self._originales  = {}
+
+    def _tocar(self, sheet):
+        if sheet not in self._originales:
+            self._originales[sheet] = self.dfs[sheet].copy()
+        if isinstance(self.dfs, LibroHojas):
+            self.dfs.marcar_sucia(sheet)
+
+    def actualizar(self, pid, datos):
+        """Parchea una pregunta. Solo se escriben los campos presentes en datos.
+        Si datos no trae 'bloque', se busca la hoja por ID. Retorna (ok, msg)."""
+        pid = str(pid)
+        bloque = datos.get('bloque')
+        if bloque is None:
+            loc = self.indice.buscar(pid)
+            if loc is None:
+                return False, "ID no encontrado"
+            bloque = loc[0]
+        if bloque not in self.dfs:
             return False, f"Bloque '{bloque}' no encontrado"
-        df = dict_of_dfs[bloque]
+        h = self.indice.hoja(bloque)
+        if h is None or pid not in h.pos:
+            return False, "ID no encontrado"
+        self._tocar(bloque)
+        df = self.dfs[bloque]
         # Asegurar columnas opcionales existen
         if not any('nota' in str(c).lower() for c in df.columns):
-            df['notas'] = ''; dict_of_dfs[bloque] = df
+            df['notas'] = ''
         if not any('soluci' in str(c).lower() for c in df.columns):
-            df['Solución'] = ''; dict_of_dfs[bloque] = df
+            df['Solución'] = ''
         if not any(str(c).lower() == 'datos' for c in df.columns):
-            df['Datos'] = ''; dict_of_dfs[bloque] = df
+            df['Datos'] = ''
         if not any('comentar' in str(c).lower() for c in df.columns):
-            df['Comentario'] = ''; dict_of_dfs[bloque] = df
+            df['Comentario'] = ''
         if not any(str(c).lower() == 'objetivo' for c in df.columns):
-            df['Objetivo'] = ''; dict_of_dfs[bloque] = df
-        mask = df['ID_Pregunta'].astype(str) == str(pid)
-        if not mask.any():
-            return False, "ID no encontrado"
-        idx = df[mask].index[0]
+            df['Objetivo'] = ''
+        h = self.indice.hoja(bloque)
+        idx = df.index[h.pos[pid]]
 
-        for col in df.columns:
-            cl = str(col).lower().strip()
-            if 'enunciado' in cl:
-                df.at[idx, col] = datos['enunciado']
-            elif 'tema' in cl and 'id' not in cl:
-                df.at[idx, col] = datos['tema']
-            elif 'correcta' in cl or 'resp' in cl:
-                df.at[idx, col] = datos['correcta']
-            elif 'dificultad' in cl:
-                df.at[idx, col] = datos['dificultad']
-            elif 'usada' in cl or 'used' in cl:
-                if datos.get('usada'):
-                    df.at[idx, col] = datos['usada']
-            elif 'soluci' in cl:
-                if 'solucion' in datos:
-                    df.at[idx, col] = datos['solucion']
-            elif 'nota' in cl:
-                df.at[idx, col] = datos.get('notas', '')
-            elif 'comentar' in cl:
-                df.at[idx, col] = datos.get('comentario', '')
-            elif cl == 'objetivo':
-                df.at[idx, col] = datos.get('objetivo', '')
-            elif cl == 'datos':
-                df.at[idx, col] = datos.get('datos_ids', '')
+        for clave, cols in h.campos.items():
+            if clave == 'usada' and not datos.get('usada'):
+                continue
+            if clave in datos:
+                for col in cols:
+                    _asignar_celda(df, idx, col, datos[clave])
 
         # Actualizar opciones (columnas después de Enunciado)
-        enun_col_idx = None
-        for i, col in enumerate(df.columns):
-            if 'enunciado' in str(col).lower():
-                enun_col_idx = i
-                break
-        if enun_col_idx is not None:
-            for j, op in enumerate(datos['opciones']):
-                op_col_idx = enun_col_idx + 1 + j
-                if op_col_idx < len(df.columns):
-                    df.iat[idx, op_col_idx] = op
+        for col, op in zip(h.opciones, datos.get('opciones', [])):
+            _asignar_celda(df, idx, col, op)
 
-        guardar_excel_local(filepath, dict_of_dfs)
+        self.actualizados.add(pid)
         return True, "Actualizado correctamente"
+
+    def _mascara(self, sheet, filas):
+        mask = np.zeros(len(self.dfs[sheet]), dtype=bool)
+        mask[filas] = True
+        return pd.Series(mask, index=self.dfs[sheet].index)
+
+    def actualizar_campo(self, ids, campo, valor):
+        """Pone tema o dificultad = valor en las preguntas indicadas. Retorna el nº de cambios."""
+        count = 0
+        for sheet, filas in self.indice.agrupar(ids).items():
+            cols = self.indice.esquema(sheet).get(campo, [])
+            if not cols:
+                continue
+            self._tocar(sheet)
+            df   = self.dfs[sheet]
+            mask = self._mascara(sheet, filas)
+            for col in cols:
+                _asignar_mascara(df, mask, col, valor)
+                count += len(filas)
+            self.actualizados.update(df['ID_Pregunta'].iloc[filas].astype(str))
+        return count
+
+    def reemplazar_texto(self, ids, buscar, reemplazar_con):
+        """Find & replace en el enunciado de las preguntas indicadas. Retorna el nº de preguntas."""
+        count = 0
+        for sheet, filas in self.indice.agrupar(ids).items():
+            cols = self.indice.esquema(sheet).get('enunciado', [])
+            if not cols:
+                continue
+            self._tocar(sheet)
+            df, col = self.dfs[sheet], cols[0]
+            mask = self._mascara(sheet, filas)
+            _asignar_mascara(df, mask, col,
+                             df.loc[mask, col].astype(str)
+                             .str.replace(buscar, reemplazar_con, regex=False))
+            count += len(filas)
+            self.actualizados.update(df['ID_Pregunta'].iloc[filas].astype(str))
+        return count
+
+    def insertar(self, bloque, filas):
+        """Añade al final de la hoja bloque las filas indicadas (dicts columna → valor).
+        Si la hoja no existe se crea. Retorna el nº de filas añadidas."""
+        if not filas:
+            return 0
+        if bloque not in self.dfs:
+            self._originales[bloque] = None   # deshacer() la quitará
+            self.dfs[bloque] = pd.DataFrame(columns=list(filas[0]))
+        self._tocar(bloque)
+        df    = self.dfs[bloque]
+        nuevo = pd.concat([df, pd.DataFrame(filas)], ignore_index=True)
+        self.dfs[bloque] = nuevo
+        self.indice.anotar_alta(bloque, nuevo, len(df))
+        if 'ID_Pregunta' in nuevo.columns:
+            self.actualizados.update(nuevo['ID_Pregunta'].iloc[len(df):].astype(str))
+        return len(filas)
+
+    def eliminar(self, ids):
+        """Elimina las preguntas indicadas de todas las hojas. Retorna el nº eliminado."""
+        ids_set = set(str(i) for i in ids)
+        count = 0
+        for sheet, filas in self.indice.agrupar(ids_set).items():
+            self._tocar(sheet)
+            df = self.dfs[sheet]
+            count += len(filas)
+            nuevo = df[~self._mascara(sheet, filas)].reset_index(drop=True)
+            self.dfs[sheet] = nuevo
+            self.indice.anotar_baja(sheet, nuevo)
+        self.eliminados |= ids_set
+        self.actualizados -= ids_set
+        return count
+
+    def registrar_uso(self, ids, fecha, examen=''):
+        """Añade al historial de uso una fila (ID, fecha, examen) por pregunta.
+        A diferencia de la columna 'usada', el historial conserva todos los usos."""
+        return self.insertar(HISTORIAL_USO_SHEET, [
+            {'ID_Pregunta': str(pid), 'Fecha': fecha, 'Examen': examen} for pid in ids])
+
+    def confirmar(self):
+        """Una copia de seguridad y un guardado para todo lo acumulado.
+        En SQLite se actualizan solo las filas afectadas."""
+        if not self._originales:
+            return
+        if es_ruta_sqlite(self.filepath) and _hojas_sucias(self.dfs) is not None:
+            almacen = AlmacenBackups(self.filepath)
+            almacen.asegurar_estado_en_disco()
+            sqlite_aplicar_cambios(self.filepath, self.dfs, self.actualizados, self.eliminados)
+            cfg = [s for s in self._originales if s in CFG_SHEETS and s in self.dfs]
+            if cfg:   # p. ej. el historial de uso: no tiene filas por pregunta
+                guardar_sqlite(self.filepath, self.dfs, hojas=cfg)
+            almacen.registrar(self.dfs, hojas=set(self._originales))
+        else:
+            guardar_excel_local(self.filepath, self.dfs)
+        self._originales = {}
+
+    def deshacer(self):
+        """Restaura en dict_of_dfs las hojas tocadas por la transacción
+        (las creadas por ella se quitan)."""
+        for sheet, df in self._originales.items():
+            if df is None:
+                self.dfs.pop(sheet, None)
+            else:
+                self.dfs[sheet] = df
+        self._originales = {}
+
+@contextmanager
+def transaccion(filepath, dict_of_dfs):
+    """with transaccion(path, dfs) as tx: tx.actualizar(...); ... → un solo guardado al salir."""
+    tx = TransaccionExcel(filepath, dict_of_dfs)
+    try:
+        yield tx
+    except BaseException:
+        tx.deshacer()
+        raise
+    tx.confirmar()
+
+def actualizar_pregunta_excel_local(filepath, dict_of_dfs, pid, datos):
+    """Equivalente local de actualizar_pregunta_db para archivos Excel.
+    Solo se escriben los campos presentes en datos."""
+    try:
+        with transaccion(filepath, dict_of_dfs) as tx:
+            ok, msg = tx.actualizar(pid, datos)
+        return ok, msg
     except Exception as e:
         return False, str(e)
 
 def eliminar_preguntas_excel_local(filepath, dict_of_dfs, ids):
     """Elimina varias preguntas por ID de todas las hojas del Excel."""
     try:
-        backup_excel(filepath)
-        ids_set = set(str(i) for i in ids)
-        count = 0
-        for sheet in list(dict_of_dfs.keys()):
-            df = dict_of_dfs[sheet]
-            if 'ID_Pregunta' not in df.columns:
-                continue
-            mask = df['ID_Pregunta'].astype(str).isin(ids_set)
-            count += int(mask.sum())
-            dict_of_dfs[sheet] = df[~mask].reset_index(drop=True)
-        guardar_excel_local(filepath, dict_of_dfs)
+        with transaccion(filepath, dict_of_dfs) as tx:
+            count = tx.eliminar(ids)
         return True, f"{count} pregunta(s) eliminada(s)"
     except Exception as e:
         return False, str(e)
@@ -162,24 +1345,8 @@ def eliminar_preguntas_excel_local(filepath, dict_of_dfs, ids):
 def actualizar_campo_masivo(filepath, dict_of_dfs, ids, campo, valor):
     """Actualiza tema o dificultad para múltiples preguntas a la vez."""
     try:
-        backup_excel(filepath)
-        ids_set = set(str(i) for i in ids)
-        count = 0
-        for sheet, df in dict_of_dfs.items():
-            if 'ID_Pregunta' not in df.columns:
-                continue
-            mask = df['ID_Pregunta'].astype(str).isin(ids_set)
-            if not mask.any():
-                continue
-            for col in df.columns:
-                cl = str(col).lower().strip()
-                if campo == 'tema' and 'tema' in cl and 'id' not in cl:
-                    dict_of_dfs[sheet].loc[mask, col] = valor
-                    count += int(mask.sum())
-                elif campo == 'dificultad' and 'dificultad' in cl:
-                    dict_of_dfs[sheet].loc[mask, col] = valor
-                    count += int(mask.sum())
-        guardar_excel_local(filepath, dict_of_dfs)
+        with transaccion(filepath, dict_of_dfs) as tx:
+            count = tx.actualizar_campo(ids, campo, valor)
         return True, f"{count} pregunta(s) actualizadas → {campo}='{valor}'"
     except Exception as e:
         return False, str(e)
@@ -187,24 +1354,8 @@ def actualizar_campo_masivo(filepath, dict_of_dfs, ids, campo, valor):
 def reemplazar_texto_masivo(filepath, dict_of_dfs, ids, buscar, reemplazar_con):
     """Find & replace en el enunciado de las preguntas indicadas."""
     try:
-        backup_excel(filepath)
-        ids_set = set(str(i) for i in ids)
-        count = 0
-        for sheet, df in dict_of_dfs.items():
-            if 'ID_Pregunta' not in df.columns:
-                continue
-            mask = df['ID_Pregunta'].astype(str).isin(ids_set)
-            if not mask.any():
-                continue
-            for col in df.columns:
-                if 'enunciado' in str(col).lower():
-                    dict_of_dfs[sheet].loc[mask, col] = (
-                        df.loc[mask, col].astype(str)
-                        .str.replace(buscar, reemplazar_con, regex=False)
-                    )
-                    count += int(mask.sum())
-                    break
-        guardar_excel_local(filepath, dict_of_dfs)
+        with transaccion(filepath, dict_of_dfs) as tx:
+            count = tx.reemplazar_texto(ids, buscar, reemplazar_con)
         return True, f"Texto reemplazado en {count} pregunta(s)"
     except Exception as e:
         return False, str(e)
@@ -233,34 +1384,799 @@ def _normalizar_texto(t: str) -> str:
     return " ".join(t.split())
 
 
-def check_for_similar_enunciado(text, df):
-    if df.empty: return False, 0.0
+# --- ÍNDICE DE SIMILITUD (MinHash + LSH) ---
+SIMILITUD_DUPLICADO = 0.85   # ratio de SequenceMatcher a partir del cual se descarta
+
+class IndiceSimilitud:
+    """Índice de enunciados para detectar casi-duplicados sin comparar con toda la DB.
+
+    Cada enunciado se normaliza una vez, se trocea en k-gramas de caracteres y se
+    resume en una firma MinHash; las firmas se reparten en bandas (LSH) de modo que
+    solo los enunciados que coinciden en alguna banda son candidatos. La similitud
+    final es el mismo ratio de SequenceMatcher de siempre, pero solo sobre esos
+    candidatos. Admite altas, cambios y bajas sueltas (añadir/eliminar) y
+    sincronizar(df) para ponerse al día con un DataFrame aplicando solo diferencias.
+    """
+
+    _PRIMO = (1 << 31) - 1
+
+    def __init__(self, num_perm: int = 64, bandas: int = 16, k: int = 4, semilla: int = 1):
+        assert num_perm % bandas == 0
+        import difflib
+        self._SequenceMatcher = difflib.SequenceMatcher
+        self.k = k
+        self.bandas = bandas
+        self.filas_banda = num_perm // bandas
+        rng = np.random.default_rng(semilla)
+        self._a = rng.integers(1, self._PRIMO, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, self._PRIMO, size=num_perm, dtype=np.uint64)
+        self._crudo = {}      # id -> texto original (para detectar cambios)
+        self._norm = {}       # id -> texto normalizado
+        self._claves = {}     # id -> claves LSH de cada banda
+        self._cubetas = [{} for _ in range(bandas)]   # clave -> set(ids)
+        self.version = None   # la fija quien lo mantiene (p. ej. db_version)
+        self.cubetas_omitidas = []   # [(banda, tamaño)] del último pares_candidatos()
+
+    def __len__(self):
+        return len(self._norm)
+
+    def __contains__(self, pid):
+        return pid in self._norm
+
+    @classmethod
+    def desde_df(cls, df, col_texto='enunciado', col_id='ID_Pregunta', **kw):
+        idx = cls(**kw)
+        idx.sincronizar(df, col_texto, col_id)
+        return idx
+
+    def _firma(self, norm: str) -> np.ndarray:
+        import zlib
+        k = self.k
+        tejas = {norm[i:i + k] for i in range(max(1, len(norm) - k + 1))}
+        h = np.fromiter((zlib.crc32(t.encode('utf-8')) for t in tejas),
+                        dtype=np.uint64, count=len(tejas)) % self._PRIMO
+        return ((self._a[:, None] * h[None, :] + self._b[:, None]) % self._PRIMO).min(axis=1)
+
+    def _claves_lsh(self, firma: np.ndarray) -> list:
+        r = self.filas_banda
+        return [firma[i * r:(i + 1) * r].tobytes() for i in range(self.bandas)]
+
+    def añadir(self, pid, texto):
+        """Alta o cambio de un enunciado."""
+        texto = '' if texto is None else str(texto)
+        if self._crudo.get(pid) == texto and pid in self._norm:
+            return
+        self.eliminar(pid)
+        norm = _normalizar_texto(texto)
+        self._crudo[pid] = texto
+        self._norm[pid] = norm
+        if not norm:
+            return
+        claves = self._claves_lsh(self._firma(norm))
+        self._claves[pid] = claves
+        for cubeta, clave in zip(self._cubetas, claves):
+            cubeta.setdefault(clave, set()).add(pid)
+
+    def eliminar(self, pid):
+        self._crudo.pop(pid, None)
+        self._norm.pop(pid, None)
+        for cubeta, clave in zip(self._cubetas, self._claves.pop(pid, ())):
+            ids = cubeta.get(clave)
+            if ids is not None:
+                ids.discard(pid)
+                if not ids:
+                    del cubeta[clave]
+
+    def sincronizar(self, df, col_texto='enunciado', col_id='ID_Pregunta'):
+        """Deja el índice igual que df tocando solo altas, cambios y bajas."""
+        if df is None or df.empty or col_texto not in df.columns:
+            actuales = {}
+        elif col_id in df.columns:
+            actuales = dict(zip(df[col_id].astype(str), df[col_texto].fillna('').astype(str)))
+        else:
+            actuales = dict(enumerate(df[col_texto].fillna('').astype(str)))
+        for pid in [p for p in self._crudo if p not in actuales]:
+            self.eliminar(pid)
+        for pid, texto in actuales.items():
+            if self._crudo.get(pid) != texto:
+                self.añadir(pid, texto)
+        return self
+
+    def pares_candidatos(self, max_cubeta: int = 200) -> set:
+        """Pares (a, b), a < b, que comparten al menos una cubeta LSH.
+
+        Una cubeta de n ids aporta n·(n-1)/2 pares, así que las de más de
+        `max_cubeta` ids (texto repetitivo o plantillas comunes que colapsan una
+        banda) se omiten con un aviso: los casi-duplicados reales coinciden en
+        varias bandas y siguen apareciendo por las demás. Las omitidas quedan en
+        `self.cubetas_omitidas` como [(banda, tamaño)]. max_cubeta=None no limita.
+        """
+        from itertools import combinations
+        pares = set()
+        self.cubetas_omitidas = []
+        for banda, cubeta in enumerate(self._cubetas):
+            for ids in cubeta.values():
+                if max_cubeta is not None and len(ids) > max_cubeta:
+                    self.cubetas_omitidas.append((banda, len(ids)))
+                elif len(ids) > 1:
+                    pares.update(combinations(sorted(ids, key=str), 2))
+        if self.cubetas_omitidas:
+            import warnings
+            warnings.warn(f"IndiceSimilitud: {len(self.cubetas_omitidas)} cubeta(s) LSH con más de "
+                          f"{max_cubeta} enunciados omitidas (la mayor, "
+                          f"{max(n for _, n in self.cubetas_omitidas)})", RuntimeWarning, stacklevel=2)
+        return pares
+
+    def similares(self, texto, k: int = 5, umbral: float = 0.0, excluir=None,
+                  exacto: bool = False) -> list:
+        """Hasta k enunciados más parecidos como [(id, similitud)], de mayor a menor,
+        con similitud >= umbral. `excluir` omite un id (p. ej. la propia pregunta).
+
+        Por defecto solo puntúa los candidatos LSH, así que puede no ver un
+        enunciado parecido que no coincida en ninguna banda (pasa con cambios
+        repartidos por todo el texto; ~1% de los casi-duplicados por encima de
+        SIMILITUD_DUPLICADO en un corpus de prueba). exacto=True puntúa además
+        el resto del índice, detrás de los candidatos: mismo resultado que
+        comparar con todos, y las cotas descartan casi todo en cuanto sube el corte."""
+        norm = _normalizar_texto(texto)
+        if not norm or not self._norm:
+            return []
+        import heapq
+        from collections import Counter
+        votos = Counter()
+        for cubeta, clave in zip(self._cubetas, self._claves_lsh(self._firma(norm))):
+            votos.update(cubeta.get(clave, ()))
+        votos.pop(excluir, None)
+        orden = [pid for pid, _ in votos.most_common()]
+        if exacto:
+            orden += [pid for pid in self._norm if pid not in votos and pid != excluir]
+        # Los que coinciden en más bandas primero: así el corte sube pronto y las
+        # cotas superiores (real_quick_ratio/quick_ratio) descartan al resto
+        mejores = []   # montículo de (similitud, id) con los k mejores
+        sm = self._SequenceMatcher(None, norm, '')
+        for pid in orden:
+            corte = max(umbral, mejores[0][0]) if len(mejores) >= k else umbral
+            sm.set_seq2(self._norm[pid])
+            if sm.real_quick_ratio() < corte or sm.quick_ratio() < corte:
+                continue
+            r = sm.ratio()
+            if r >= corte:
+                if len(mejores) >= k:
+                    heapq.heapreplace(mejores, (r, pid))
+                else:
+                    heapq.heappush(mejores, (r, pid))
+        return [(pid, r) for r, pid in sorted(mejores, key=lambda t: -t[0])]
+
+def _comparar_pares(lote, umbral, umbral_opciones):
+    """Compara un lote de pares (id_a, id_b, enun_a, enun_b, ops_a, ops_b) y
+    retorna los que superan ambos umbrales como (id_a, id_b, sim_enun, sim_ops).
+    Nivel de módulo para poder ejecutarse en otro proceso."""
     from difflib import SequenceMatcher
-    norm = _normalizar_texto(text)
-    if not norm: return False, 0.0
-    if 'enunciado' not in df.columns: return False, 0.0
-    sims = df['enunciado'].astype(str).apply(
-        lambda x: SequenceMatcher(None, norm, _normalizar_texto(x)).ratio()
-    )
-    max_sim = sims.max()
-    return (max_sim > 0.85, max_sim)
+    res = []
+    sm = SequenceMatcher(None, '', '')
+    for a, b, ea, eb, oa, ob in lote:
+        sm.set_seqs(ea, eb)
+        if sm.real_quick_ratio() < umbral or sm.quick_ratio() < umbral:
+            continue
+        se = sm.ratio()
+        if se < umbral:
+            continue
+        if oa or ob:
+            sm.set_seqs(oa, ob)
+            so = sm.ratio() if sm.quick_ratio() >= umbral_opciones else 0.0
+        else:
+            so = 1.0
+        if so >= umbral_opciones:
+            res.append((a, b, se, so))
+    return res
+
+def auditar_duplicados(df, umbral=SIMILITUD_DUPLICADO, umbral_opciones=0.0,
+                       indice=None, procesos=None, tam_lote=2000, min_pares_procesos=20000,
+                       max_cubeta=200):
+    """Busca grupos de preguntas casi idénticas en todo el banco.
+
+    Solo se comparan los pares que comparten alguna cubeta LSH del índice de
+    similitud (sin las cubetas de más de `max_cubeta` ids, ver
+    IndiceSimilitud.pares_candidatos). Con menos de `min_pares_procesos` pares
+    se comparan en este mismo proceso: arrancar procesos 'spawn' (reimportan
+    pandas y esta librería) cuesta más que la comparación en bancos pequeños y
+    se pagaría en cada rerun de Streamlit. Por encima, los pares se reparten en
+    lotes entre `procesos` procesos (por defecto, uno por núcleo). Un par es
+    duplicado si el ratio de los enunciados >= umbral y el de las opciones >=
+    umbral_opciones.
+    Retorna una lista de grupos, de mayor a menor:
+    [{"ids": [...], "sim_enunciado": min, "sim_opciones": min,
+      "preguntas": [{ID_Pregunta, bloque, Tema, usada, enunciado}, ...]}, ...]
+    """
+    if df is None or df.empty or 'enunciado' not in df.columns:
+        return []
+    if indice is None:
+        indice = IndiceSimilitud.desde_df(df)
+    filas = df.drop_duplicates('ID_Pregunta')
+    filas = filas.set_index(filas['ID_Pregunta'].astype(str))
+    if 'opciones_list' in filas.columns:
+        opciones = {pid: ' | '.join(sorted(_normalizar_texto(o) for o in (ops or []) if str(o).strip()))
+                    for pid, ops in filas['opciones_list'].items()}
+    else:
+        opciones = {}
+    pares = [(a, b, indice._norm[a], indice._norm[b], opciones.get(a, ''), opciones.get(b, ''))
+             for a, b in indice.pares_candidatos(max_cubeta) if a in filas.index and b in filas.index]
+    lotes = [pares[i:i + tam_lote] for i in range(0, len(pares), tam_lote)]
+    procesos = procesos or os.cpu_count() or 1
+    encontrados = []
+    if procesos > 1 and len(lotes) > 1 and len(pares) >= min_pares_procesos:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(procesos, len(lotes)),
+                                 mp_context=multiprocessing.get_context('spawn')) as ex:
+            for r in ex.map(_comparar_pares, lotes, [umbral] * len(lotes),
+                            [umbral_opciones] * len(lotes)):
+                encontrados.extend(r)
+    else:
+        for lote in lotes:
+            encontrados.extend(_comparar_pares(lote, umbral, umbral_opciones))
+
+    # Grupos = componentes conexas de los pares duplicados (union-find)
+    padre = {}
+    def raiz(x):
+        while padre.setdefault(x, x) != x:
+            padre[x] = padre[padre[x]]
+            x = padre[x]
+        return x
+    for a, b, _, _ in encontrados:
+        padre[raiz(a)] = raiz(b)
+    grupos = {}
+    for a, b, se, so in encontrados:
+        g = grupos.setdefault(raiz(a), {"ids": set(), "sim_enunciado": 1.0, "sim_opciones": 1.0})
+        g["ids"].update((a, b))
+        g["sim_enunciado"] = min(g["sim_enunciado"], se)
+        g["sim_opciones"] = min(g["sim_opciones"], so)
+    cols = [c for c in ('bloque', 'Tema', 'usada', 'enunciado') if c in filas.columns]
+    res = []
+    for g in grupos.values():
+        ids = sorted(g["ids"])
+        preguntas = []
+        for pid in ids:
+            fila = {'ID_Pregunta': pid}
+            fila.update({c: filas.at[pid, c] for c in cols})
+            preguntas.append(fila)
+        res.append({"ids": ids, "sim_enunciado": g["sim_enunciado"],
+                    "sim_opciones": g["sim_opciones"], "preguntas": preguntas})
+    res.sort(key=lambda g: (-len(g["ids"]), -g["sim_enunciado"]))
+    return res
+
+# --- ÍNDICE DE BÚSQUEDA DE TEXTO ---
+CAMPOS_BUSQUEDA = ('enunciado', 'opciones_list', 'solucion', 'notas', 'comentario')
+
+class IndiceTexto:
+    """Índice invertido de palabras de las preguntas, insensible a tildes y mayúsculas.
+
+    Vocabulario ordenado + todas las listas de filas concatenadas en ese orden:
+    las palabras que empiezan por un prefijo son un tramo contiguo del vocabulario
+    y sus filas un tramo contiguo de `_filas`, así que cada término de la consulta
+    se resuelve con dos búsquedas binarias y una asignación numpy.
+    """
+
+    def __init__(self, df, campos=CAMPOS_BUSQUEDA, col_id='ID_Pregunta'):
+        import bisect
+        self._bisect = bisect
+        n = 0 if df is None else len(df)
+        self.n = n
+        self.ids = (df[col_id].astype(str).to_numpy() if n and col_id in df.columns
+                    else np.array([], dtype=object))
+        self.version = None
+        if not n:
+            self.vocab, self._filas, self._offsets = [], np.array([], dtype=np.int32), np.zeros(1, np.int64)
+            return
+        partes = []
+        for c in campos:
+            if c not in df.columns:
+                continue
+            col = df[c]
+            if c == 'opciones_list':
+                col = col.map(lambda ops: ' '.join(map(str, ops)) if isinstance(ops, (list, tuple)) else '')
+            partes.append(col.fillna('').astype(str).reset_index(drop=True))
+        if not partes:
+            self.vocab, self._filas, self._offsets = [], np.array([], dtype=np.int32), np.zeros(1, np.int64)
+            return
+        texto = partes[0].str.cat(partes[1:], sep=' ') if len(partes) > 1 else partes[0]
+        tokens = texto.str.lower().str.findall(r'\w+').explode().dropna().astype(str)
+        filas = tokens.index.to_numpy(dtype=np.int64)
+        # Las tildes se quitan una vez por palabra distinta, no por cada aparición
+        codigos, crudas = pd.factorize(tokens)
+        cod_norm, vocab = pd.factorize(pd.Series([_normalizar_texto(w) for w in crudas]), sort=True)
+        codigos = cod_norm[codigos].astype(np.int64)
+        # Pares (palabra, fila) únicos, ordenados por palabra y luego por fila
+        clave = np.sort(codigos * n + filas)
+        clave = clave[np.r_[True, clave[1:] != clave[:-1]]]
+        cod_ord = clave // n
+        self._filas = (clave % n).astype(np.int32)
+        self._offsets = np.searchsorted(cod_ord, np.arange(len(vocab) + 1))
+        self.vocab = list(vocab)
+
+    def __len__(self):
+        return self.n
+
+    @staticmethod
+    def terminos(consulta: str) -> list:
+        return [_normalizar_texto(w) for w in re.findall(r'\w+', str(consulta).lower())]
+
+    def _tramo(self, prefijo: str) -> slice:
+        i = self._bisect.bisect_left(self.vocab, prefijo)
+        j = self._bisect.bisect_left(self.vocab, prefijo + '\uffff', lo=i)
+        return slice(self._offsets[i], self._offsets[j])
+
+    def mascara(self, consulta: str) -> np.ndarray:
+        """Máscara booleana (una posición por fila del DataFrame indexado) de las
+        filas que contienen, para cada término, alguna palabra que empieza por él.
+        Una consulta sin términos selecciona todas las filas."""
+        res = np.ones(self.n, dtype=bool)
+        for t in self.terminos(consulta):
+            m = np.zeros(self.n, dtype=bool)
+            m[self._filas[self._tramo(t)]] = True
+            res &= m
+            if not res.any():
+                break
+        return res
+
+    def buscar(self, consulta: str) -> np.ndarray:
+        """IDs de las preguntas que cumplen la consulta (ver mascara)."""
+        return self.ids[self.mascara(consulta)]
+
+    # ── Búsqueda aproximada por trigramas (tolerante a erratas) ──
+    @staticmethod
+    def _trigramas(palabra: str) -> set:
+        p = f"  {palabra} "
+        return {p[i:i + 3] for i in range(len(p) - 2)}
+
+    def _indice_trigramas(self):
+        """Trigrama -> palabras del vocabulario que lo contienen (se crea al primer uso)."""
+        if getattr(self, '_tri', None) is None:
+            pal, tri = [], []
+            for i, w in enumerate(self.vocab):
+                for t in self._trigramas(w):
+                    pal.append(i)
+                    tri.append(t)
+            codigos, trigramas = pd.factorize(pd.Series(tri, dtype=object), sort=True)
+            orden = np.argsort(codigos, kind='stable')
+            self._tri = {t: i for i, t in enumerate(trigramas)}
+            self._tri_pal = np.asarray(pal, dtype=np.int32)[orden]
+            self._tri_off = np.searchsorted(codigos[orden], np.arange(len(trigramas) + 1))
+            self._tri_n = np.bincount(np.asarray(pal, dtype=np.int64), minlength=len(self.vocab))
+        return self._tri
+
+    def palabras_parecidas(self, termino: str, umbral: float = 0.35) -> list:
+        """[(índice en vocab, similitud)] de las palabras cuyo coeficiente de
+        Jaccard de trigramas con `termino` es >= umbral."""
+        tri = self._indice_trigramas()
+        if not self.vocab:
+            return []
+        q = self._trigramas(termino)
+        codigos = [tri[t] for t in q if t in tri]
+        if not codigos:
+            return []
+        pal = np.concatenate([self._tri_pal[self._tri_off[c]:self._tri_off[c + 1]] for c in codigos])
+        comunes = np.bincount(pal, minlength=len(self.vocab))
+        cand = np.nonzero(comunes)[0]
+        sim = comunes[cand] / (len(q) + self._tri_n[cand] - comunes[cand])
+        ok = sim >= umbral
+        return list(zip(cand[ok].tolist(), sim[ok].tolist()))
+
+    def buscar_aproximado(self, consulta: str, umbral: float = 0.35) -> tuple:
+        """Búsqueda tolerante a erratas: cada término puntúa una pregunta con la
+        mayor similitud de trigramas entre él y las palabras de la pregunta; deben
+        puntuar todos y se ordena por la media. Retorna (ids, puntuaciones) de
+        mayor a menor puntuación."""
+        terminos = self.terminos(consulta)
+        if not terminos or not self.n:
+            return self.ids[:0], np.array([])
+        total = np.zeros(self.n)
+        vivas = np.ones(self.n, dtype=bool)
+        for t in terminos:
+            mejor = np.zeros(self.n)
+            for i, sim in self.palabras_parecidas(t, umbral):
+                filas = self._filas[self._offsets[i]:self._offsets[i + 1]]
+                mejor[filas] = np.maximum(mejor[filas], sim)
+            vivas &= mejor > 0
+            total += mejor
+            if not vivas.any():
+                break
+        pos = np.nonzero(vivas)[0]
+        punt = total[pos] / len(terminos)
+        orden = np.argsort(-punt, kind='stable')
+        return self.ids[pos[orden]], punt[orden]
+
+# --- ÍNDICE DE FACETAS (filtros de selección) ---
+def columna_fecha_uso(df) -> pd.Series:
+    """Fecha de último uso tipada (datetime64, NaT = nunca usada o fecha no válida).
+    Usa la columna 'fecha_uso' si ya existe; si no, la deriva de 'usada' ('AAAA-MM-DD')."""
+    if 'fecha_uso' in df.columns and pd.api.types.is_datetime64_any_dtype(df['fecha_uso']):
+        return df['fecha_uso']
+    usada = df['usada'] if 'usada' in df.columns else pd.Series('', index=df.index)
+    return pd.to_datetime(usada.fillna('').astype(str).str.split(' ').str[0],
+                          format='%Y-%m-%d', errors='coerce')
+
+def uso_anterior_a(fechas, meses, ahora=None) -> np.ndarray:
+    """Máscara de las fechas de uso anteriores a hace `meses` meses (de 30 días).
+    Versión vectorizada de app_utils.es_uso_antiguo; NaT cuenta como False."""
+    import datetime as _dt
+    ahora = ahora or _dt.datetime.now()
+    limite = np.datetime64(ahora - _dt.timedelta(days=meses * 30), 'ns')
+    return np.asarray(fechas, dtype='datetime64[ns]') < limite
+
+class IndiceFacetas:
+    """Máscaras precalculadas de df_preguntas para los filtros habituales.
+
+    Por cada faceta (bloque, tema, dificultad, comentario, objetivo) se guarda el
+    código de cada fila y una máscara booleana por valor, de modo que combinar
+    filtros es un AND de arrays y los recuentos de un desplegable salen de un
+    np.bincount. Las posiciones son las de las filas del DataFrame indexado.
+    """
+
+    # faceta -> (columna, transformación aplicada antes de comparar)
+    FACETAS = {
+        'bloque':     ('bloque', None),
+        'tema':       ('Tema', str),
+        'dificultad': ('dificultad', str.lower),
+        'comentario': ('comentario', None),
+        'objetivo':   ('objetivo', str),
+    }
+
+    def __init__(self, df):
+        self.n = 0 if df is None else len(df)
+        self.valores = {}      # faceta -> array de valores distintos
+        self._codigos = {}     # faceta -> código de cada fila (-1 = vacío/nulo)
+        self._mascaras = {}    # faceta -> {valor: máscara}
+        self.ids = (df['ID_Pregunta'].astype(str).to_numpy() if self.n
+                    else np.array([], dtype=object))
+        if not self.n:
+            self.usada = self.con_solucion = np.zeros(0, dtype=bool)
+            self.fecha_uso = np.array([], dtype='datetime64[ns]')
+            self.fechas_examen = self.fecha_uso
+            return
+        for faceta, (col, f) in self.FACETAS.items():
+            if col not in df.columns:
+                continue
+            serie = df[col]
+            if f is str:
+                serie = serie.astype(str)
+            elif f is str.lower:
+                serie = serie.astype(str).str.lower()
+            codigos, valores = pd.factorize(serie)
+            self._codigos[faceta] = codigos.astype(np.int32)
+            self.valores[faceta] = np.asarray(valores, dtype=object)
+            self._mascaras[faceta] = {v: codigos == k for k, v in enumerate(self.valores[faceta])}
+        usada = df['usada'].fillna('').astype(str) if 'usada' in df.columns else pd.Series([''] * self.n)
+        self.usada = usada.ne('').to_numpy()
+        self.fecha_uso = columna_fecha_uso(df).to_numpy(dtype='datetime64[ns]')
+        # Fechas de uso distintas, de la más reciente a la más antigua: cada examen
+        # marca sus preguntas con su fecha, así que equivalen a los exámenes pasados.
+        fechas = self.fecha_uso[~np.isnat(self.fecha_uso)]
+        self.fechas_examen = np.sort(pd.unique(fechas))[::-1]
+        if 'solucion' in df.columns:
+            sol = df['solucion'].fillna('').astype(str)
+            self.con_solucion = (sol.str.strip().ne('') & ~sol.isin(['nan', 'None'])).to_numpy()
+        else:
+            self.con_solucion = np.zeros(self.n, dtype=bool)
+
+    def __len__(self):
+        return self.n
+
+    def _faceta(self, faceta: str, valor) -> np.ndarray:
+        col, f = self.FACETAS[faceta]
+        if f is str:
+            valor = str(valor)
+        elif f is str.lower:
+            valor = str(valor).lower()
+        m = self._mascaras.get(faceta, {}).get(valor)
+        return m if m is not None else np.zeros(self.n, dtype=bool)
+
+    def mascara(self, bloque=None, tema=None, dificultad=None, comentario=None, objetivo=None,
+                usada=None, antes_de_meses=None, ultimos_examenes=None,
+                con_solucion=None) -> np.ndarray:
+        """Máscara de las filas que cumplen todos los filtros dados (None = sin filtro).
+        usada: True/False; antes_de_meses: usada por última vez hace más de N meses
+        (mismo criterio que app_utils.es_uso_antiguo); ultimos_examenes: usada en
+        alguno de los N últimos exámenes (fechas de uso distintas); con_solucion: True/False."""
+        res = np.ones(self.n, dtype=bool)
+        for faceta, valor in (('bloque', bloque), ('tema', tema), ('dificultad', dificultad),
+                              ('comentario', comentario), ('objetivo', objetivo)):
+            if valor is not None:
+                res &= self._faceta(faceta, valor)
+        if usada is not None:
+            res &= self.usada if usada else ~self.usada
+        if antes_de_meses is not None:
+            res &= uso_anterior_a(self.fecha_uso, antes_de_meses)
+        if ultimos_examenes is not None:
+            if ultimos_examenes > 0 and len(self.fechas_examen):
+                corte = self.fechas_examen[min(ultimos_examenes, len(self.fechas_examen)) - 1]
+                res &= self.fecha_uso >= corte
+            else:
+                res[:] = False
+        if con_solucion is not None:
+            res &= self.con_solucion if con_solucion else ~self.con_solucion
+        return res
+
+    def histograma_uso(self, mascara=None, cortes=(6, 12, 24)) -> dict:
+        """{tramo: nº de preguntas} según los meses transcurridos desde el último uso.
+        Incluye 'Nunca usada' y, si las hay, las marcadas como usadas sin fecha válida."""
+        usada, fecha = self.usada, self.fecha_uso
+        if mascara is not None:
+            usada, fecha = usada[mascara], fecha[mascara]
+        con_fecha = ~np.isnat(fecha)
+        import datetime as _dt
+        dias = (np.datetime64(_dt.datetime.now(), 'ns') - fecha[con_fecha]) / np.timedelta64(1, 'D')
+        tramos = np.searchsorted(np.asarray(cortes, dtype=float) * 30, dias, side='left')
+        cuentas = np.bincount(tramos, minlength=len(cortes) + 1).tolist()
+        etiquetas = ([f"< {cortes[0]} meses"]
+                     + [f"{a}–{b} meses" for a, b in zip(cortes, cortes[1:])]
+                     + [f"> {cortes[-1]} meses"])
+        res = dict(zip(etiquetas, cuentas))
+        sin_fecha = int(usada.sum()) - int(con_fecha.sum())
+        if sin_fecha:
+            res['Usada (sin fecha)'] = sin_fecha
+        res['Nunca usada'] = int((~usada).sum())
+        return res
+
+    def contar(self, faceta: str, mascara=None) -> dict:
+        """{valor: nº de filas} de la faceta, restringido a `mascara` si se da."""
+        if faceta not in self._codigos:
+            return {}
+        cod = self._codigos[faceta]
+        if mascara is not None:
+            cod = cod[mascara]
+        cuentas = np.bincount(cod[cod >= 0], minlength=len(self.valores[faceta]))
+        return dict(zip(self.valores[faceta].tolist(), cuentas.tolist()))
+
+SIMILITUD_EXACTA_HASTA = 2000   # bancos de hasta este tamaño se comparan con todo el banco
+SIMILITUD_MARGEN_EXACTO = 0.15  # o si el mejor candidato LSH se queda a este margen del umbral
+
+def check_for_similar_enunciado(text, df):
+    """(es_duplicado, similitud_máxima) de text frente a los enunciados de df.
+    df puede ser un DataFrame o un IndiceSimilitud ya construido (recomendado
+    si se comprueban muchos textos seguidos).
+
+    Es exacto (igual que comparar con todos los enunciados) en bancos de hasta
+    SIMILITUD_EXACTA_HASTA enunciados y cuando el mejor candidato LSH está cerca
+    del umbral. En bancos mayores, un casi-duplicado sin candidato LSH próximo
+    puede no detectarse (ver IndiceSimilitud.similares)."""
+    if isinstance(df, IndiceSimilitud):
+        indice = df
+    else:
+        if df.empty or 'enunciado' not in df.columns: return False, 0.0
+        indice = IndiceSimilitud.desde_df(df)
+    exacto = len(indice) <= SIMILITUD_EXACTA_HASTA
+    top = indice.similares(text, k=1, exacto=exacto)
+    max_sim = top[0][1] if top else 0.0
+    if not exacto and SIMILITUD_DUPLICADO - SIMILITUD_MARGEN_EXACTO <= max_sim <= SIMILITUD_DUPLICADO:
+        top = indice.similares(text, k=1, umbral=max_sim, exacto=True)
+        max_sim = top[0][1] if top else max_sim
+    return (max_sim > SIMILITUD_DUPLICADO, max_sim)
+
+class AsignadorIds:
+    """Reparte IDs FM_<bloque>_<tema>_<n> consecutivos sin reescanear el DataFrame.
+
+    Cada prefijo (bloque, tema) se escanea una sola vez, la primera vez que se
+    pide; a partir de ahí siguiente() es O(1) y reservar() entrega n IDs de golpe.
+    Los IDs entregados cuentan para los siguientes aunque aún no estén en df.
+    """
+
+    def __init__(self, df=None):
+        if df is None or df.empty or 'ID_Pregunta' not in df.columns:
+            self._ids = pd.Series([], dtype=str)
+        else:
+            self._ids = df['ID_Pregunta'].astype(str)
+        self._ultimo = {}
+
+    @staticmethod
+    def prefijo(bloque, tema):
+        return f"FM_{str(bloque).zfill(2)}_{str(tema).zfill(2)}"
+
+    def _ultimo_de(self, prefix):
+        if prefix not in self._ultimo:
+            suf = self._ids[self._ids.str.startswith(prefix)].str.rsplit('_', n=1).str[-1].str.strip()
+            nums = suf[suf.str.fullmatch(r'[+-]?\d+')].astype(int)
+            self._ultimo[prefix] = int(nums.max()) if len(nums) else 0
+        return self._ultimo[prefix]
+
+    def reservar(self, bloque, tema, n):
+        """Lista de n IDs nuevos consecutivos para (bloque, tema)."""
+        prefix = self.prefijo(bloque, tema)
+        ini = self._ultimo_de(prefix) + 1
+        self._ultimo[prefix] = ini + n - 1
+        return [f"{prefix}_{str(k).zfill(2)}" for k in range(ini, ini + n)]
+
+    def siguiente(self, bloque, tema):
+        """(id, número) del siguiente ID libre de (bloque, tema), como generar_siguiente_id."""
+        nid = self.reservar(bloque, tema, 1)[0]
+        return nid, self._ultimo[self.prefijo(bloque, tema)]
 
 def generar_siguiente_id(df, bloque, tema):
-    prefix = f"FM_{str(bloque).zfill(2)}_{str(tema).zfill(2)}"
-    if df is None or df.empty or 'ID_Pregunta' not in df.columns: return f"{prefix}_01", 1
-    existing = df[df['ID_Pregunta'].astype(str).str.startswith(prefix)]
-    if existing.empty: return f"{prefix}_01", 1
-    nums = []
-    for x in existing['ID_Pregunta']:
-        try: nums.append(int(x.split('_')[-1]))
-        except: pass
-    next_n = max(nums) + 1 if nums else 1
-    return f"{prefix}_{str(next_n).zfill(2)}", next_n
+    """Siguiente ID libre de (bloque, tema). Para varios IDs seguidos usar AsignadorIds."""
+    return AsignadorIds(df).siguiente(bloque, tema)
 
 def get_first_empty_row(worksheet, col_check=1):
     cols = worksheet.col_values(col_check) 
     return len(cols) + 1
 
+# --- RECETAS DE SELECCIÓN AUTOMÁTICA ---
+def _celda_receta(clave):
+    """(tipo de agrupación, valor, etiqueta) de una clave de receta."""
+    if clave == '__ALL__':
+        return 'bloque', None, '(cualquier tema)'
+    if str(clave).startswith('__OBJ_'):
+        cod = str(clave)[len('__OBJ_'):]
+        return 'objetivo', cod, f'Obj {cod}'
+    return 'tema', str(clave), f'Tema {clave}'
+
+def exposicion_preguntas(df, historial=None):
+    """(nº de usos, días desde el último uso) de cada fila de df; días = NaN si
+    nunca se ha usado. Cuenta las filas del historial de uso y, para los usos
+    anteriores al historial, la fecha de la columna 'usada'."""
+    import datetime as _dt
+    fecha = columna_fecha_uso(df)
+    n_usos = fecha.notna().to_numpy(dtype=np.int64)
+    ultima = fecha.to_numpy(dtype='datetime64[ns]')
+    if historial is not None and not historial.empty:
+        g = (historial.dropna(subset=['Fecha']).groupby('ID_Pregunta')['Fecha']
+             .agg(['size', 'max']).reindex(df['ID_Pregunta'].astype(str)))
+        n_usos = np.maximum(n_usos, g['size'].fillna(0).to_numpy(dtype=np.int64))
+        ultima = np.fmax(ultima, g['max'].to_numpy(dtype='datetime64[ns]'))   # NaT se ignora
+    dias = (np.datetime64(_dt.datetime.now(), 'ns') - ultima) / np.timedelta64(1, 'D')
+    return n_usos, dias
+
+def pesos_exposicion(n_usos, dias, semivida=180.0, castigo=1.0, minimo=0.02):
+    """Peso de muestreo por pregunta según su exposición previa: 1 si nunca se ha
+    usado; un uso reciente lo hunde y se recupera con el tiempo (la mitad de lo
+    perdido cada `semivida` días), y cada uso acumulado lo divide por (1+n)^castigo.
+    Nunca baja de `minimo`, para que ninguna pregunta quede excluida del todo."""
+    dias = np.asarray(dias, dtype=float)
+    recencia = np.where(np.isnan(dias), 1.0, 1.0 - 0.5 ** (np.maximum(dias, 0.0) / semivida))
+    return np.maximum(minimo, recencia / (1.0 + np.asarray(n_usos, dtype=float)) ** castigo)
+
+def aplicar_receta(df, receta, fijas=(), rng=None, pesos=None):
+    """Completa un examen con preguntas al azar según una receta automática.
+
+    receta: {bloque: {clave: {dificultad: n}}}; la clave es '__ALL__' (cualquier
+    tema del bloque), '__OBJ_<código>' (objetivo docente) o el número de tema.
+    Las preguntas de `fijas` cuentan para todas las celdas a las que pertenecen;
+    cada pregunta añadida cubre una sola celda y nunca se repite.
+
+    Las celdas se solapan (una pregunta del tema 3 sirve también para '__ALL__' o
+    para su objetivo), así que el reparto se resuelve como un emparejamiento
+    bipartito celda↔pregunta: primero un reparto voraz empezando por las celdas
+    con menos margen y después caminos de aumento (Ford-Fulkerson) para las que
+    quedan cortas. Si existe una selección que cubre toda la receta se encuentra;
+    si no, se cubre el máximo posible de huecos. Los candidatos de cada celda se
+    barajan con `rng` (random.Random o semilla): con la misma semilla se obtiene
+    la misma selección.
+
+    `pesos` (uno por fila de df, p. ej. pesos_exposicion) sustituye el barajado
+    uniforme por uno ponderado: cada pregunta recibe una clave log(u)/peso con u
+    uniforme y se ordena por ella (Efraimidis-Spirakis), lo que equivale a extraer
+    sin reemplazo con probabilidad proporcional al peso. Las claves salen de un
+    único sorteo vectorizado para todo el banco.
+
+    Devuelve (ids añadidos, faltas) con un dict por celda que no pudo cubrirse:
+    {'bloque', 'clave', 'etiqueta', 'dificultad', 'pedidas', 'fijas', 'añadidas',
+     'conflicto', 'disponibles'}; 'conflicto' son las demás celdas
+    (bloque, etiqueta, dificultad) que compiten por las mismas preguntas y
+    'disponibles' cuántas preguntas hay en total para todas ellas.
+    """
+    from collections import deque
+    if not isinstance(rng, random.Random):
+        rng = random.Random(rng)
+    if df is None or df.empty or not receta:
+        return [], []
+
+    ids = df['ID_Pregunta'].to_numpy(dtype=object)
+    claves = pd.DataFrame({
+        'bloque': df['bloque'].to_numpy(dtype=object),
+        'tema': df['Tema'].astype(str).to_numpy(dtype=object),
+        'dif': df['dificultad'].astype(str).str.lower().to_numpy(dtype=object),
+    })
+    tiene_obj = 'objetivo' in df.columns
+    if tiene_obj:
+        claves['objetivo'] = df['objetivo'].astype(str).to_numpy(dtype=object)
+    grupos = {}   # tipo -> {(bloque, [valor,] dif): posiciones en df}, bajo demanda
+    vacia = np.array([], dtype=np.intp)
+
+    def _posiciones(tipo, clave):
+        if tipo not in grupos:
+            cols = ['bloque', 'dif'] if tipo == 'bloque' else ['bloque', tipo, 'dif']
+            grupos[tipo] = claves.groupby(cols, sort=False).indices
+        return grupos[tipo].get(clave, vacia)
+
+    es_fija = pd.Series(ids).isin(list(fijas)).to_numpy()
+    orden = None
+    if pesos is not None:
+        u = 1.0 - np.random.default_rng(rng.getrandbits(64)).random(len(ids))   # (0, 1]
+        orden = np.log(u) / np.asarray(pesos, dtype=float)
+
+    # ── Celdas de la receta: candidatos barajados y huecos a cubrir ──────────
+    celdas = []
+    for bloque, temas_cfg in receta.items():
+        for clave, dif_cfg in temas_cfg.items():
+            tipo, valor, etiqueta = _celda_receta(clave)
+            if tipo == 'objetivo' and not tiene_obj:
+                tipo, valor = 'bloque', None   # sin columna objetivo: todo el bloque
+            for dif_name, n_req in dif_cfg.items():
+                if n_req <= 0:
+                    continue
+                dif = str(dif_name).lower()
+                pos = _posiciones(tipo, (bloque, dif) if valor is None else (bloque, valor, dif))
+                n_fijas = int(es_fija[pos].sum())
+                cand = pos[~es_fija[pos]]
+                if orden is None:
+                    cand = cand.tolist()
+                    rng.shuffle(cand)
+                else:
+                    cand = cand[np.argsort(-orden[cand], kind='stable')].tolist()
+                celdas.append({'bloque': bloque, 'clave': clave, 'etiqueta': etiqueta,
+                               'dificultad': dif_name, 'pedidas': n_req, 'fijas': n_fijas,
+                               'huecos': max(0, int(n_req) - n_fijas), 'cand': cand})
+
+    dueño = {}                                # posición -> celda que la usa
+    asignadas = [dict() for _ in celdas]      # celda -> {posición: None} (orden estable)
+
+    # ── Reparto voraz: primero las celdas con menos margen ───────────────────
+    for k in sorted(range(len(celdas)), key=lambda k: len(celdas[k]['cand']) - celdas[k]['huecos']):
+        c, a = celdas[k], asignadas[k]
+        for p in c['cand']:
+            if len(a) >= c['huecos']:
+                break
+            if p not in dueño:
+                dueño[p] = k
+                a[p] = None
+
+    def _aumentar(k):
+        """Busca (BFS) un camino celda→pregunta ocupada→su celda→… hasta una pregunta
+        libre y lo aplica. Devuelve (True, None) o (False, (celdas, preguntas) alcanzadas)."""
+        padre, via = {k: None}, {}
+        vistas = set()
+        cola = deque([k])
+        while cola:
+            c = cola.popleft()
+            for p in celdas[c]['cand']:
+                if p in vistas:
+                    continue
+                vistas.add(p)
+                d = dueño.get(p)
+                if d is None:
+                    nueva = p
+                    while True:                 # desplazar a lo largo del camino
+                        dueño[nueva] = c
+                        asignadas[c][nueva] = None
+                        if c == k:
+                            return True, None
+                        nueva = via[c]
+                        del asignadas[c][nueva]
+                        c = padre[c]
+                if d not in padre:
+                    padre[d], via[d] = c, p
+                    cola.append(d)
+        return False, (list(padre), vistas)
+
+    faltas = []
+    for k, c in enumerate(celdas):
+        while len(asignadas[k]) < c['huecos']:
+            ok, alcance = _aumentar(k)
+            if ok:
+                continue
+            # Celdas alcanzadas = conjunto de Hall que incumple: piden más
+            # preguntas de las que existen entre todas ellas.
+            otras, vistas = alcance
+            faltas.append({**{x: c[x] for x in ('bloque', 'clave', 'etiqueta', 'dificultad',
+                                                'pedidas', 'fijas')},
+                           'añadidas': len(asignadas[k]),
+                           'conflicto': [(celdas[j]['bloque'], celdas[j]['etiqueta'],
+                                          celdas[j]['dificultad']) for j in otras if j != k],
+                           'disponibles': len(vistas)})
+            break
+
+    añadidas = [ids[p] for a in asignadas for p in a]
+    return añadidas, faltas
+
 # --- PARSERS DE IMPORTACIÓN (formato normalizado) ---
 # Cada parser devuelve lista de dicts:
 # {'enunciado': str, 'opciones_list': [A,B,C,D], 'letra_correcta': str,
@@ -966,12 +2882,52 @@ def get_cfg_objetivos(dfs: dict) -> dict:
     return result
 
 
-def init_cfg_from_data(dfs: dict) -> dict:
+def _txt_cfg(v) -> str:
+    """Texto de una celda de config; vacía/NaN/None -> ''."""
+    t = "" if v is None or (isinstance(v, float) and np.isnan(v)) else str(v)
+    return "" if t in ("nan", "None") else t
+
+
+def _asignar_cfg(dfs: dict, nombre: str, df: pd.DataFrame):
+    """dfs[nombre] = df solo si el contenido cambia (asignar marca la hoja sucia)."""
+    prev = dfs.get(nombre)
+    if (prev is not None and list(prev.columns) == list(df.columns) and len(prev) == len(df)
+            and prev.fillna("").astype(str).reset_index(drop=True).equals(df.fillna("").astype(str))):
+        return
+    dfs[nombre] = df
+
+
+def _temas_de_hojas(dfs: dict) -> dict:
+    """{tema: primer bloque donde aparece} leyendo las hojas de preguntas."""
+    seen = {}
+    for b_name, df_sheet in dfs.items():
+        if b_name in CFG_SHEETS or df_sheet.empty:
+            continue
+        head = [str(h).lower().strip() for h in df_sheet.columns]
+        idx_t = next((i for i, h in enumerate(head)
+                      if "tema" in h and "id" not in h), -1)
+        if idx_t == -1:
+            continue
+        temas = df_sheet.iloc[:, idx_t].map(str).str.strip()
+        temas = temas.mask(temas.str.endswith(".0"), temas.str[:-2])
+        for t in pd.unique(temas[~temas.isin(("nan", "None", ""))]):
+            if t not in seen:
+                seen[t] = b_name
+    return seen
+
+
+def init_cfg_from_data(dfs: dict, temas=None) -> dict:
     """
     Sincroniza Cfg_Bloques y Cfg_Temas con los datos reales de preguntas:
     - Añade bloques/temas nuevos que no estén en el config.
     - Nunca sobreescribe nombres/descripciones ya guardados.
     - Elimina filas huérfanas (bloques/temas que ya no existen en los datos).
+
+    `temas` (opcional) son los temas de las preguntas ya procesadas (p. ej.
+    df_preguntas["Tema"]). Si coinciden con los de Cfg_Temas y todos tienen
+    bloque, no se leen las hojas de preguntas: en un LibroHojas perezoso solo se
+    cargan las de configuración. Las hojas de config solo se reasignan (y pasan
+    a sucias) si su contenido cambia.
     """
     _k = lambda t: [int(x) if x.isdigit() else x.lower()
                     for x in re.split(r"(\d+)", str(t))]
@@ -984,33 +2940,18 @@ def init_cfg_from_data(dfs: dict) -> dict:
         existing_map_b = {}
     else:
         existing_map_b = {
-            str(r["Bloque"]): str(r.get("Descripcion", "") or "")
+            str(r["Bloque"]): _txt_cfg(r.get("Descripcion"))
             for _, r in existing_b.iterrows()
             if str(r.get("Bloque", "")) not in ("", "nan", "None")
         }
     # Merge: keep existing desc, add new blank
     merged_b = {b: existing_map_b.get(b, "") for b in question_sheets}
-    dfs[CFG_BLOQUES_SHEET] = pd.DataFrame(
-        [{"Bloque": b, "Descripcion": merged_b[b]} for b in question_sheets]
-    )
-
-    # ── Cfg_Temas: recopilar todos los temas presentes en los datos ───────────
-    seen = {}  # tema -> bloque (first occurrence in data)
-    for b_name, df_sheet in dfs.items():
-        if b_name in CFG_SHEETS or df_sheet.empty:
-            continue
-        head = [str(h).lower().strip() for h in df_sheet.columns]
-        idx_t = next((i for i, h in enumerate(head)
-                      if "tema" in h and "id" not in h), -1)
-        if idx_t == -1:
-            continue
-        for _, row in df_sheet.iterrows():
-            t = str(row.iloc[idx_t]).strip()
-            if t.endswith(".0"):
-                t = t[:-2]
-            if t and t not in ("nan", "None", "") and t not in seen:
-                seen[t] = b_name
+    _asignar_cfg(dfs, CFG_BLOQUES_SHEET, pd.DataFrame(
+        [{"Bloque": b, "Descripcion": merged_b[b]} for b in question_sheets],
+        columns=["Bloque", "Descripcion"]
+    ))
 
+    # ── Cfg_Temas: temas presentes en los datos ──────────────────────────────
     existing_t = dfs.get(CFG_TEMAS_SHEET)
     if existing_t is None or existing_t.empty:
         existing_map_t = {}
@@ -1022,10 +2963,16 @@ def init_cfg_from_data(dfs: dict) -> dict:
                 t = t[:-2]
             if t and t not in ("nan", "None", ""):
                 existing_map_t[t] = {
-                    "nombre": str(r.get("Nombre", "") or ""),
-                    "bloque": str(r.get("Bloque", "") or ""),
+                    "nombre": _txt_cfg(r.get("Nombre")),
+                    "bloque": _txt_cfg(r.get("Bloque")),
                 }
 
+    conocidos = None if temas is None else set(map(str, pd.unique(pd.Series(temas))))
+    if conocidos == set(existing_map_t) and all(v["bloque"] for v in existing_map_t.values()):
+        seen = {t: v["bloque"] for t, v in existing_map_t.items()}   # nada que añadir ni quitar
+    else:
+        seen = _temas_de_hojas(dfs)   # tema -> bloque (first occurrence in data)
+
     # Merge: only keep temas that exist in data; preserve saved names
     rows_t = []
     for t in sorted(seen, key=_k):
@@ -1035,9 +2982,7 @@ def init_cfg_from_data(dfs: dict) -> dict:
             "Nombre": prev.get("nombre", "") or "",
             "Bloque": prev.get("bloque", "") or seen[t],
         })
-    dfs[CFG_TEMAS_SHEET] = pd.DataFrame(rows_t) if rows_t else pd.DataFrame(
-        columns=["Tema", "Nombre", "Bloque"]
-    )
+    _asignar_cfg(dfs, CFG_TEMAS_SHEET, pd.DataFrame(rows_t, columns=["Tema", "Nombre", "Bloque"]))
 
     return dfs
 
@@ -1091,6 +3036,24 @@ def _fix_text_superscripts(s: str) -> str:
     return s
 
 
+# ── Historial de uso ──────────────────────────────────────────────────────────
+def get_historial_uso(dfs: dict) -> pd.DataFrame:
+    """Historial de uso (una fila por pregunta y examen) con 'Fecha' como datetime64.
+    Vacío (con columnas) si la hoja no existe."""
+    df = dfs.get(HISTORIAL_USO_SHEET)
+    if df is None or df.empty or 'ID_Pregunta' not in df.columns:
+        return pd.DataFrame({'ID_Pregunta': pd.Series(dtype=str),
+                             'Fecha': pd.Series(dtype='datetime64[ns]'),
+                             'Examen': pd.Series(dtype=str)})
+    df = df.copy()
+    for col in HISTORIAL_USO_COLS:
+        if col not in df.columns:
+            df[col] = ''
+    df['ID_Pregunta'] = df['ID_Pregunta'].astype(str)
+    df['Fecha'] = pd.to_datetime(df['Fecha'].astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+    return df
+
+
 def format_datos_latex(ids_str: str, datos_df: pd.DataFrame) -> str:
     """Formatea las constantes seleccionadas como bloque LaTeX inline.
     ids_str: IDs separados por comas. Retorna string LaTeX o '' si vacío."""
@@ -1153,56 +3116,138 @@ def format_datos_word(ids_str: str, datos_df: pd.DataFrame) -> str:
 
 
 # --- EXPORTAR ---
-def generar_master_examen(pool, num_modelos, cfg):
-    master = []
-    letras_version = ['A','B','C','D','E','F']
-    for m in range(1, num_modelos+1):
-        ex = [p.copy() for p in pool]
-        if cfg.get('barajar_por_temas', False):
-            # Respeta orden de bloques y temas; baraja dentro de cada (bloque, tema)
-            _seen, _groups = [], {}
-            for p in ex:
-                _key = (p.get('bloque', ''), str(p.get('Tema', '')))
-                if _key not in _groups:
-                    _groups[_key] = []; _seen.append(_key)
-                _groups[_key].append(p)
-            ex = []
-            for _key in _seen:
-                _g = _groups[_key]; random.shuffle(_g); ex.extend(_g)
-        elif cfg.get('barajar_por_bloques', False):
-            # Mantiene el orden de bloques del pool, baraja dentro de cada bloque
-            _seen, _groups = [], {}
-            for p in ex:
-                _b = p.get('bloque', '')
-                if _b not in _groups:
-                    _groups[_b] = []; _seen.append(_b)
-                _groups[_b].append(p)
-            ex = []
-            for _b in _seen:
-                _g = _groups[_b]; random.shuffle(_g); ex.extend(_g)
-        elif cfg.get('barajar_preguntas', False):
-            random.shuffle(ex)
-        for idx, p in enumerate(ex):
-            ops = p.get('opciones_visibles', p.get('opciones_list'))[:]
-            correcta_orig_letra = p.get('letra_correcta', 'A')
-            idx_orig = {'A':0, 'B':1, 'C':2, 'D':3}.get(correcta_orig_letra, 0)
-            txt_correcta = p.get('opciones_list')[idx_orig]
-            anclado = False
-            frases_anclaje = ["todas las anteriores", "ninguna de las anteriores", "ambas son", "son correctas", "son falsas"]
-            if cfg.get('frases_anclaje_extra'):
-                frases_anclaje.extend([x.lower().strip() for x in cfg['frases_anclaje_extra'].split(',')])
-            for op in ops:
-                if any(f in str(op).lower() for f in frases_anclaje): anclado = True
-            if cfg.get('barajar_respuestas', True) and not anclado:
-                random.shuffle(ops)
-            try:
-                new_idx = ops.index(txt_correcta)
-                new_letra = ['A','B','C','D'][new_idx]
-            except: new_letra = 'A'
-            p['opciones_finales'] = ops; p['letra_final'] = new_letra; p['num'] = idx + 1
-        letra_v = letras_version[m-1] if m <= len(letras_version) else str(m)
-        master.append({'modelo': m, 'letra_version': letra_v, 'preguntas': ex})
-    return master
+_FRASES_ANCLAJE = ["todas las anteriores", "ninguna de las anteriores", "ambas son", "son correctas", "son falsas"]
+_LETRAS_VERSION = ['A','B','C','D','E','F']
+_LETRAS_OPCION  = ['A','B','C','D']
+
+
+class VersionesExamen:
+    """Versiones barajadas de un examen, guardadas como permutaciones de enteros.
+
+    En lugar de copiar el pool entero por versión, se guardan tres arrays:
+    ``orden`` (V×Q, índice del pool en cada posición), ``opciones`` (V×Q×K,
+    permutación de las opciones de cada pregunta del pool) y ``correcta``
+    (V×Q, posición de la respuesta correcta tras barajar, -1 si no es A–D).
+    Los dicts de cada versión se construyen al pedirla, así que la memoria
+    crece con V×Q enteros y no con V copias del pool; esto permite generar
+    una versión por alumno con cientos de alumnos.
+
+    Se comporta como la lista que devolvía ``generar_master_examen``:
+    ``len()``, índices e iteración dan ``{'modelo', 'letra_version', 'preguntas'}``.
+    ``etiquetas`` (p. ej. DNI de los alumnos) sustituye a las letras A–F y fija
+    el número de versiones.
+    """
+
+    def __init__(self, pool, num_versiones, cfg, rng=None, etiquetas=None):
+        self.pool = list(pool)
+        if etiquetas is not None:
+            etiquetas = [str(e) for e in etiquetas]
+            if len(set(etiquetas)) != len(etiquetas):
+                raise ValueError("Las etiquetas de versión deben ser únicas.")
+            num_versiones = len(etiquetas)
+        self.etiquetas = etiquetas
+        if rng is None:
+            rng = np.random.default_rng(random.getrandbits(64))
+        V, Q = int(num_versiones), len(self.pool)
+
+        frases = list(_FRASES_ANCLAJE)
+        if cfg.get('frases_anclaje_extra'):
+            frases.extend([x.lower().strip() for x in cfg['frases_anclaje_extra'].split(',')])
+
+        # Datos por pregunta del pool: se calculan una sola vez para todas las versiones
+        self._ops, grupos = [], []
+        n_ops  = np.zeros(Q, dtype=np.int64)
+        fija   = np.zeros(Q, dtype=bool)
+        vistos = {}
+        for i, p in enumerate(self.pool):
+            ops = list(p.get('opciones_visibles', p.get('opciones_list')))
+            self._ops.append(ops)
+            n_ops[i] = len(ops)
+            fija[i]  = any(f in str(op).lower() for op in ops for f in frases)
+            if cfg.get('barajar_por_temas', False):
+                clave = (p.get('bloque', ''), str(p.get('Tema', '')))
+            elif cfg.get('barajar_por_bloques', False):
+                clave = p.get('bloque', '')
+            else:
+                clave = None
+            grupos.append(vistos.setdefault(clave, len(vistos)))
+        if not cfg.get('barajar_respuestas', True):
+            fija[:] = True
+        K = max(int(n_ops.max()) if Q else 0, 1)
+
+        # Máscara Q×K: posiciones originales cuyo texto es la opción correcta
+        es_correcta = np.zeros((Q, K), dtype=bool)
+        for i, p in enumerate(self.pool):
+            idx_orig = {'A':0, 'B':1, 'C':2, 'D':3}.get(p.get('letra_correcta', 'A'), 0)
+            base = p.get('opciones_list') or []
+            if idx_orig < len(base):
+                txt = base[idx_orig]
+                es_correcta[i, :n_ops[i]] = [op == txt for op in self._ops[i]]
+
+        # Orden de preguntas: clave de grupo + desempate aleatorio → argsort por fila
+        barajar = (cfg.get('barajar_por_temas', False) or cfg.get('barajar_por_bloques', False)
+                   or cfg.get('barajar_preguntas', False))
+        if barajar and Q:
+            claves = np.asarray(grupos, dtype=np.float64) + rng.random((V, Q))
+            self.orden = np.argsort(claves, axis=1, kind='stable').astype(np.int32)
+        else:
+            self.orden = np.broadcast_to(np.arange(Q, dtype=np.int32), (V, Q))
+
+        # Orden de opciones: relleno (>= n_ops) siempre al final, ancladas sin barajar
+        huecos = np.arange(K) >= n_ops[:, None]
+        claves = rng.random((V, Q, K))
+        claves[:, fija, :] = np.arange(K)
+        claves[:, huecos]  = np.inf
+        self.opciones = np.argsort(claves, axis=2, kind='stable').astype(np.int8)
+
+        pos_ok = np.take_along_axis(np.broadcast_to(es_correcta, (V, Q, K)),
+                                    self.opciones.astype(np.intp), axis=2)
+        correcta = np.where(pos_ok.any(axis=2), pos_ok.argmax(axis=2), -1)
+        correcta[correcta >= len(_LETRAS_OPCION)] = -1
+        self.correcta = correcta.astype(np.int8)
+
+    def __len__(self):
+        return self.orden.shape[0]
+
+    def etiqueta(self, v):
+        """Etiqueta de la versión ``v`` (0-based): A–F, su número o la etiqueta dada."""
+        if self.etiquetas is not None:
+            return self.etiquetas[v]
+        return _LETRAS_VERSION[v] if v < len(_LETRAS_VERSION) else str(v + 1)
+
+    def letras(self, v):
+        """Clave de respuestas de la versión ``v`` en orden de examen, sin construir dicts."""
+        idx = self.correcta[v, self.orden[v]]
+        return [_LETRAS_OPCION[c] if c >= 0 else 'A' for c in idx]
+
+    def __getitem__(self, v):
+        if isinstance(v, slice):
+            return [self[i] for i in range(*v.indices(len(self)))]
+        if v < 0:
+            v += len(self)
+        if not 0 <= v < len(self):
+            raise IndexError(v)
+        preguntas = []
+        for num, i in enumerate(self.orden[v], start=1):
+            ops = self._ops[i]
+            c = self.correcta[v, i]
+            preguntas.append({
+                **self.pool[i],
+                'opciones_finales': [ops[j] for j in self.opciones[v, i, :len(ops)]],
+                'letra_final': _LETRAS_OPCION[c] if c >= 0 else 'A',
+                'num': num,
+            })
+        return {'modelo': v + 1, 'letra_version': self.etiqueta(v), 'preguntas': preguntas}
+
+    def __iter__(self):
+        for v in range(len(self)):
+            yield self[v]
+
+
+def generar_master_examen(pool, num_modelos, cfg, rng=None):
+    """Versiones del examen. Con ``cfg['etiquetas_version']`` genera una por etiqueta (alumno)."""
+    return VersionesExamen(pool, num_modelos, cfg, rng=rng,
+                           etiquetas=cfg.get('etiquetas_version') or None)
 
 def exportar_archivos_csv(master, ruta, nombre):
     # 1. CLAVES (Formato Vertical Lector)
@@ -2873,27 +4918,40 @@ def cargar_examen_csv(path):
 def exportar_preguntas_json(ids, df, filepath):
     """Exporta una seleccion de preguntas a JSON portable."""
     import json
-    pregs = df[df['ID_Pregunta'].isin(ids)].to_dict('records')
+    # fecha_uso se deriva de 'usada' al cargar: no forma parte del formato portable
+    pregs = (df[df['ID_Pregunta'].isin(ids)]
+             .drop(columns=['fecha_uso'], errors='ignore').to_dict('records'))
     with open(filepath, 'w', encoding='utf-8') as f:
         json.dump({'version': 1, 'preguntas': pregs}, f, ensure_ascii=False, indent=2, default=str)
     return len(pregs)
 
-def importar_preguntas_json(filepath, bloque_destino, df_existing):
-    """Importa preguntas desde JSON. Retorna (nuevas_list, duplicados_count)."""
+def importar_preguntas_json(filepath, bloque_destino, df_existing, indice=None):
+    """Importa preguntas desde JSON. Retorna (nuevas_list, duplicados_count).
+    `indice` es un IndiceSimilitud de df_existing ya construido (opcional)."""
     import json
     with open(filepath, 'r', encoding='utf-8') as f:
         data = json.load(f)
     pregs = data.get('preguntas', [])
+    if indice is None:
+        indice = IndiceSimilitud.desde_df(df_existing)
+    lote = IndiceSimilitud()   # las ya aceptadas de este mismo archivo
     nuevas = []; dupes = 0
     for p in pregs:
         enun = p.get('enunciado','')
-        is_dup, _ = check_for_similar_enunciado(enun, df_existing)
+        is_dup, _ = check_for_similar_enunciado(enun, indice)
+        if not is_dup and nuevas:
+            is_dup, _ = check_for_similar_enunciado(enun, lote)
         if is_dup: dupes += 1; continue
-        tema = p.get('Tema', '1')
-        nid, _ = generar_siguiente_id(df_existing, bloque_destino, tema)
         p_new = dict(p)
-        p_new['ID_Pregunta'] = nid; p_new['bloque'] = bloque_destino; p_new['usada'] = ''
+        p_new['bloque'] = bloque_destino; p_new['usada'] = ''
+        lote.añadir(len(nuevas), enun)
         nuevas.append(p_new)
-        # Update df_existing for next ID generation
-        df_existing.loc[len(df_existing)] = p_new
+    # IDs: un bloque reservado por tema, en orden de aparición
+    asignador = AsignadorIds(df_existing)
+    por_tema = {}
+    for p_new in nuevas:
+        por_tema.setdefault(p_new.get('Tema', '1'), []).append(p_new)
+    for tema, grupo in por_tema.items():
+        for p_new, nid in zip(grupo, asignador.reservar(bloque_destino, tema, len(grupo))):
+            p_new['ID_Pregunta'] = nid
     return nuevas, dupes
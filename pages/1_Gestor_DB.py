@@ -27,8 +27,9 @@ from app_utils import (
     connect_db, reload_db,
     bloques_disponibles, temas_de_bloque, temas_en_db, objetivos_de_tema,
     nombre_bloque, nombre_tema, nombre_objetivo,
-    es_uso_antiguo, render_question_card_html, mathjax_html, _nsort,
-    sync_hoja_gsheets, sync_bloques_gsheets,
+    render_question_card_html, mathjax_html, _nsort,
+    sync_hoja_gsheets, sync_bloques_gsheets, marcar_db_cambiada, indice_similitud, filtrar_por_busqueda,
+    indice_facetas,
     _dialog_editar_pregunta,
 )
 
@@ -409,8 +410,9 @@ def _fill_row(blk_df: pd.DataFrame, p_data: dict, nid: str) -> dict:
 # ═════════════════════════════════════════════════════════════════════════════
 # PESTAÑA PRINCIPAL
 # ═════════════════════════════════════════════════════════════════════════════
-tab_man, tab_sol, tab_add, tab_imp, tab_stat, tab_const, tab_obj = st.tabs(
-    ["✏️ Gestionar", "📖 Soluciones", "➕ Añadir", "📥 Importar", "📊 Estadísticas", "🔢 Constantes", "🎯 Objetivos"]
+tab_man, tab_sol, tab_add, tab_imp, tab_stat, tab_dup, tab_const, tab_obj = st.tabs(
+    ["✏️ Gestionar", "📖 Soluciones", "➕ Añadir", "📥 Importar", "📊 Estadísticas",
+     "👯 Duplicados", "🔢 Constantes", "🎯 Objetivos"]
 )
 
 # ─────────────────────────────────────────────────────────────────────────────
@@ -452,7 +454,7 @@ with tab_add:
 
         if enun_add.strip():
             # Comprobar duplicados
-            is_dup, sim = lib.check_for_similar_enunciado(enun_add.strip(), df_total)
+            is_dup, sim = lib.check_for_similar_enunciado(enun_add.strip(), indice_similitud())
             if is_dup:
                 st.error(f"❌ Pregunta muy similar ya existe en la base de datos (similitud {sim:.0%}). Descartada.")
             else:
@@ -466,10 +468,8 @@ with tab_add:
                     "letra_correcta": corr_add, "enunciado": enun_add.strip(),
                     "opciones_list": ops_add, "usada": "", "notas": "",
                 }, nid)
-                excel_dfs[bloque_add] = pd.concat(
-                    [blk_df, pd.DataFrame([new_row])], ignore_index=True
-                )
-                lib.guardar_excel_local(excel_path, excel_dfs)
+                with lib.transaccion(excel_path, excel_dfs) as tx:
+                    tx.insertar(bloque_add, [new_row])
                 st.success(f"✅ Pregunta guardada con ID: **{nid}**")
                 sync_bloques_gsheets([bloque_add])
                 reload_db()
@@ -606,6 +606,10 @@ div[data-testid="stCheckbox"] { margin-top:4px!important; }
             imported = 0; skipped = 0
             excel_path = st.session_state.excel_path
             excel_dfs  = st.session_state.excel_dfs
+            nuevas_por_blk = {}
+            asignador  = lib.AsignadorIds(df_total)
+            indice     = indice_similitud()
+            lote       = lib.IndiceSimilitud()   # las ya aceptadas en esta importación
 
             for i in sel_ids:
                 p_data = {
@@ -619,7 +623,9 @@ div[data-testid="stCheckbox"] { margin-top:4px!important; }
                     "comentario":     staging[i].get("comentario", ""),
                     "objetivo":       staging[i].get("objetivo", ""),
                 }
-                is_dup, _ = lib.check_for_similar_enunciado(p_data["enunciado"], df_total)
+                is_dup, _ = lib.check_for_similar_enunciado(p_data["enunciado"], indice)
+                if not is_dup:
+                    is_dup, _ = lib.check_for_similar_enunciado(p_data["enunciado"], lote)
                 if is_dup: skipped += 1; continue
                 blk    = p_data["bloque"]
                 blk_df = _asegurar_bloque(excel_dfs, blk)
@@ -633,20 +639,15 @@ div[data-testid="stCheckbox"] { margin-top:4px!important; }
                             else len(blk_df.columns))
                     blk_df.insert(ins2, "Objetivo", "")
                     excel_dfs[blk] = blk_df
-                nid, _ = lib.generar_siguiente_id(df_total, blk, p_data["tema"])
-                new_row = _fill_row(blk_df, p_data, nid)
-                excel_dfs[blk] = pd.concat([blk_df, pd.DataFrame([new_row])], ignore_index=True)
-                df_total = pd.concat([df_total, pd.DataFrame([{
-                    "ID_Pregunta": nid, "bloque": blk, "Tema": p_data["tema"],
-                    "enunciado": p_data["enunciado"], "opciones_list": p_data["opciones_list"],
-                    "letra_correcta": p_data["letra_correcta"], "dificultad": p_data["dificultad"],
-                    "usada": "", "notas": "", "comentario": p_data.get("comentario", ""),
-                    "objetivo": p_data.get("objetivo", ""),
-                }])], ignore_index=True)
+                nid, _ = asignador.siguiente(blk, p_data["tema"])
+                nuevas_por_blk.setdefault(blk, []).append(_fill_row(blk_df, p_data, nid))
+                lote.añadir(nid, p_data["enunciado"])
                 imported += 1
 
             if imported:
-                lib.guardar_excel_local(excel_path, excel_dfs)
+                with lib.transaccion(excel_path, excel_dfs) as tx:
+                    for blk, filas in nuevas_por_blk.items():
+                        tx.insertar(blk, filas)
                 st.success(f"✅ {imported} pregunta(s) importada(s). {skipped} duplicada(s) omitida(s).")
                 st.session_state.import_staging = []
                 _bloques_imp = list({staging[i].get("bloque", bloque_imp) for i in sel_ids})
@@ -675,14 +676,17 @@ with tab_man:
         st.session_state["man_f_uso"]          = "Todos"
         st.session_state["man_search"]         = ""
         st.session_state["man_search_global"]  = False
+        st.session_state["man_search_fuzzy"]   = False
         st.session_state["man_filter_sin_sol"] = False
         st.session_state["_man_prev_bloque"]   = "Todos"
 
     fc1, fc2, fc3, fc4, fc5 = st.columns([2, 2, 1.5, 2, 0.7])
 
+    facetas = indice_facetas()
+    _n_blq  = facetas.contar("bloque")
     f_bloque = fc1.selectbox(
         "Bloque", ["Todos"] + bloques, key="man_f_bloque",
-        format_func=lambda b: "Todos" if b == "Todos" else nombre_bloque(b),
+        format_func=lambda b: "Todos" if b == "Todos" else f"{nombre_bloque(b)} ({_n_blq.get(b, 0)})",
     )
 
     # Reset tema si cambia el bloque
@@ -698,51 +702,58 @@ with tab_man:
     if _t_cur != "Todos" and _t_cur not in temas_disponibles:
         st.session_state["man_f_tema"] = "Todos"
 
+    _m_blq  = facetas.mascara(bloque=None if f_bloque == "Todos" else f_bloque)
+    _n_tema = facetas.contar("tema", _m_blq)
     f_tema = fc2.selectbox(
         "Tema", ["Todos"] + temas_disponibles, key="man_f_tema",
-        format_func=lambda t: "Todos" if t == "Todos" else nombre_tema(t),
+        format_func=lambda t: "Todos" if t == "Todos" else f"{nombre_tema(t)} ({_n_tema.get(str(t), 0)})",
     )
-    f_dif  = fc3.selectbox("Dificultad", ["Todas", "Facil", "Media", "Dificil"], key="man_f_dif")
+    _n_dif = facetas.contar("dificultad", _m_blq & facetas.mascara(
+        tema=None if f_tema == "Todos" else f_tema))
+    f_dif  = fc3.selectbox("Dificultad", ["Todas", "Facil", "Media", "Dificil"], key="man_f_dif",
+                           format_func=lambda d: d if d == "Todas" else f"{d} ({_n_dif.get(d.lower(), 0)})")
     f_uso  = fc4.selectbox(
-        "Uso", ["Todos", "Nunca usada", "Usada", "Usada >6m", "Usada >12m"], key="man_f_uso",
+        "Uso", ["Todos", "Nunca usada", "Usada", "Usada >6m", "Usada >12m",
+                "Usada hace > N meses", "En últimos N exámenes"], key="man_f_uso",
     )
+    f_uso_n = None
+    if f_uso == "Usada hace > N meses":
+        f_uso_n = fc4.number_input("Meses", min_value=1, max_value=120, value=18, step=1,
+                                   key="man_f_uso_meses", label_visibility="collapsed")
+    elif f_uso == "En últimos N exámenes":
+        f_uso_n = fc4.number_input("Exámenes", min_value=1, max_value=50, value=3, step=1,
+                                   key="man_f_uso_examenes", label_visibility="collapsed",
+                                   help="Cada fecha de uso distinta cuenta como un examen")
     fc5.markdown("<div style='margin-top:24px'></div>", unsafe_allow_html=True)
     if fc5.button("🔄", key="btn_clear_filters", help="Limpiar todos los filtros"):
         st.session_state["_do_clear_filters"] = True
         st.rerun()
 
-    srch1, srch2, srch3 = st.columns([4, 1.2, 1])
-    f_search  = srch1.text_input("🔍 Buscar", placeholder="Enunciado, opciones, notas…", key="man_search")
+    srch1, srch2, srch4, srch3 = st.columns([4, 1.2, 1.2, 1])
+    f_search  = srch1.text_input("🔍 Buscar", placeholder="Enunciado, opciones, solución, notas…", key="man_search",
+                                help="Sin distinguir tildes ni mayúsculas. Cada palabra busca las que "
+                                     "empiezan por ella; con varias, deben aparecer todas.")
     f_global  = srch2.checkbox("🌐 Todos los bloques", key="man_search_global", value=False,
                                 help="Buscar ignorando el filtro de bloque")
+    f_fuzzy   = srch4.checkbox("≈ Tolerar erratas", key="man_search_fuzzy", value=False,
+                                help="Encuentra palabras parecidas (p. ej. 'refracion' → "
+                                     "'refracción') y ordena por parecido")
     f_sin_sol = srch3.checkbox("Sin solución", key="man_filter_sin_sol", value=False)
 
     # ── Aplicar filtros ───────────────────────────────────────────────────────
-    df_filt = df_total.copy()
-    if f_bloque != "Todos" and not f_global:
-        df_filt = df_filt[df_filt["bloque"] == f_bloque]
-    if f_tema != "Todos":
-        df_filt = df_filt[df_filt["Tema"].astype(str) == f_tema]
-    if f_dif != "Todas":
-        df_filt = df_filt[df_filt["dificultad"].str.lower() == f_dif.lower()]
-    if f_uso == "Nunca usada":
-        df_filt = df_filt[df_filt["usada"] == ""]
-    elif f_uso == "Usada":
-        df_filt = df_filt[df_filt["usada"] != ""]
-    elif f_uso == "Usada >6m":
-        df_filt = df_filt[df_filt["usada"].apply(lambda v: es_uso_antiguo(v, 6))]
-    elif f_uso == "Usada >12m":
-        df_filt = df_filt[df_filt["usada"].apply(lambda v: es_uso_antiguo(v, 12))]
-    if f_sin_sol:
-        df_filt = df_filt[~df_filt["solucion"].apply(
-            lambda v: bool(str(v).strip() and str(v) not in ('nan', 'None', '')))]
+    # Máscaras precalculadas por versión de la BD (ver lib.IndiceFacetas)
+    _meses_uso = {"Usada >6m": 6, "Usada >12m": 12, "Usada hace > N meses": f_uso_n}
+    df_filt = df_total[facetas.mascara(
+        bloque=None if f_bloque == "Todos" or f_global else f_bloque,
+        tema=None if f_tema == "Todos" else f_tema,
+        dificultad=None if f_dif == "Todas" else f_dif,
+        usada={"Nunca usada": False, "Usada": True}.get(f_uso),
+        antes_de_meses=_meses_uso.get(f_uso),
+        ultimos_examenes=f_uso_n if f_uso == "En últimos N exámenes" else None,
+        con_solucion=False if f_sin_sol else None,
+    )]
     if f_search:
-        sq = f_search.lower()
-        mask = df_filt["enunciado"].str.lower().str.contains(sq, na=False)
-        mask = mask | df_filt["notas"].astype(str).str.lower().str.contains(sq, na=False)
-        mask = mask | df_filt["opciones_list"].apply(
-            lambda ops: any(sq in str(o).lower() for o in (ops or [])))
-        df_filt = df_filt[mask]
+        df_filt = filtrar_por_busqueda(df_filt, f_search, aproximada=f_fuzzy)
 
     # Contador + badge global search
     n_filt   = len(df_filt)
@@ -828,21 +839,23 @@ with tab_man:
                                               key="bulk_dif")
                     if st.button(f"✅ Aplicar a {n_filt} preguntas", key="btn_bulk_apply"):
                         msgs = []
-                        if bulk_tema.strip():
-                            ok, m = lib.actualizar_campo_masivo(
-                                st.session_state.excel_path, st.session_state.excel_dfs,
-                                bulk_ids, "tema", bulk_tema.strip())
-                            msgs.append(m)
-                        if bulk_dif != "(no cambiar)":
-                            ok, m = lib.actualizar_campo_masivo(
-                                st.session_state.excel_path, st.session_state.excel_dfs,
-                                bulk_ids, "dificultad", bulk_dif)
-                            msgs.append(m)
+                        # Tema y dificultad en una sola transacción → un único guardado
+                        try:
+                            with lib.transaccion(st.session_state.excel_path,
+                                                 st.session_state.excel_dfs) as tx:
+                                if bulk_tema.strip():
+                                    n = tx.actualizar_campo(bulk_ids, "tema", bulk_tema.strip())
+                                    msgs.append(f"{n} pregunta(s) actualizadas → tema='{bulk_tema.strip()}'")
+                                if bulk_dif != "(no cambiar)":
+                                    n = tx.actualizar_campo(bulk_ids, "dificultad", bulk_dif)
+                                    msgs.append(f"{n} pregunta(s) actualizadas → dificultad='{bulk_dif}'")
+                        except Exception as e:
+                            st.error(str(e)); msgs = None
                         if msgs:
                             sync_bloques_gsheets(list(
                                 df_total[df_total["ID_Pregunta"].isin(bulk_ids)]["bloque"].unique()))
                             st.success(" | ".join(msgs)); reload_db(); st.rerun()
-                        else:
+                        elif msgs is not None:
                             st.warning("No hay cambios que aplicar.")
                 with bt2:
                     fr1, fr2 = st.columns(2)
@@ -964,10 +977,9 @@ with tab_man:
                             "notas": row_d.get("notas", "") or "",
                             "solucion": "",
                         }, nid)
-                        st.session_state.excel_dfs[blk] = pd.concat(
-                            [blk_df, pd.DataFrame([new_row_dup])], ignore_index=True)
-                        lib.guardar_excel_local(st.session_state.excel_path,
-                                                st.session_state.excel_dfs)
+                        with lib.transaccion(st.session_state.excel_path,
+                                             st.session_state.excel_dfs) as tx:
+                            tx.insertar(blk, [new_row_dup])
                         st.success(f"✅ Duplicada como **{nid}**")
                         sync_bloques_gsheets([blk]); reload_db(); st.rerun()
 
@@ -1058,12 +1070,14 @@ with tab_man:
                 with tempfile.NamedTemporaryFile(delete=False, suffix=".json") as tf:
                     tf.write(json_file.read())
                     tmp_json = tf.name
-                nuevas, dupes = lib.importar_preguntas_json(tmp_json, bloque_json, df_total)
+                nuevas, dupes = lib.importar_preguntas_json(tmp_json, bloque_json, df_total,
+                                                            indice=indice_similitud())
                 os.unlink(tmp_json)
                 if nuevas:
                     blk_df = _asegurar_bloque(st.session_state.excel_dfs, bloque_json)
+                    filas_json = []
                     for p in nuevas:
-                        new_row = _fill_row(blk_df, {
+                        filas_json.append(_fill_row(blk_df, {
                             "tema": p.get("Tema") or p.get("tema", "1"),
                             "dificultad": p.get("dificultad", "Media"),
                             "letra_correcta": p.get("letra_correcta", "A"),
@@ -1071,10 +1085,10 @@ with tab_man:
                             "opciones_list": p.get("opciones_list", []),
                             "usada": p.get("usada", ""),
                             "notas": p.get("notas", "") or "",
-                        }, p["ID_Pregunta"])
-                        blk_df = pd.concat([blk_df, pd.DataFrame([new_row])], ignore_index=True)
-                    st.session_state.excel_dfs[bloque_json] = blk_df
-                    lib.guardar_excel_local(st.session_state.excel_path, st.session_state.excel_dfs)
+                        }, p["ID_Pregunta"]))
+                    with lib.transaccion(st.session_state.excel_path,
+                                         st.session_state.excel_dfs) as tx:
+                        tx.insertar(bloque_json, filas_json)
                     st.success(f"✅ {len(nuevas)} importadas, {dupes} duplicadas omitidas.")
                     sync_bloques_gsheets([bloque_json])
                     reload_db()
@@ -1104,6 +1118,20 @@ with tab_stat:
             s = series.fillna("").astype(str)
             return int((s.str.strip().ne("") & ~s.isin(["nan", "None"])).sum())
 
+        def _fig_antiguedad(mascara=None):
+            """Barras de preguntas por meses desde su último uso (vectorizado sobre fecha_uso)."""
+            hist = indice_facetas().histograma_uso(mascara)
+            # Uso reciente en rojo → antiguo en verde; sin fecha / nunca en gris
+            colores = ["#c0392b", "#e67e22", "#f1c40f", "#27ae60"] + ["#bdc3c7"] * (len(hist) - 4)
+            fig = go.Figure(go.Bar(
+                x=list(hist), y=list(hist.values()), marker_color=colores,
+                text=list(hist.values()), textposition="outside",
+                hovertemplate="<b>%{x}</b><br>%{y} preguntas<extra></extra>",
+            ))
+            fig.update_layout(**_PLT_CFG, height=260, showlegend=False,
+                              yaxis=dict(title="Nº preguntas", gridcolor="#e9ecef"))
+            return fig
+
         total   = len(df)
         nunca   = int((df["usada"] == "").sum())
         usadas  = total - nunca
@@ -1283,6 +1311,9 @@ with tab_stat:
                 )
                 st.plotly_chart(fig_sol, use_container_width=True)
 
+                st.markdown("#### Antigüedad del último uso")
+                st.plotly_chart(_fig_antiguedad(), use_container_width=True)
+
         # ══════════════════════════════════════════════════════════════════════
         else:  # Bloque específico
         # ══════════════════════════════════════════════════════════════════════
@@ -1442,6 +1473,69 @@ with tab_stat:
                 )
                 st.plotly_chart(fig_sol_t, use_container_width=True)
 
+                st.markdown("#### Antigüedad del último uso")
+                st.plotly_chart(_fig_antiguedad(indice_facetas().mascara(bloque=sel_blq)),
+                                use_container_width=True)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# TAB · DUPLICADOS (auditoría de todo el banco)
+# ─────────────────────────────────────────────────────────────────────────────
+with tab_dup:
+    st.subheader("Auditoría de duplicados")
+    st.caption("Busca en todo el banco grupos de preguntas casi idénticas. Solo se "
+               "comparan las parejas con fragmentos de texto en común, repartidas "
+               "entre los núcleos del equipo.")
+    dc1, dc2, dc3 = st.columns([2, 2, 1])
+    umbral_enun = dc1.slider("Similitud mínima del enunciado", 0.75, 1.0,
+                             float(lib.SIMILITUD_DUPLICADO), 0.01, key="dup_umbral")
+    umbral_ops = dc2.slider("Similitud mínima de las opciones", 0.0, 1.0, 0.0, 0.05,
+                            key="dup_umbral_ops", help="0 = comparar solo el enunciado")
+    dc3.markdown("<div style='height:28px'></div>", unsafe_allow_html=True)
+    if dc3.button("🔍 Analizar", type="primary", key="btn_dup_audit",
+                  use_container_width=True, disabled=df_total.empty):
+        with st.spinner("Comparando preguntas…"):
+            grupos = lib.auditar_duplicados(df_total, umbral_enun, umbral_ops,
+                                            indice=indice_similitud())
+        st.session_state["_dup_audit"] = {
+            "version": st.session_state.get("db_version", 0), "grupos": grupos,
+            "omitidas": list(indice_similitud().cubetas_omitidas)}
+
+    audit = st.session_state.get("_dup_audit")
+    if audit and audit["version"] == st.session_state.get("db_version", 0):
+        grupos = audit["grupos"]
+        if audit.get("omitidas"):
+            st.warning(f"⚠️ Se han omitido {len(audit['omitidas'])} grupo(s) de más de 200 "
+                       "enunciados con texto casi común (p. ej. plantillas); los duplicados "
+                       "entre ellos pueden no aparecer.")
+        if not grupos:
+            st.success("✅ No se han encontrado preguntas duplicadas.")
+        else:
+            n_impl = sum(len(g["ids"]) for g in grupos)
+            st.markdown(f"**{len(grupos)}** grupo(s) · **{n_impl}** preguntas implicadas")
+            filas_dup = []
+            for n_g, g in enumerate(grupos, start=1):
+                for q in g["preguntas"]:
+                    uso = str(q.get("usada", "") or "").split(" ")[0]
+                    filas_dup.append({
+                        "Grupo": n_g,
+                        "ID": q["ID_Pregunta"],
+                        "Bloque": q.get("bloque", ""),
+                        "Tema": q.get("Tema", ""),
+                        "Último uso": uso or "—",
+                        "Sim. enunciado": f"{g['sim_enunciado']:.0%}",
+                        "Sim. opciones": f"{g['sim_opciones']:.0%}",
+                        "Enunciado": str(q.get("enunciado", ""))[:160],
+                    })
+            df_dup = pd.DataFrame(filas_dup)
+            st.dataframe(df_dup, hide_index=True, use_container_width=True,
+                         height=min(600, 38 + 35 * len(df_dup)))
+            st.download_button(
+                "⬇️ Descargar informe (CSV)",
+                df_dup.to_csv(index=False).encode("utf-8"),
+                file_name="duplicados.csv", mime="text/csv", key="btn_dup_csv",
+            )
+
 
 # ─────────────────────────────────────────────────────────────────────────────
 # TAB 5 · SOLUCIONES (editor batch interactivo)
@@ -1669,7 +1763,7 @@ with tab_const:
             _dfs2 = lib.save_datos_df(st.session_state.excel_dfs, df_new)
             st.session_state.excel_dfs    = _dfs2
             lib.guardar_excel_local(st.session_state.excel_path, _dfs2)
-            st.session_state["excel_bytes"] = lib.generar_excel_bytes(_dfs2)
+            marcar_db_cambiada()
             sync_bloques_gsheets([lib.DATOS_SHEET])  # sincronizar con Google Sheets si está conectado
 
         _datos_df = lib.get_datos_df(st.session_state.excel_dfs)
@@ -1833,11 +1927,11 @@ with tab_obj:
 
         def _save_obj_df(df_new):
             import pandas as _pd_obj
-            dfs2 = dict(st.session_state.excel_dfs)
+            dfs2 = st.session_state.excel_dfs
             dfs2[CFG_OBJ_SHEET] = df_new
             st.session_state.excel_dfs = dfs2
             lib.guardar_excel_local(st.session_state.excel_path, dfs2)
-            st.session_state["excel_bytes"] = lib.generar_excel_bytes(dfs2)
+            marcar_db_cambiada()
             st.session_state["cfg_objetivos"] = lib.get_cfg_objetivos(dfs2)
             sync_bloques_gsheets([CFG_OBJ_SHEET])
 
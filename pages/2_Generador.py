@@ -27,11 +27,12 @@ import examen_lib_latex as lib
 from app_utils import (
     init_session_state, render_sidebar, handle_oauth_callback, APP_CSS, page_header,
     reload_db, bloques_disponibles, temas_de_bloque, objetivos_de_tema,
-    es_uso_antiguo, render_question_card_html, mathjax_html,
+    render_question_card_html, mathjax_html,
     append_historial, save_preset, delete_preset,
     nombre_bloque, nombre_tema, nombre_objetivo,
     OUTPUT_DIR, _nsort,
-    _dialog_editar_pregunta, marcar_preguntas_usadas,
+    _dialog_editar_pregunta, marcar_preguntas_usadas, filtrar_por_busqueda, indice_facetas,
+    pesos_muestreo,
 )
 
 # ── Configuración ─────────────────────────────────────────────────────────────
@@ -419,19 +420,40 @@ with tab_sel:
     # ── Filtros (colapsables para maximizar espacio) ──────────────────────────
     with st.expander("🔍 Filtros", expanded=False):
         fc1, fc2, fc3, fc4, fc5 = st.columns(5)
-        f_bloque = fc1.selectbox("Bloque", ["Todos"] + bloques, key="sel_f_bloque")
+        facetas = indice_facetas()
+        _n_blq = facetas.contar("bloque")
+        f_bloque = fc1.selectbox("Bloque", ["Todos"] + bloques, key="sel_f_bloque",
+                                  format_func=lambda b: b if b == "Todos" else f"{b} ({_n_blq.get(b, 0)})")
+        _m_blq = facetas.mascara(bloque=None if f_bloque == "Todos" else f_bloque)
+        _n_tema = facetas.contar("tema", _m_blq)
         temas_disp = (temas_de_bloque(f_bloque) if f_bloque != "Todos"
                       else sorted(df_total["Tema"].unique().tolist(), key=_nsort))
         f_tema   = fc2.selectbox("Tema", ["Todos"] + [str(t) for t in temas_disp],
                                   key="sel_f_tema",
-                                  format_func=lambda t: "Todos" if t == "Todos" else nombre_tema(t))
+                                  format_func=lambda t: "Todos" if t == "Todos"
+                                  else f"{nombre_tema(t)} ({_n_tema.get(t, 0)})")
+        _n_dif = facetas.contar("dificultad", _m_blq & facetas.mascara(
+            tema=None if f_tema == "Todos" else f_tema))
         f_dif    = fc3.selectbox("Dificultad", ["Todas", "Facil", "Media", "Dificil"],
-                                  key="sel_f_dif")
+                                  key="sel_f_dif",
+                                  format_func=lambda d: d if d == "Todas"
+                                  else f"{d} ({_n_dif.get(d.lower(), 0)})")
         f_uso    = fc4.selectbox(
-            "Uso", ["Todos", "Nunca usada", "Usada", "Usada >6 meses", "Usada >12 meses"],
+            "Uso", ["Todos", "Nunca usada", "Usada", "Usada >6 meses", "Usada >12 meses",
+                    "Usada hace > N meses", "En últimos N exámenes"],
             key="sel_f_uso"
         )
+        f_uso_n  = None
+        if f_uso == "Usada hace > N meses":
+            f_uso_n = fc4.number_input("Meses", min_value=1, max_value=120, value=18, step=1,
+                                       key="sel_f_uso_meses", label_visibility="collapsed")
+        elif f_uso == "En últimos N exámenes":
+            f_uso_n = fc4.number_input("Exámenes", min_value=1, max_value=50, value=3, step=1,
+                                       key="sel_f_uso_examenes", label_visibility="collapsed",
+                                       help="Cada fecha de uso distinta cuenta como un examen")
         f_search = fc5.text_input("Buscar", placeholder="Texto...", key="sel_search")
+        f_fuzzy  = fc5.checkbox("≈ Tolerar erratas", key="sel_search_fuzzy",
+                                help="Encuentra palabras parecidas y ordena por parecido")
         _coms_disp = sorted({c for c in df_total.get("comentario", pd.Series(dtype=str)).dropna() if c})
         _objs_disp = sorted({str(o) for o in df_total.get("objetivo", pd.Series(dtype=str)).dropna() if str(o).strip()})
         _has_extra = bool(_coms_disp) or bool(_objs_disp)
@@ -444,35 +466,21 @@ with tab_sel:
             f_com = "Todas"
             f_obj = "Todos"
 
-    # Aplicar filtros
-    df_filt = df_total.copy()
-    df_filt = df_filt[~df_filt["ID_Pregunta"].isin(sel_ids_actual)]
-    if f_bloque != "Todos":
-        df_filt = df_filt[df_filt["bloque"] == f_bloque]
-    if f_tema != "Todos":
-        df_filt = df_filt[df_filt["Tema"].astype(str) == f_tema]
-    if f_dif != "Todas":
-        df_filt = df_filt[df_filt["dificultad"].str.lower() == f_dif.lower()]
-    if f_uso == "Nunca usada":
-        df_filt = df_filt[df_filt["usada"] == ""]
-    elif f_uso == "Usada":
-        df_filt = df_filt[df_filt["usada"] != ""]
-    elif f_uso == "Usada >6 meses":
-        df_filt = df_filt[df_filt["usada"].apply(lambda v: es_uso_antiguo(v, 6))]
-    elif f_uso == "Usada >12 meses":
-        df_filt = df_filt[df_filt["usada"].apply(lambda v: es_uso_antiguo(v, 12))]
+    # Aplicar filtros (máscaras precalculadas por versión de la BD)
+    _meses_uso = {"Usada >6 meses": 6, "Usada >12 meses": 12, "Usada hace > N meses": f_uso_n}
+    mask = facetas.mascara(
+        bloque=None if f_bloque == "Todos" else f_bloque,
+        tema=None if f_tema == "Todos" else f_tema,
+        dificultad=None if f_dif == "Todas" else f_dif,
+        usada={"Nunca usada": False, "Usada": True}.get(f_uso),
+        antes_de_meses=_meses_uso.get(f_uso),
+        ultimos_examenes=f_uso_n if f_uso == "En últimos N exámenes" else None,
+        comentario=None if f_com == "Todas" else f_com,
+        objetivo=None if f_obj == "Todos" else f_obj,
+    )
+    df_filt = df_total[mask & ~df_total["ID_Pregunta"].isin(sel_ids_actual).to_numpy()]
     if f_search:
-        q = f_search.lower()
-        mask = df_filt["enunciado"].str.lower().str.contains(q, na=False)
-        ops_mask = df_filt["opciones_list"].apply(
-            lambda ops: any(q in str(o).lower() for o in ops)
-            if isinstance(ops, list) else False
-        )
-        df_filt = df_filt[mask | ops_mask]
-    if f_com != "Todas" and "comentario" in df_filt.columns:
-        df_filt = df_filt[df_filt["comentario"] == f_com]
-    if f_obj != "Todos" and "objetivo" in df_filt.columns:
-        df_filt = df_filt[df_filt["objetivo"].astype(str) == f_obj]
+        df_filt = filtrar_por_busqueda(df_filt, f_search, aproximada=f_fuzzy)
 
     # ═══════════════════════════════════════════════════════════════════════════
     # LAYOUT 3 COLUMNAS: disponibles | preview | fijas
@@ -1610,6 +1618,9 @@ with tab_prev:
     # ── Controles ─────────────────────────────────────────────────────────────
     ctrl1, ctrl2, ctrl3, ctrl4, ctrl5 = st.columns([2, 2, 2, 1, 1])
     show_sol  = ctrl1.checkbox("Mostrar soluciones ✓", value=True, key="prev_show_sol")
+    ponderar  = ctrl1.checkbox("Priorizar poco usadas", value=True, key="prev_ponderar_uso",
+                               help="La receta automática elige con menos probabilidad las preguntas "
+                                    "usadas hace poco o muchas veces (según el historial de uso)")
     ord_prev  = ctrl2.selectbox("Orden",
                     ["Por bloques", "Por temas", "Global aleatorio", "Manual (selección)", "Sin barajar (ID)"],
                     key="prev_ord")
@@ -1628,71 +1639,19 @@ with tab_prev:
             st.warning("⚠️ Sin preguntas seleccionadas ni receta automática — ve a la pestaña Selección.")
         else:
             rng          = random.Random(seed_prev if seed_prev else None)
-            df_lookup    = df_total.set_index("ID_Pregunta").to_dict("index")
             exam_ids     = list(sel_prev)     # empezar con las manuales fijas
-            already_used = set(exam_ids)
-            warns_gen    = []
 
             # ── Aplicar receta automática ─────────────────────────────────────
-            for bloque, temas_cfg in auto_rec.items():
-                for tema_key, dif_cfg in temas_cfg.items():
-                    for dif_name, n_req in dif_cfg.items():
-                        if n_req <= 0:
-                            continue
-                        if tema_key == "__ALL__":
-                            already_fixed = [
-                                p for p in sel_prev
-                                if df_lookup.get(p, {}).get("bloque", "") == bloque
-                                and df_lookup.get(p, {}).get("dificultad", "").lower() == dif_name.lower()
-                            ]
-                            pool_ids = df_total[
-                                (df_total["bloque"] == bloque) &
-                                (df_total["dificultad"].str.lower() == dif_name.lower()) &
-                                (~df_total["ID_Pregunta"].isin(already_used))
-                            ]["ID_Pregunta"].tolist()
-                            label_str = "(cualquier tema)"
-                        elif tema_key.startswith("__OBJ_"):
-                            obj_cod = tema_key[len("__OBJ_"):]
-                            already_fixed = [
-                                p for p in sel_prev
-                                if df_lookup.get(p, {}).get("bloque", "") == bloque
-                                and str(df_lookup.get(p, {}).get("objetivo", "")) == obj_cod
-                                and df_lookup.get(p, {}).get("dificultad", "").lower() == dif_name.lower()
-                            ]
-                            _obj_mask = (
-                                (df_total["bloque"] == bloque) &
-                                (df_total["dificultad"].str.lower() == dif_name.lower()) &
-                                (~df_total["ID_Pregunta"].isin(already_used))
-                            )
-                            if "objetivo" in df_total.columns:
-                                _obj_mask &= (df_total["objetivo"].astype(str) == obj_cod)
-                            pool_ids = df_total[_obj_mask]["ID_Pregunta"].tolist()
-                            label_str = f"Obj {obj_cod}"
-                        else:
-                            already_fixed = [
-                                p for p in sel_prev
-                                if df_lookup.get(p, {}).get("bloque", "") == bloque
-                                and str(df_lookup.get(p, {}).get("Tema", "")) == str(tema_key)
-                                and df_lookup.get(p, {}).get("dificultad", "").lower() == dif_name.lower()
-                            ]
-                            pool_ids = df_total[
-                                (df_total["bloque"] == bloque) &
-                                (df_total["Tema"].astype(str) == str(tema_key)) &
-                                (df_total["dificultad"].str.lower() == dif_name.lower()) &
-                                (~df_total["ID_Pregunta"].isin(already_used))
-                            ]["ID_Pregunta"].tolist()
-                            label_str = f"Tema {tema_key}"
-
-                        needed = max(0, n_req - len(already_fixed))
-                        actual = min(needed, len(pool_ids))
-                        picked = rng.sample(pool_ids, actual) if actual > 0 else []
-                        if actual < needed:
-                            warns_gen.append(
-                                f"**{bloque}** {label_str} {dif_name}: "
-                                f"receta={n_req}, fijas={len(already_fixed)}, añadidas={actual}"
-                            )
-                        exam_ids.extend(picked)
-                        already_used.update(picked)
+            auto_ids, faltas = lib.aplicar_receta(df_total, auto_rec, sel_prev, rng,
+                                                  pesos=pesos_muestreo() if ponderar else None)
+            exam_ids.extend(auto_ids)
+            warns_gen = [
+                f"**{f['bloque']}** {f['etiqueta']} {f['dificultad']}: "
+                f"receta={f['pedidas']}, fijas={f['fijas']}, añadidas={f['añadidas']}"
+                + (f" · compite con {', '.join(f'{e} {d}' for _, e, d in f['conflicto'])} "
+                   f"por {f['disponibles']} preguntas" if f["conflicto"] else "")
+                for f in faltas
+            ]
 
             st.session_state["gen_warnings"] = warns_gen
 
@@ -1858,13 +1817,33 @@ def _inject_formulario_tex(tex_str: str, formulario_name: str) -> str:
     return tex_str.replace("\\end{document}", inc + "\\end{document}")
 
 
+# ── Helper: etiquetas de versión por alumno ──────────────────────────────────
+def _etiquetas_alumnos(texto):
+    """Identificadores de alumno únicos, en orden, aptos para nombres de archivo y LaTeX."""
+    vistos = []
+    for linea in str(texto or "").splitlines():
+        et = re.sub(r"[^0-9A-Za-z\-]+", "-", linea.strip()).strip("-")
+        if et and et not in vistos:
+            vistos.append(et)
+    return vistos
+
+
+def _num_versiones(cfg):
+    """Nº de versiones a exportar y sus etiquetas (None → letras A–F)."""
+    if cfg.get("por_alumno"):
+        alumnos = _etiquetas_alumnos(cfg.get("alumnos_txt", ""))
+        if alumnos:
+            return len(alumnos), alumnos
+    return cfg.get("vers", 1), None
+
+
 # ── Helper: ejecutar exportación completa en memoria ─────────────────────────
 def _ejecutar_export():
     """Genera todos los archivos en memoria y los guarda en session_state['export_files']."""
     cfg          = st.session_state.get("exam_cfg", {})
     sel_actual   = get_sel_ids()
     nombre_arch  = cfg.get("file", f"Examen_{datetime.date.today()}")
-    n_mod        = cfg.get("vers", 1)
+    n_mod, etiquetas_version = _num_versiones(cfg)
     exp_word     = cfg.get("exp_word", True)
     exp_tex      = cfg.get("exp_tex",  True)
 
@@ -1904,6 +1883,7 @@ def _ejecutar_export():
         "barajar_por_bloques": cfg.get("ord", "bloques") == "bloques",
         "barajar_por_temas":   cfg.get("ord", "bloques") == "temas",
         "barajar_respuestas":  cfg.get("bar", True),
+        "etiquetas_version":   etiquetas_version,
         "frases_anclaje_extra": cfg.get("anc_txt","") if cfg.get("anc_chk", True) else "",
         "sol_negrita": cfg.get("sol_bold",  False),
         "sol_color":   cfg.get("sol_color", "red"),
@@ -2111,19 +2091,10 @@ def _ejecutar_export():
 
     ef["zip_bytes"] = lib.generar_zip_bytes(ef["_zip_all"])
 
-    # Marcar preguntas como usadas en la DB
+    # Marcar preguntas como usadas en la DB (una transacción → un único guardado)
     hoy = datetime.date.today().strftime("%Y-%m-%d")
-    dfs = st.session_state.excel_dfs
-    for bloque_name, df_sheet in dfs.items():
-        head    = [str(h).lower().strip() for h in df_sheet.columns]
-        idx_id  = next((i for i, h in enumerate(head) if "id_preg" in h or h == "id"), -1)
-        idx_usa = next((i for i, h in enumerate(head) if "usada" in h or "fecha" in h), -1)
-        if idx_id == -1 or idx_usa == -1: continue
-        id_col  = df_sheet.columns[idx_id]
-        usa_col = df_sheet.columns[idx_usa]
-        mask = df_sheet[id_col].astype(str).isin([str(pid) for pid in sel_actual])
-        df_sheet.loc[mask, usa_col] = hoy
-    reload_db()
+    if not marcar_preguntas_usadas(sel_actual, hoy, nombre_arch):
+        reload_db()
 
     # Historial — estadísticas de dificultad y bloques
     _df_exp = st.session_state.df_preguntas
@@ -2157,7 +2128,7 @@ def _dialog_confirmar_export():
     auto_rec = st.session_state.get("auto_recipe", {})
     n_rec    = sum(int(v) for bd in auto_rec.values() for sd in bd.values()
                    if isinstance(sd, dict) for v in sd.values() if isinstance(v, (int, float)))
-    n_mod    = cfg.get("vers", 1)
+    n_mod, _ = _num_versiones(cfg)
     _lbl     = (f"{len(sel)} fijas + ~{n_rec} auto" if sel and n_rec
                 else f"~{n_rec} auto" if n_rec else str(len(sel)))
     st.markdown(f"**{_lbl} preguntas · {n_mod} modelo(s)**")
@@ -2689,6 +2660,15 @@ with tab_exp:
                                         format_func=lambda x: x[0], key="exp_ord")
             orden       = orden_val[1]
             barajar     = oc3.checkbox("Barajar respuestas", value=cfg.get("bar", True), key="exp_bar")
+            por_alumno  = st.checkbox("Una versión por alumno", value=cfg.get("por_alumno", False),
+                                      key="exp_por_alumno",
+                                      help="Genera una versión distinta por cada alumno de la lista "
+                                           "(ignora «Nº Modelos»). La versión se etiqueta con su identificador.")
+            alumnos_txt = cfg.get("alumnos_txt", "")
+            if por_alumno:
+                alumnos_txt = st.text_area("Alumnos (uno por línea: DNI, NIU…)", value=alumnos_txt,
+                                           key="exp_alumnos", height=120)
+                st.caption(f"ℹ️ {len(_etiquetas_alumnos(alumnos_txt))} versiones distintas.")
 
             st.markdown("**Modo de partes:**")
             _partes_opts = [
@@ -3098,6 +3078,7 @@ with tab_exp:
             "inst": inst, "asig": asig, "tipo": tipo, "fecha": fecha, "tiem": tiem,
             "file": nombre_archivo, "ins": instr, "h1": info_fund, "h2": info_test,
             "vers": num_modelos, "ord": orden, "bar": barajar,
+            "por_alumno": por_alumno, "alumnos_txt": alumnos_txt,
             "opciones_cols": opciones_cols, "campos_alumno": campos_alumno,
             "exp_word": exp_word, "exp_tex": exp_tex,
             "sol_bold": sol_bold, "sol_color": sol_color, "sol_ast": sol_ast,
@@ -3188,6 +3169,7 @@ with tab_exp:
         _tpl_rows = ""
         if exp_word: _tpl_rows += f'<div style="opacity:0.8">📎 Word: {_tpl_w}</div>'
         if exp_tex:  _tpl_rows += f'<div style="opacity:0.8">📎 LaTeX: {_tpl_t}</div>'
+        _n_vers, _ = _num_versiones(st.session_state.exam_cfg)
 
         st.markdown(
             f"""<div style="background:linear-gradient(135deg,#1a252f,#2c3e50);color:white;
@@ -3196,7 +3178,7 @@ with tab_exp:
             <div style="opacity:0.65;font-size:0.82em;margin-bottom:10px">
               {inst or '—'} &nbsp;·&nbsp; {fecha or '—'} &nbsp;·&nbsp; {tiem or '—'}</div>
             <hr style="border-color:rgba(255,255,255,0.15);margin:8px 0">
-            <div>📋 <b>{n_pregs if not n_recipe else (f"{n_pregs} fijas + ~{n_recipe} auto" if n_pregs else f"~{n_recipe} auto")}</b> test{_dev_str} &nbsp;&nbsp; 🔢 <b>{num_modelos}</b> modelo(s)</div>
+            <div>📋 <b>{n_pregs if not n_recipe else (f"{n_pregs} fijas + ~{n_recipe} auto" if n_pregs else f"~{n_recipe} auto")}</b> test{_dev_str} &nbsp;&nbsp; 🔢 <b>{_n_vers}</b> modelo(s)</div>
             <div>🔀 {_orden_label}</div>
             <div>🃏 Barajar respuestas: {_barajar_str}</div>
             <div>📦 {_fmt_str}</div>
@@ -5,7 +5,8 @@ Pestañas:
   1. General   – Datos de la asignatura (asignatura, grado, año, dpto, notas)
   2. Bloques   – Nombres descriptivos de bloques
   3. Temas     – Nombres de temas con contador de preguntas
-  4. Backup    – Exportar / importar configuración como JSON
+  4. Backup    – Exportar / importar configuración como JSON y restaurar
+                copias de seguridad del libro
 """
 import json
 import io
@@ -21,7 +22,7 @@ import examen_lib_latex as lib
 from app_utils import (
     init_session_state, render_sidebar, handle_oauth_callback,
     APP_CSS, page_header, _load_cfg, _nsort,
-    sync_bloques_gsheets, sync_hoja_gsheets, reload_db,
+    sync_bloques_gsheets, sync_hoja_gsheets, reload_db, marcar_db_cambiada,
 )
 
 st.set_page_config(page_title="Configuración · Exámenes UCM", page_icon="⚙️", layout="wide")
@@ -38,7 +39,7 @@ if not st.session_state.db_connected:
 
 # ── Asegurar que las hojas de config existen y están sincronizadas ────────────
 dfs = st.session_state.excel_dfs
-dfs = lib.init_cfg_from_data(dfs)
+dfs = lib.init_cfg_from_data(dfs, st.session_state.df_preguntas["Tema"])
 st.session_state.excel_dfs = dfs
 
 bloques_list  = st.session_state.bloques
@@ -93,9 +94,9 @@ with tab_gen:
     if st.button("💾 Guardar datos generales", type="primary", key="btn_save_gen"):
         cfg_g_new = {**cfg_g, **new_vals}
         dfs = lib.save_cfg_general(st.session_state.excel_dfs, cfg_g_new)
-        dfs = _load_cfg(dfs)
+        dfs = _load_cfg(dfs, df_preguntas)
         st.session_state.excel_dfs   = dfs
-        st.session_state.excel_bytes = lib.generar_excel_bytes(dfs)
+        marcar_db_cambiada()
         path = st.session_state.get("excel_path", "")
         if path:
             lib.guardar_excel_local(path, dfs)
@@ -168,9 +169,9 @@ with tab_bloques:
         # Guardar sin la columna de conteo
         save_b = edited_b[["Bloque", "Descripcion"]].copy()
         dfs = lib.save_cfg_bloques(st.session_state.excel_dfs, save_b)
-        dfs = _load_cfg(dfs)
+        dfs = _load_cfg(dfs, df_preguntas)
         st.session_state.excel_dfs  = dfs
-        st.session_state.excel_bytes = lib.generar_excel_bytes(dfs)
+        marcar_db_cambiada()
         path = st.session_state.get("excel_path", "")
         if path:
             lib.guardar_excel_local(path, dfs)
@@ -272,9 +273,9 @@ with tab_temas:
             pass
 
         dfs = lib.save_cfg_temas(st.session_state.excel_dfs, merged)
-        dfs = _load_cfg(dfs)
+        dfs = _load_cfg(dfs, df_preguntas)
         st.session_state.excel_dfs   = dfs
-        st.session_state.excel_bytes = lib.generar_excel_bytes(dfs)
+        marcar_db_cambiada()
         path = st.session_state.get("excel_path", "")
         if path:
             lib.guardar_excel_local(path, dfs)
@@ -347,9 +348,9 @@ with tab_obj:
         save_o = edited_o[["Codigo", "Nombre_corto", "Descripcion", "Bloque", "Tema"]].copy()
         save_o = save_o[save_o["Codigo"].astype(str).str.strip() != ""].reset_index(drop=True)
         dfs2 = lib.save_cfg_objetivos(st.session_state.excel_dfs, save_o)
-        dfs2 = _load_cfg(dfs2)
+        dfs2 = _load_cfg(dfs2, df_preguntas)
         st.session_state.excel_dfs   = dfs2
-        st.session_state.excel_bytes = lib.generar_excel_bytes(dfs2)
+        marcar_db_cambiada()
         path = st.session_state.get("excel_path", "")
         if path:
             lib.guardar_excel_local(path, dfs2)
@@ -519,9 +520,9 @@ with tab_backup:
                 dfs = lib.save_cfg_bloques(dfs, new_b_df)
                 dfs = lib.save_cfg_temas(dfs, new_t_df)
                 dfs = lib.save_cfg_objetivos(dfs, new_o_df)
-                dfs = _load_cfg(dfs)
+                dfs = _load_cfg(dfs, df_preguntas)
                 st.session_state.excel_dfs   = dfs
-                st.session_state.excel_bytes = lib.generar_excel_bytes(dfs)
+                marcar_db_cambiada()
                 path = st.session_state.get("excel_path", "")
                 if path:
                     lib.guardar_excel_local(path, dfs)
@@ -533,3 +534,45 @@ with tab_backup:
                 st.rerun()
             except Exception as e:
                 st.error(f"❌ Error al importar: {e}")
+
+    # ── Copias de seguridad del libro ─────────────────────────────────────────
+    st.divider()
+    st.markdown("#### 🕓 Copias de seguridad")
+    _bk_path = st.session_state.get("excel_path", "")
+    if not _bk_path:
+        st.info("Las copias de seguridad solo están disponibles con una base de datos local.")
+    else:
+        st.caption(
+            "Cada guardado deja una instantánea en `_backups/` (las hojas sin cambios no se "
+            "duplican). Se conservan todas las de la última hora, una por hora durante un día "
+            "y una por día durante un mes."
+        )
+        _almacen = lib.AlmacenBackups(_bk_path)
+        _snaps = list(reversed(_almacen.listar()))
+        if not _snaps:
+            st.info("Todavía no hay copias de seguridad de esta base de datos.")
+        else:
+            _fmt_snap = {
+                s["id"]: f"{s['actualizado'].replace('T', ' ')} · "
+                         f"{'estado previo en disco' if s['origen'] == 'disco' else 'guardado'} · "
+                         f"{len(s['hojas'])} hojas"
+                for s in _snaps
+            }
+            bk1, bk2 = st.columns([3, 1])
+            with bk1:
+                _snap_id = st.selectbox("Instantánea", list(_fmt_snap), format_func=_fmt_snap.get,
+                                        key="bk_snap_sel")
+            with bk2:
+                st.markdown("<br>", unsafe_allow_html=True)
+                _base = os.path.splitext(os.path.basename(_bk_path))[0]
+                # El .xlsx se reconstruye al pulsar (en otro hilo): solo a partir de la
+                # instantánea elegida al pintar el botón, nunca del libro de la sesión
+                st.download_button(
+                    "🧱 Reconstruir .xlsx",
+                    data=lambda ruta=_bk_path, i=_snap_id: lib.generar_excel_bytes(
+                        lib.AlmacenBackups(ruta).cargar(i)),
+                    file_name=f"{_base}_restaurado_{_snap_id}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    key="btn_bk_descargar",
+                    use_container_width=True,
+                )
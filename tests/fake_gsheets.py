@@ -0,0 +1,97 @@
+"""Hoja de cálculo falsa con la interfaz de gspread.Spreadsheet que usa SesionGSheets.
+
+Guarda cada pestaña como una cuadrícula de strings, aplica las peticiones de
+batch_update que emite la sincronización (deleteDimension, appendDimension,
+updateCells) y registra todas las llamadas para poder comprobarlas.
+"""
+import gspread
+
+
+class FakeWorksheet:
+    def __init__(self, title, sheet_id, rows, cols):
+        self.title, self.id = title, sheet_id
+        self.row_count, self.col_count = rows, cols
+        self.grid = [[""] * cols for _ in range(rows)]
+
+    def get_all_values(self):
+        g = [list(r) for r in self.grid]
+        while g and not any(g[-1]):
+            g.pop()
+        ancho = max([max([j + 1 for j, v in enumerate(r) if v] or [0]) for r in g] or [0])
+        return [r[:ancho] for r in g]
+
+
+class FakeSpreadsheet:
+    title = "Banco falso"
+
+    def __init__(self):
+        self.ws = {}
+        self.llamadas = []      # (método, argumento)
+
+    def _por_id(self, sheet_id):
+        return next(w for w in self.ws.values() if w.id == sheet_id)
+
+    # ── Lecturas ──
+    def fetch_sheet_metadata(self):
+        self.llamadas.append(("fetch_sheet_metadata", None))
+        return {"sheets": [{"properties": {
+            "sheetId": w.id, "title": t,
+            "gridProperties": {"rowCount": w.row_count, "columnCount": w.col_count}}}
+            for t, w in self.ws.items()]}
+
+    def values_get(self, rango):
+        self.llamadas.append(("values_get", rango))
+        titulo = rango.strip("'").split("'!")[0]
+        return {"values": self.ws[titulo].get_all_values()}
+
+    def values_batch_get(self, rangos):
+        self.llamadas.append(("values_batch_get", list(rangos)))
+        return {"valueRanges": [{"range": r, "values": self.ws[r.strip("'")].get_all_values()}
+                                for r in rangos]}
+
+    # ── Escrituras ──
+    def worksheet(self, titulo):
+        if titulo not in self.ws:
+            raise gspread.exceptions.WorksheetNotFound(titulo)
+        return self.ws[titulo]
+
+    def add_worksheet(self, title, rows, cols):
+        self.llamadas.append(("add_worksheet", title))
+        w = FakeWorksheet(title, len(self.ws) + 1, rows, cols)
+        self.ws[title] = w
+        return w
+
+    def batch_update(self, body):
+        self.llamadas.append(("batch_update", body))
+        for req in body["requests"]:
+            (tipo, v), = req.items()
+            if tipo == "deleteDimension":
+                r = v["range"]
+                w = self._por_id(r["sheetId"])
+                del w.grid[r["startIndex"]:r["endIndex"]]
+                w.row_count = len(w.grid)
+            elif tipo == "appendDimension":
+                w = self._por_id(v["sheetId"])
+                if v["dimension"] == "ROWS":
+                    w.grid += [[""] * w.col_count for _ in range(v["length"])]
+                    w.row_count = len(w.grid)
+                else:
+                    for fila in w.grid:
+                        fila += [""] * v["length"]
+                    w.col_count += v["length"]
+            elif tipo == "updateCells":
+                r = v["range"]
+                w = self._por_id(r["sheetId"])
+                assert r["endRowIndex"] <= w.row_count and r["endColumnIndex"] <= w.col_count
+                celdas = v["rows"][0]["values"]
+                for j, c in enumerate(celdas):
+                    w.grid[r["startRowIndex"]][r["startColumnIndex"] + j] = \
+                        c.get("userEnteredValue", {}).get("stringValue", "")
+            else:
+                raise NotImplementedError(tipo)
+        return {}
+
+    def peticiones(self):
+        """Peticiones del último batch_update, como (tipo, cuerpo)."""
+        body = next(a for m, a in reversed(self.llamadas) if m == "batch_update")
+        return [next(iter(r.items())) for r in body["requests"]]
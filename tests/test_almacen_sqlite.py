@@ -0,0 +1,54 @@
+import sqlite3
+
+import pandas as pd
+
+import examen_lib_latex as lib
+
+
+def _libro():
+    return {
+        "Bloque 1": pd.DataFrame({
+            "ID_Pregunta": ["B1-1", "B1-2"],
+            "Enunciado":   ["uno", "dos"],
+            "Usada":       pd.to_datetime(["2024-03-05", None]),
+            "Puntos":      [1, 2],
+        }),
+        lib.DATOS_SHEET: pd.DataFrame({"ID": ["c"], "Valor": ["3e8"]}),
+    }
+
+
+def test_ida_y_vuelta_conserva_fechas(tmp_path):
+    db = str(tmp_path / "banco.db")
+    lib.guardar_sqlite(db, _libro())
+    r = lib.cargar_sqlite(db)
+    assert pd.api.types.is_datetime64_any_dtype(r["Bloque 1"]["Usada"])
+    assert r["Bloque 1"]["Usada"].iloc[0] == pd.Timestamp("2024-03-05")
+    assert pd.isna(r["Bloque 1"]["Usada"].iloc[1])
+
+
+def test_cambio_de_fila_mantiene_tipos(tmp_path):
+    db = str(tmp_path / "banco.db")
+    lib.guardar_sqlite(db, _libro())
+    r = lib.cargar_sqlite(db)
+    r["Bloque 1"].loc[0, "Enunciado"] = "editado"
+    lib.sqlite_aplicar_cambios(db, r, actualizados=["B1-1"])
+    df = lib.cargar_sqlite(db)["Bloque 1"]
+    assert df["Enunciado"].iloc[0] == "editado"
+    assert pd.api.types.is_datetime64_any_dtype(df["Usada"])
+
+
+def test_exportar_a_excel_escribe_fechas(tmp_path):
+    db = str(tmp_path / "banco.db")
+    lib.guardar_sqlite(db, _libro())
+    xlsx = lib.exportar_sqlite_a_excel(db)
+    df = pd.read_excel(xlsx, sheet_name="Bloque 1")
+    assert pd.api.types.is_datetime64_any_dtype(df["Usada"])
+
+
+def test_base_sin_columna_fechas(tmp_path):
+    db = str(tmp_path / "antigua.db")
+    with sqlite3.connect(db) as con:
+        con.execute("CREATE TABLE hojas (nombre TEXT PRIMARY KEY, orden INTEGER NOT NULL, "
+                    "tipo TEXT NOT NULL, columnas TEXT NOT NULL)")
+        con.execute("INSERT INTO hojas VALUES ('B', 0, 'preguntas', '[\"ID_Pregunta\"]')")
+    assert list(lib.cargar_sqlite(db)["B"].columns) == ["ID_Pregunta"]
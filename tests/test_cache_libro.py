@@ -0,0 +1,96 @@
+import os
+
+import pandas as pd
+
+import examen_lib_latex as lib
+
+
+def _libro():
+    return {
+        "Bloque 1": pd.DataFrame({"ID_Pregunta": ["B1-1", "B1-2"], "Enunciado": ["a", "b"],
+                                  "Usada": pd.to_datetime(["2024-03-05", None])}),
+        "Bloque 2": pd.DataFrame({"ID_Pregunta": ["B2-1"], "Enunciado": ["c"], "Tema": [3]}),
+    }
+
+
+def _objetos(path):
+    d = os.path.join(lib._cache_dir(path), "objetos")
+    return set(os.listdir(d)) if os.path.isdir(d) else set()
+
+
+def _xlsx(tmp_path):
+    path = str(tmp_path / "banco.xlsx")
+    lib._escribir_xlsx(path, _libro())
+    return path
+
+
+def test_cache_feather_sin_pickle(tmp_path):
+    path = _xlsx(tmp_path)
+    lib.CacheLibro(path).escribir_hojas(lib.cargar_excel_local(path))
+    ficheros = [f for _, _, fs in os.walk(tmp_path / "_cache") for f in fs]
+    assert ficheros and all(f == "manifest.json" or f.endswith(".feather") for f in ficheros)
+
+    libro = lib.CacheLibro(path).leer_hojas()
+    assert isinstance(libro, lib.LibroHojas) and not libro.hojas_sucias()
+    for nombre, df in lib.cargar_excel_local(path).items():
+        pd.testing.assert_frame_equal(libro[nombre], df)
+
+
+def test_archivo_modificado_invalida(tmp_path):
+    path = _xlsx(tmp_path)
+    lib.CacheLibro(path).escribir_hojas(lib.cargar_excel_local(path))
+    otro = _libro()
+    otro["Bloque 2"].loc[0, "Enunciado"] = "cambiado fuera"
+    lib._escribir_xlsx(path, otro)
+    assert lib.CacheLibro(path).leer_hojas() is None
+
+
+def test_guardado_refresca_solo_hojas_sucias(tmp_path):
+    path = _xlsx(tmp_path)
+    cache = lib.CacheLibro(path)
+    libro = lib.cargar_excel_local(path)
+    cache.escribir_hojas(libro)
+    cache.escribir_derivados("preguntas", {n: libro[n] for n in libro})
+    antes = _objetos(path)
+
+    libro["Bloque 1"].loc[0, "Enunciado"] = "editado"
+    libro.marcar_sucia("Bloque 1")
+    lib.guardar_excel_local(path, libro)
+
+    cache = lib.CacheLibro(path)
+    assert cache.valida
+    assert len(_objetos(path) - antes) == 1          # solo la hoja editada
+    assert cache.leer_hojas()["Bloque 1"].loc[0, "Enunciado"] == "editado"
+    assert cache.leer_derivado("preguntas", "Bloque 1") is None
+    assert cache.leer_derivado("preguntas", "Bloque 2") is not None
+
+
+def test_cache_de_formato_anterior_se_ignora(tmp_path):
+    path = _xlsx(tmp_path)
+    d = lib._cache_dir(path)
+    os.makedirs(d)
+    with open(os.path.join(d, "manifest.json"), "w") as f:
+        f.write('{"ruta": "%s", "mtime_ns": 0, "size": 0, "sha256": ""}' % os.path.abspath(path))
+    assert lib.CacheLibro(path).leer_hojas() is None
+
+
+def test_columnas_mezcladas_y_listas(tmp_path):
+    path = _xlsx(tmp_path)
+    cache = lib.CacheLibro(path)
+    cache.escribir_hojas(lib.cargar_excel_local(path))
+    df = pd.DataFrame({
+        "Mezcla": pd.Series([1, "dos", None, 4.5], dtype=object),
+        "Enteros": pd.Series([1, None, 3, None], dtype=object),
+        "opciones_list": [["a", "b"], [], ["c"], ["d", "e", "f"]],
+        "Num": [1, 2, 3, 4],
+    })
+    cache.escribir_derivados("preguntas", {"Bloque 1": df})
+
+    cache = lib.CacheLibro(path)
+    leido = cache.leer_derivado("preguntas", "Bloque 1")
+    assert list(leido["Mezcla"].fillna("")) == ["1", "dos", "", "4.5"]   # se guarda como texto
+    assert list(leido["Enteros"]) == [1, None, 3, None]
+    assert list(leido["opciones_list"]) == list(df["opciones_list"])
+    assert leido["Num"].dtype == "int64"
+    tipos = [t for t in cache._man["tipos"].values() if "Mezcla" in t]
+    assert tipos == [{"Mezcla": "object", "Enteros": "object", "opciones_list": "object", "Num": "int64"}]
@@ -0,0 +1,75 @@
+import os
+
+import pandas as pd
+from streamlit.testing.v1 import AppTest
+
+import examen_lib_latex as lib
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Conecta (dos veces: la segunda con la caché en disco caliente) y abre la página
+_SCRIPT = """
+import runpy
+import streamlit as st
+from app_utils import init_session_state, connect_db
+init_session_state()
+if not st.session_state.get("_conectado_test"):
+    connect_db({path!r})
+    connect_db({path!r})
+    st.session_state["_conectado_test"] = True
+st.set_page_config = lambda *a, **k: None
+runpy.run_path({pagina!r}, run_name="__main__")
+"""
+
+
+def _banco(path):
+    hojas = {}
+    for b in (1, 2, 3):
+        n = 20
+        hojas[f"Bloque {b}"] = pd.DataFrame({
+            "ID_Pregunta": [f"B{b}-{i:02d}" for i in range(n)],
+            "Tema":        [str(b * 10 + i % 2) for i in range(n)],
+            "Enunciado":   [f"e{b}-{i}" for i in range(n)],
+            "Opción A": ["a"] * n, "Opción B": ["b"] * n, "Opción C": ["c"] * n, "Opción D": ["d"] * n,
+            "Correcta":    ["A"] * n,
+        })
+    hojas[lib.CFG_BLOQUES_SHEET] = pd.DataFrame({"Bloque": ["Bloque 1", "Bloque 2", "Bloque 3"],
+                                                 "Descripcion": ["Uno", "", "Tres"]})
+    hojas[lib.CFG_TEMAS_SHEET] = pd.DataFrame({
+        "Tema":   ["10", "11", "20", "21", "30", "31"],
+        "Nombre": ["Óptica", "", "", "", "", ""],
+        "Bloque": ["Bloque 1", "Bloque 1", "Bloque 2", "Bloque 2", "Bloque 3", "Bloque 3"]})
+    lib._escribir_xlsx(path, hojas)
+
+
+def _abrir_configuracion(path):
+    at = AppTest.from_string(_SCRIPT.format(
+        path=path, pagina=os.path.join(RAIZ, "pages", "3_Configuracion.py")), default_timeout=120)
+    at.secrets["GOOGLE_OAUTH"] = {}
+    at.run()
+    assert not at.exception, [e.message for e in at.exception]
+    return at
+
+
+def test_configuracion_solo_lee_hojas_de_config(tmp_path):
+    path = str(tmp_path / "banco.xlsx")
+    _banco(path)
+    at = _abrir_configuracion(path)
+    libro = at.session_state["excel_dfs"]
+    assert set(libro.hojas_leidas()) <= set(lib.CFG_SHEETS)
+    assert not libro.hojas_sucias()          # la config no ha cambiado: nada que guardar
+    at.run()                                 # otro render de la página
+    assert set(at.session_state["excel_dfs"].hojas_leidas()) <= set(lib.CFG_SHEETS)
+
+
+def test_tema_nuevo_lee_las_hojas(tmp_path):
+    path = str(tmp_path / "banco.xlsx")
+    _banco(path)
+    dfs = lib.cargar_excel_local(path)
+    dfs["Bloque 2"] = dfs["Bloque 2"].assign(Tema=[99] + [20, 21] * 9 + [20])
+    lib.guardar_excel_local(path, dfs, completo=True)
+    at = _abrir_configuracion(path)
+    libro = at.session_state["excel_dfs"]
+    temas = libro[lib.CFG_TEMAS_SHEET]
+    assert "99" in set(temas["Tema"]) and libro.hojas_sucias() == {lib.CFG_TEMAS_SHEET}
+    assert temas.set_index("Tema").loc["10", "Nombre"] == "Óptica"
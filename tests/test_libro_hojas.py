@@ -0,0 +1,48 @@
+import pandas as pd
+
+import examen_lib_latex as lib
+
+
+def _guardado(tmp_path):
+    path = str(tmp_path / "banco.xlsx")
+    lib._escribir_xlsx(path, {
+        "Bloque 1": pd.DataFrame({"ID_Pregunta": ["B1-1"], "Enunciado": ["a"]}),
+        "Bloque 2": pd.DataFrame({"ID_Pregunta": ["B2-1"], "Enunciado": ["b"]}),
+    })
+    return path, lib.cargar_excel_local(path)
+
+
+def test_asignar_marca_sucia(tmp_path):
+    _, libro = _guardado(tmp_path)
+    libro["Bloque 1"] = libro["Bloque 1"].assign(Enunciado="x")
+    assert libro.hojas_sucias() == {"Bloque 1"}
+
+
+def test_guardar_solo_hojas_marcadas(tmp_path):
+    path, libro = _guardado(tmp_path)
+    libro["Bloque 1"].loc[0, "Enunciado"] = "marcada"
+    libro.marcar_sucia("Bloque 1")
+    libro["Bloque 2"].loc[0, "Enunciado"] = "sin marcar"
+    lib.guardar_excel_local(path, libro)
+    r = lib.cargar_excel_local(path)
+    assert r["Bloque 1"].loc[0, "Enunciado"] == "marcada"
+    assert r["Bloque 2"].loc[0, "Enunciado"] == "b"   # la regla documentada
+
+
+def test_sin_marcas_guarda_todo(tmp_path):
+    path, libro = _guardado(tmp_path)
+    libro["Bloque 2"].loc[0, "Enunciado"] = "in situ"
+    assert not libro.hojas_sucias()
+    lib.guardar_excel_local(path, libro)
+    assert lib.cargar_excel_local(path)["Bloque 2"].loc[0, "Enunciado"] == "in situ"
+    assert not libro.hojas_sucias()
+
+
+def test_completo_fuerza_todas(tmp_path):
+    path, libro = _guardado(tmp_path)
+    libro["Bloque 1"].loc[0, "Enunciado"] = "marcada"
+    libro.marcar_sucia("Bloque 1")
+    libro["Bloque 2"].loc[0, "Enunciado"] = "sin marcar"
+    lib.guardar_excel_local(path, libro, completo=True)
+    r = lib.cargar_excel_local(path)
+    assert (r["Bloque 1"].loc[0, "Enunciado"], r["Bloque 2"].loc[0, "Enunciado"]) == ("marcada", "sin marcar")
@@ -0,0 +1,30 @@
+import pytest
+
+import app_utils as au
+
+
+@pytest.mark.parametrize("kw", [{"lecturas_min": 0}, {"escrituras_min": -5},
+                                {"rafaga": 0}, {"reserva": 1.0}])
+def test_limites_no_positivos_se_rechazan(kw):
+    with pytest.raises(ValueError):
+        au.PlanificadorGSheets(**kw)
+
+
+def test_cuota_invalida_usa_valores_por_defecto():
+    cuota, errores = au._cuota_gsheets({"lecturas_min": 0, "escrituras_min": "abc",
+                                        "rafaga": 0.4})
+    assert cuota == {"lecturas_min": 60, "escrituras_min": 60, "rafaga": 10}
+    assert len(errores) == 3 and "lecturas_min" in errores[0]
+    plan = au.PlanificadorGSheets(**cuota)
+    assert plan.adquirir("lectura") < 0.1      # hay ficha: no se bloquea
+
+
+def test_cuota_valida_se_respeta():
+    cuota, errores = au._cuota_gsheets({"lecturas_min": "120", "rafaga": 3})
+    assert cuota == {"lecturas_min": 120.0, "escrituras_min": 60.0, "rafaga": 3} and not errores
+
+
+def test_rafaga_minima_no_bloquea():
+    plan = au.PlanificadorGSheets(lecturas_min=6000, escrituras_min=6000, rafaga=1)
+    for _ in range(3):
+        assert plan.adquirir("escritura") < 1.0
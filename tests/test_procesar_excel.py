@@ -0,0 +1,20 @@
+import pandas as pd
+
+import app_utils as au
+
+
+def test_fecha_uso_ignora_anotaciones_tras_la_fecha():
+    dfs = {"Bloque 1": pd.DataFrame({
+        "ID_Pregunta": ["B1-1", "B1-2", "B1-3", "B1-4"],
+        "Tema":        ["1", "1", "2", "2"],
+        "Enunciado":   ["e1", "e2", "e3", "e4"],
+        "Opción A":    ["a"] * 4, "Opción B": ["b"] * 4,
+        "Opción C":    ["c"] * 4, "Opción D": ["d"] * 4,
+        "Correcta":    ["A"] * 4,
+        "Usada":       ["2024-03-05 (examen)", "2024-01-20", "", "no válida"],
+    })}
+    df = au.procesar_excel_dfs(dfs).set_index("ID_Pregunta")
+    assert pd.api.types.is_datetime64_any_dtype(df["fecha_uso"])
+    assert df.loc["B1-1", "fecha_uso"] == pd.Timestamp("2024-03-05")
+    assert df.loc["B1-2", "fecha_uso"] == pd.Timestamp("2024-01-20")
+    assert df.loc[["B1-3", "B1-4"], "fecha_uso"].isna().all()
@@ -0,0 +1,104 @@
+import random
+
+import numpy as np
+import pandas as pd
+
+import examen_lib_latex as lib
+
+
+def _banco(temas, bloque="Bloque 1", dificultad="Media"):
+    return pd.DataFrame({
+        "ID_Pregunta": [f"P{i}" for i in range(len(temas))],
+        "bloque":      [bloque] * len(temas),
+        "Tema":        [str(t) for t in temas],
+        "dificultad":  [dificultad] * len(temas),
+    })
+
+
+def _banco_grande(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "ID_Pregunta": [f"P{i}" for i in range(n)],
+        "bloque":      rng.choice(["Bloque 1", "Bloque 2"], n),
+        "Tema":        rng.integers(1, 6, n).astype(str),
+        "dificultad":  rng.choice(["Fácil", "Media", "Difícil"], n),
+        "objetivo":    rng.integers(1, 4, n).astype(str),
+    })
+
+
+_RECETA = {
+    "Bloque 1": {"1": {"fácil": 3, "media": 2}, "__ALL__": {"difícil": 4},
+                 "__OBJ_2": {"media": 2}},
+    "Bloque 2": {"3": {"difícil": 2}, "__ALL__": {"fácil": 5, "media": 5}},
+}
+
+
+def test_misma_semilla_misma_seleccion():
+    df = _banco_grande()
+    a, fa = lib.aplicar_receta(df, _RECETA, rng=7)
+    b, fb = lib.aplicar_receta(df, _RECETA, rng=random.Random(7))
+    assert a == b and fa == fb == []
+    assert lib.aplicar_receta(df, _RECETA, rng=8)[0] != a
+
+
+def test_misma_semilla_con_pesos():
+    df = _banco_grande()
+    pesos = np.linspace(0.1, 1.0, len(df))
+    a, _ = lib.aplicar_receta(df, _RECETA, rng=3, pesos=pesos)
+    b, _ = lib.aplicar_receta(df, _RECETA, rng=3, pesos=pesos)
+    assert a == b
+
+
+def test_celdas_solapadas_se_resuelven():
+    # Tema 1 pide sus dos únicas preguntas; '__ALL__' solo puede quedarse la del tema 2
+    df = _banco([1, 1, 2])
+    receta = {"Bloque 1": {"__ALL__": {"media": 1}, "1": {"media": 2}}}
+    for semilla in range(20):
+        ids, faltas = lib.aplicar_receta(df, receta, rng=semilla)
+        assert sorted(ids) == ["P0", "P1", "P2"] and faltas == []
+
+
+def test_fijas_cuentan_y_no_se_repiten():
+    df = _banco_grande()
+    fijas = df["ID_Pregunta"].iloc[::40].tolist()
+    ids, faltas = lib.aplicar_receta(df, _RECETA, fijas=fijas, rng=1)
+    assert faltas == []
+    assert not set(ids) & set(fijas)
+    assert len(set(ids)) == len(ids)
+    # las fijas del tema 1 (fácil) del bloque 1 descuentan de esa celda, que no
+    # comparte preguntas con ninguna otra de la receta
+    por_id = df.set_index("ID_Pregunta")
+    en_celda = lambda xs: int(((por_id.loc[xs, "bloque"] == "Bloque 1") & (por_id.loc[xs, "Tema"] == "1")
+                               & (por_id.loc[xs, "dificultad"] == "Fácil")).sum())
+    assert en_celda(fijas) >= 1
+    assert en_celda(ids) == max(0, 3 - en_celda(fijas))
+
+
+def test_faltas_sin_preguntas_suficientes():
+    df = _banco([1, 1, 2])
+    ids, faltas = lib.aplicar_receta(df, {"Bloque 1": {"1": {"media": 3}}}, fijas=["P0"], rng=0)
+    assert ids == ["P1"]
+    assert faltas == [{"bloque": "Bloque 1", "clave": "1", "etiqueta": "Tema 1",
+                       "dificultad": "media", "pedidas": 3, "fijas": 1, "añadidas": 1,
+                       "conflicto": [], "disponibles": 1}]
+
+
+def test_faltas_por_conflicto_entre_celdas():
+    # 3 preguntas para 4 huecos: una de las dos celdas queda corta y señala a la otra
+    df = _banco([1, 1, 2])
+    receta = {"Bloque 1": {"1": {"media": 2}, "__ALL__": {"media": 2}}}
+    ids, faltas = lib.aplicar_receta(df, receta, rng=0)
+    assert sorted(ids) == ["P0", "P1", "P2"]
+    assert len(faltas) == 1
+    f = faltas[0]
+    assert f["pedidas"] - f["añadidas"] == 1
+    otra = ("Bloque 1", "Tema 1", "media") if f["clave"] == "__ALL__" else \
+           ("Bloque 1", "(cualquier tema)", "media")
+    assert f["conflicto"] == [otra] and f["disponibles"] == 3
+
+
+def test_tema_inexistente_y_banco_vacio():
+    df = _banco([1, 2])
+    ids, faltas = lib.aplicar_receta(df, {"Bloque 1": {"9": {"media": 2}}}, rng=0)
+    assert ids == [] and faltas[0]["añadidas"] == 0 and faltas[0]["disponibles"] == 0
+    assert lib.aplicar_receta(df.iloc[0:0], {"Bloque 1": {"1": {"media": 1}}}) == ([], [])
@@ -0,0 +1,39 @@
+import concurrent.futures
+
+import pandas as pd
+import pytest
+
+import examen_lib_latex as lib
+
+
+def _banco(enunciados):
+    return pd.DataFrame({"ID_Pregunta": [f"P{i}" for i in range(len(enunciados))],
+                         "enunciado": enunciados})
+
+
+def test_cubetas_grandes_se_omiten_con_aviso():
+    # 30 enunciados idénticos caen en la misma cubeta de todas las bandas
+    idx = lib.IndiceSimilitud.desde_df(_banco(["¿Cuál es la capital de Francia?"] * 30))
+    assert len(idx.pares_candidatos()) == 30 * 29 // 2
+    with pytest.warns(RuntimeWarning, match="cubeta"):
+        assert idx.pares_candidatos(max_cubeta=10) == set()
+    assert idx.cubetas_omitidas and all(n == 30 for _, n in idx.cubetas_omitidas)
+
+
+def test_pares_de_cubetas_pequenas_se_mantienen():
+    textos = ["Enunciado repetido de plantilla"] * 30 + [
+        "¿Qué órgano bombea la sangre por el cuerpo humano?",
+        "¿Qué órgano bombea la sangre por el cuerpo humano ?"]
+    idx = lib.IndiceSimilitud.desde_df(_banco(textos))
+    with pytest.warns(RuntimeWarning):
+        pares = idx.pares_candidatos(max_cubeta=10)
+    assert ("P30", "P31") in pares
+
+
+def test_banco_pequeno_no_arranca_procesos(monkeypatch):
+    def _prohibido(*a, **kw):
+        raise AssertionError("no debería arrancar procesos")
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", _prohibido)
+    df = _banco(["¿Cuánto es dos más dos?", "¿Cuánto es dos más dos ?", "Otra pregunta distinta"])
+    grupos = lib.auditar_duplicados(df, procesos=4, tam_lote=1)
+    assert [sorted(g["ids"]) for g in grupos] == [["P0", "P1"]]
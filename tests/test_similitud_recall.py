@@ -0,0 +1,88 @@
+"""Recall de la detección de casi-duplicados frente a la comparación con todo el banco."""
+import random
+from difflib import SequenceMatcher
+
+import pandas as pd
+import pytest
+
+import examen_lib_latex as lib
+
+_PALABRAS = (
+    "calcule determine la el de un una que cual cuanto sobre con por para entre desde "
+    "energia cinetica potencial masa carga electron proton neutron foton haz dosis "
+    "absorbida equivalente efectiva radiacion ionizante tejido blando hueso agua plomo "
+    "aluminio espesor coeficiente atenuacion lineal masico capa hemirreductora fluencia "
+    "kerma aire exposicion actividad isotopo periodo semidesintegracion constante "
+    "desintegracion becquerel gray sievert rendimiento detector camara ionizacion "
+    "velocidad aceleracion fuerza campo electrico magnetico potencial diferencia "
+    "longitud onda frecuencia intensidad sonido ultrasonido impedancia acustica "
+    "reflexion refraccion lente focal imagen resonancia spin relajacion tiempo "
+    "paciente tratamiento acelerador lineal fuente braquiterapia distancia cuadrado "
+    "inverso ley tension corriente resistencia circuito condensador bobina").split()
+
+
+def _corpus(n_semillas=60, n_consultas=80, seed=3):
+    rng = random.Random(seed)
+    semillas = [" ".join(rng.choice(_PALABRAS) for _ in range(rng.randint(12, 28))) + "?"
+                for _ in range(n_semillas)]
+    consultas = []
+    for _ in range(n_consultas):
+        w = rng.choice(semillas).split()
+        for _ in range(rng.randint(1, 4)):
+            i, op = rng.randrange(len(w)), rng.random()
+            if op < .35:
+                w[i] = rng.choice(_PALABRAS)
+            elif op < .6:
+                w.insert(i, rng.choice(_PALABRAS))
+            elif op < .8 and len(w) > 6:
+                del w[i]
+            else:
+                j = rng.randrange(len(w))
+                w[i], w[j] = w[j], w[i]
+        consultas.append(" ".join(w))
+    df = pd.DataFrame({"ID_Pregunta": [f"P{i}" for i in range(n_semillas)], "enunciado": semillas})
+    return df, consultas
+
+
+def _bruto(indice, texto):
+    sm = SequenceMatcher(None, lib._normalizar_texto(texto), "")
+    mejor = 0.0
+    for norm in indice._norm.values():
+        sm.set_seq2(norm)
+        mejor = max(mejor, sm.ratio())
+    return mejor
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    df, consultas = _corpus()
+    indice = lib.IndiceSimilitud.desde_df(df)
+    return indice, consultas, [_bruto(indice, q) for q in consultas]
+
+
+def test_banco_pequeno_igual_que_comparar_con_todos(corpus):
+    indice, consultas, bruto = corpus
+    assert len(indice) <= lib.SIMILITUD_EXACTA_HASTA
+    for q, esperado in zip(consultas, bruto):
+        es_dup, sim = lib.check_for_similar_enunciado(q, indice)
+        assert sim == pytest.approx(esperado)
+        assert es_dup == (esperado > lib.SIMILITUD_DUPLICADO)
+
+
+def test_similares_exacto_igual_que_comparar_con_todos(corpus):
+    indice, consultas, bruto = corpus
+    for q, esperado in zip(consultas, bruto):
+        assert indice.similares(q, k=1, exacto=True)[0][1] == pytest.approx(esperado)
+
+
+def test_recall_solo_lsh(corpus, monkeypatch):
+    # Bancos grandes: solo candidatos LSH, más la pasada exacta cerca del umbral
+    indice, consultas, bruto = corpus
+    duplicados = [q for q, b in zip(consultas, bruto) if b > lib.SIMILITUD_DUPLICADO]
+    assert len(duplicados) >= 30
+    solo_lsh = sum(bool(t) and t[0][1] > lib.SIMILITUD_DUPLICADO
+                   for t in (indice.similares(q, k=1) for q in duplicados))
+    monkeypatch.setattr(lib, "SIMILITUD_EXACTA_HASTA", 0)
+    con_margen = sum(lib.check_for_similar_enunciado(q, indice)[0] for q in duplicados)
+    assert solo_lsh / len(duplicados) >= 0.95
+    assert con_margen >= solo_lsh
@@ -0,0 +1,158 @@
+import time
+
+import pandas as pd
+import pytest
+
+import app_utils as au
+from fake_gsheets import FakeSpreadsheet
+
+
+def _banco(n=10):
+    return pd.DataFrame({
+        "ID_Pregunta": [f"B1-{i:02d}" for i in range(n)],
+        "Enunciado":   [f"e{i}" for i in range(n)],
+        "Nota":        [""] * n,
+    })
+
+
+@pytest.fixture
+def sesion():
+    sh = FakeSpreadsheet()
+    ses = au.SesionGSheets(sh)
+    df = _banco()
+    snap, _ = au.sincronizar_hoja_delta(ses, "B1", df, None)
+    return sh, ses, df, snap
+
+
+def _sincronizar(sh, ses, df, snap):
+    n = len(sh.llamadas)
+    snap, stats = au.sincronizar_hoja_delta(ses, "B1", df, snap)
+    assert sh.ws["B1"].get_all_values() == au._grid_hoja(df)
+    return snap, stats, sh.llamadas[n:]
+
+
+def test_alta_de_pestaña(sesion):
+    sh, _, df, _ = sesion
+    assert sh.ws["B1"].get_all_values() == au._grid_hoja(df)
+    assert [m for m, _ in sh.llamadas] == ["fetch_sheet_metadata", "add_worksheet", "batch_update"]
+
+
+def test_actualizar_escribe_solo_la_celda(sesion):
+    sh, ses, df, snap = sesion
+    df.loc[4, "Nota"] = "revisar"
+    _, stats, llamadas = _sincronizar(sh, ses, df, snap)
+    assert [m for m, _ in llamadas] == ["batch_update"]
+    (tipo, cuerpo), = sh.peticiones()
+    assert tipo == "updateCells"
+    # fila 5 de la hoja (la 0 es la cabecera), columna Nota (2), una celda
+    assert cuerpo["range"] == {"sheetId": sh.ws["B1"].id, "startRowIndex": 5, "endRowIndex": 6,
+                               "startColumnIndex": 2, "endColumnIndex": 3}
+    assert stats["celdas"] == 1
+
+
+def test_insertar_escribe_solo_filas_nuevas(sesion):
+    sh, ses, df, snap = sesion
+    df = pd.concat([df, pd.DataFrame({"ID_Pregunta": ["N1", "N2"], "Enunciado": ["a", "b"],
+                                      "Nota": ["", "x"]})], ignore_index=True)
+    _, stats, _ = _sincronizar(sh, ses, df, snap)
+    rangos = [(c["range"]["startRowIndex"], c["range"]["startColumnIndex"], c["range"]["endColumnIndex"])
+              for t, c in sh.peticiones() if t == "updateCells"]
+    assert rangos == [(11, 0, 2), (12, 0, 3)]
+    assert all(t == "updateCells" for t, _ in sh.peticiones())   # la pestaña tiene filas libres
+    assert stats["filas_escritas"] == 2
+
+
+def test_borrar_elimina_filas_sin_reescribir(sesion):
+    sh, ses, df, snap = sesion
+    df = df.drop([2, 3, 7]).reset_index(drop=True)
+    _, stats, _ = _sincronizar(sh, ses, df, snap)
+    pets = sh.peticiones()
+    assert [t for t, _ in pets] == ["deleteDimension", "deleteDimension"]
+    # de abajo arriba y agrupando contiguas: fila 8 (B1-07) y filas 3-4 (B1-02, B1-03)
+    assert [(c["range"]["startIndex"], c["range"]["endIndex"]) for _, c in pets] == [(8, 9), (3, 5)]
+    assert stats["borradas"] == 3 and stats["filas_escritas"] == 0
+
+
+def test_sin_cambios_no_hay_peticion(sesion):
+    sh, ses, df, snap = sesion
+    _, stats, llamadas = _sincronizar(sh, ses, df, snap)
+    assert llamadas == [] and stats["peticiones"] == 0
+
+
+def test_sin_cuadricula_previa_relee_la_hoja(sesion):
+    sh, ses, df, _ = sesion
+    df.loc[0, "Enunciado"] = "cambio"
+    _, _, llamadas = _sincronizar(sh, ses, df, None)
+    assert [m for m, _ in llamadas] == ["values_get", "batch_update"]
+    assert len(sh.peticiones()) == 1
+
+
+# ── Cola de sincronización ───────────────────────────────────────────────────
+class _SpreadsheetLento(FakeSpreadsheet):
+    """batch_update que tarda `espera` segundos y falla si `fallar`."""
+    def __init__(self, espera=0.0, fallar=False):
+        super().__init__()
+        self.espera, self.fallar = espera, fallar
+
+    def batch_update(self, body):
+        time.sleep(self.espera)
+        if self.fallar:
+            raise ValueError("sin permiso")
+        return super().batch_update(body)
+
+
+def _cola(sh):
+    ses = au.SesionGSheets(sh)
+    snap, _ = au.sincronizar_hoja_delta(ses, "B1", _banco(), None)
+    cola = au.ColaSyncGSheets(ventana=0.0)
+    cola.reiniciar(ses, {"B1": snap})
+    return ses, cola
+
+
+def test_reiniciar_no_descarta_fallidas():
+    sh = _SpreadsheetLento()
+    ses, cola = _cola(sh)
+    sh.fallar = True
+    df = _banco()
+    df.loc[0, "Nota"] = "x"
+    cola.encolar(ses, "B1", au._grid_hoja(df))
+    assert cola.vaciar(timeout=5)
+    assert set(cola.estado()["fallidas"]) == {"B1"}
+    with pytest.raises(RuntimeError, match="B1"):
+        cola.reiniciar(ses, {})
+    assert set(cola.estado()["fallidas"]) == {"B1"}     # se pueden reintentar
+    sh.fallar = False
+    cola.reintentar_fallidas()
+    assert cola.vaciar(timeout=5) and not cola.estado()["fallidas"]
+    assert sh.ws["B1"].get_all_values() == au._grid_hoja(df)
+    cola.reiniciar(ses, {"B1": au._grid_hoja(df)})
+
+
+def test_reiniciar_descartando_ignora_envio_tardio():
+    sh = _SpreadsheetLento()
+    ses, cola = _cola(sh)
+    sh.espera = 0.5
+    df = _banco()
+    df.loc[1, "Nota"] = "tarde"
+    cola.encolar(ses, "B1", au._grid_hoja(df))
+    while cola._en_curso is None:
+        time.sleep(0.01)
+    with pytest.raises(RuntimeError):
+        cola.reiniciar(ses, {}, timeout=0.05)       # envío aún en curso
+    nuevos = {"B1": [["ID_Pregunta"]]}
+    cola.reiniciar(ses, nuevos, descartar=True)
+    cola.vaciar(timeout=5)
+    assert cola.snaps is nuevos and cola.snaps["B1"] == [["ID_Pregunta"]]
+
+
+def test_reiniciar_espera_el_envio_en_curso():
+    sh = _SpreadsheetLento()
+    ses, cola = _cola(sh)
+    sh.espera = 0.3
+    df = _banco()
+    df.loc[2, "Nota"] = "y"
+    cola.encolar(ses, "B1", au._grid_hoja(df))
+    while cola._en_curso is None:
+        time.sleep(0.01)
+    cola.reiniciar(ses, {"B1": au._grid_hoja(df)})
+    assert sh.ws["B1"].get_all_values() == au._grid_hoja(df)